@@ -52,6 +52,13 @@ function MetarView() {
         };
 
         fetchMetar();
+
+        // receive new observations pushed by the server instead of polling
+        const source = new EventSource(`${window.REACT_APP_API_URL}/metar/stream?icao=${icao}`);
+        source.addEventListener('metar', (event) => {
+          setMetarData(JSON.parse(event.data));
+        });
+        return () => source.close();
       }, [icao]);
 
   if (!metarData) {
@@ -1,34 +1,377 @@
+import atexit
+import configparser
 import logging
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+import os
+import random
+import re
+import threading
+import time
+from metar_metrics import QUERY_SECONDS, WRITE_POINTS, WRITE_SECONDS
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def writeMetarToInfluxDb2(metar, bucket):
-    try:
-        client = InfluxDBClient.from_config_file("config.ini")
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-        point = Point("metar") \
-            .tag("icao", metar["station"]) \
-            .field("temperature", metar["temperatures"]["temperature"]) \
-            .field("dewpoint", metar["temperatures"]["dew_point"]) \
-            .field("humidity", metar["humidity"]) \
-            .field("wind_direction", metar["wind"]["direction"]) \
-            .field("wind_speed", metar["wind"]["speed"]) \
-            .field("wind_gust", metar["wind"]["gust"]) \
-            .field("visibility", metar["visibility"]) \
-            .field("weather", metar["weather"]) \
-            .field("qnh", metar["QNH"])
-        write_api.write(bucket=bucket, org=client.org, record=point)
-    except Exception as e:
-        logger.error(f"Error writing METAR to InfluxDB: {e}")
+# METAR_CONFIG selects another config file, e.g. one which points at the sink of metar_replay.py
+CONFIG_FILE = os.environ.get("METAR_CONFIG", "config.ini")
+
+ICAO_PATTERN = re.compile(r"^[A-Z0-9]{3,4}$")
+
+DURATION_PATTERN = re.compile(r"^(\d+)(s|m|h|d|w)$")
+DURATION_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Numeric fields which can be aggregated, weather is a text field
+HISTORY_FIELDS = ("temperature", "dewpoint", "humidity", "wind_direction", "wind_speed",
+                  "wind_gust", "visibility", "qnh")
+HISTORY_FUNCTIONS = ("mean", "min", "max", "median", "last")
+
+# Upper bound of points per field of a history query
+MAX_HISTORY_POINTS = 5000
+
+class MetarRepository:
+    """
+    Holds one InfluxDB client for the whole process and writes METARs in
+    batches.
+
+    Points are collected in a buffer and sent by a background thread with one
+    HTTP request per batch through the synchronous write API of the client. A
+    batch is sent once it holds batch_size points or flush_interval
+    milliseconds after its first point was buffered. Failed batches are
+    retried with exponential backoff plus random jitter, points are counted
+    as written once InfluxDB stored them. At most max_buffered points wait
+    for the writer, write_many blocks until there is room, so a producer
+    faster than InfluxDB does not grow the buffer without bound.
+    """
+
+    def __init__(self, client, bucket="metar", batch_size=500, flush_interval=1000,
+                 jitter_interval=0, retry_interval=5000, max_retries=5, max_buffered=10000):
+        """
+        Args:
+            client: The InfluxDBClient to use, it is owned and closed by the repository.
+            bucket: The default bucket to write to.
+            batch_size: The maximum number of points per write request.
+            flush_interval: Milliseconds after which a partial batch is written.
+            jitter_interval: Maximum random delay of a flush and of a retry in milliseconds.
+            retry_interval: Milliseconds to wait before the first retry of a failed batch, doubled for every retry.
+            max_retries: Number of retries of a failed batch, 0 disables retries.
+            max_buffered: The maximum number of points buffered or being written.
+        """
+        from influxdb_client.client.write_api import SYNCHRONOUS
+        self.client = client
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.jitter_interval = jitter_interval
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.max_buffered = max_buffered
+        self._write_api = client.write_api(write_options=SYNCHRONOUS)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._closed = False
+        # buffered points by bucket, the points not yet written include the batch being sent
+        self._buffers = {}
+        self._buffered = 0
+        self._unwritten = 0
+        self._deadline = None
+        self._flushes = 0
+        self._blocked = 0
+        self._writer = threading.Thread(target=self._run, name="influx-writer", daemon=True)
+        self._writer.start()
+
+    @classmethod
+    def fromConfigFile(cls, config_file=CONFIG_FILE, bucket="metar"):
+        """
+        Creates a repository from the [influx2] section of a config file.
+
+        The optional [batching] section overrides the batching settings, e.g.
+        batch_size, flush_interval, jitter_interval, retry_interval, max_retries and max_buffered.
+
+        Args:
+            config_file: The path of the config file.
+            bucket: The default bucket to write to.
+
+        Returns:
+            A new MetarRepository.
+        """
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        options = {}
+        if config.has_section("batching"):
+            options = {key: config.getint("batching", key) for key in config.options("batching")}
+        # the client pulls in numpy and reactivex, only processes which talk to InfluxDB load it
+        from influxdb_client import InfluxDBClient
+        client = InfluxDBClient.from_config_file(config_file)
+        return cls(client, bucket=bucket, **options)
+
+    def write(self, metar, bucket=None):
+        """
+        Queues a single METAR for writing.
+
+        Args:
+            metar: The parsed METAR dictionary.
+            bucket: The bucket, defaults to the bucket of the repository.
+
+        Returns:
+            The number of queued points, 0 or 1.
+        """
+        return self.write_many([metar], bucket)
+
+    def write_many(self, metars, bucket=None):
+        """
+        Queues many METARs for writing, they are sent in batches. Blocks
+        while the buffer has no room for them.
+
+        METARs which can not be converted to a point are logged and skipped.
+
+        Args:
+            metars: An iterable of parsed METAR dictionaries.
+            bucket: The bucket, defaults to the bucket of the repository.
+
+        Returns:
+            The number of queued points, they are counted in WRITE_POINTS once written.
+
+        Raises:
+            RuntimeError: If the repository is closed.
+        """
+        points = []
+        for metar in metars:
+            try:
+                points.append(metarToPoint(metar))
+            except Exception as e:
+                logger.error(f"Error converting METAR to point: {e}")
+        with self._changed:
+            # a call with more than max_buffered points waits for an empty buffer
+            room = lambda: self._closed or not self._unwritten or self._unwritten + len(points) <= self.max_buffered
+            if not room():
+                # a waiting producer makes the writer send partial batches
+                self._blocked += 1
+                self._changed.notify_all()
+                try:
+                    self._changed.wait_for(room)
+                finally:
+                    self._blocked -= 1
+            if self._closed:
+                raise RuntimeError("The repository is closed")
+            if points:
+                if not self._buffered:
+                    jitter = random.uniform(0, self.jitter_interval)
+                    self._deadline = time.monotonic() + (self.flush_interval + jitter) / 1000
+                self._buffers.setdefault(bucket or self.bucket, []).extend(points)
+                self._buffered += len(points)
+                self._unwritten += len(points)
+                self._changed.notify_all()
+        return len(points)
+
+    def write_lines(self, lines, bucket=None):
+        """
+        Writes points in line protocol and waits until InfluxDB stored them.
+
+        Unlike write_many nothing is buffered or retried, so the caller knows
+        whether the points are stored, e.g. the drainer of the spool which
+        retries after retryDelay.
+
+        Args:
+            lines: A list of points in line protocol.
+            bucket: The bucket, defaults to the bucket of the repository.
+
+        Raises:
+            Exception: If the write fails.
+        """
+        self._post(bucket or self.bucket, lines)
+
+    def _post(self, bucket, records):
+        # one HTTP request, timed and counted once InfluxDB stored the points
+        with WRITE_SECONDS.time():
+            self._write_api.write(bucket=bucket, org=self.client.org, record=records)
+        WRITE_POINTS.inc(len(records))
+
+    def _run(self):
+        # the writer thread, sends a batch when it is full, due, flushed or the repository closes
+        while True:
+            with self._changed:
+                while not self._closed and not (self._buffered and (
+                        self._buffered >= self.batch_size or self._flushes or self._blocked
+                        or time.monotonic() >= self._deadline)):
+                    self._changed.wait(self._deadline - time.monotonic() if self._buffered else None)
+                if not self._buffered:
+                    return
+                bucket = next(iter(self._buffers))
+                buffer = self._buffers[bucket]
+                points = buffer[:self.batch_size]
+                del buffer[:self.batch_size]
+                if not buffer:
+                    del self._buffers[bucket]
+                self._buffered -= len(points)
+            try:
+                self._writeBatch(bucket, points)
+            finally:
+                with self._changed:
+                    self._unwritten -= len(points)
+                    self._changed.notify_all()
+
+    def _writeBatch(self, bucket, points):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._post(bucket, points)
+                return
+            except Exception as e:
+                if attempt == self.max_retries or isPermanent(e) or self._closed:
+                    logger.error(f"Error writing METAR batch of {len(points)} points to InfluxDB: {e}")
+                    return
+                delay = self.retryDelay(attempt + 1)
+                logger.warning(f"Retrying METAR batch write to InfluxDB in {delay:.1f}s: {e}")
+            with self._changed:
+                # closing the repository cuts the wait short, the batch gets one last attempt
+                self._changed.wait_for(lambda: self._closed, delay)
+
+    def retryDelay(self, attempt):
+        """
+        Returns the delay before a retry, the retry interval doubles with
+        every attempt and a random jitter is added. The spool drainer waits
+        as long between failed drains, so all writes follow one retry policy.
+
+        Args:
+            attempt: The number of the failed attempt, starting at 1.
+
+        Returns:
+            The delay in seconds.
+        """
+        return (self.retry_interval * 2 ** (attempt - 1) + random.uniform(0, self.jitter_interval)) / 1000
+
+    def flush(self):
+        """
+        Writes all buffered points and waits until they are sent or given up.
+        """
+        with self._changed:
+            self._flushes += 1
+            self._changed.notify_all()
+            try:
+                self._changed.wait_for(lambda: not self._unwritten)
+            finally:
+                self._flushes -= 1
+
+    def close(self):
+        """
+        Writes all buffered points right away and closes the client.
+        """
+        with self._changed:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+        self._writer.join()
+        self._write_api.close()
+        self.client.close()
+
+def isPermanent(error):
+    """
+    Returns True if a write failed for good, InfluxDB answered with a client
+    error other than 408 or 429. Server and connection errors are transient.
+    """
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+_repository = None
+_repository_lock = threading.Lock()
+
+def getRepository():
+    """
+    Returns the process wide repository, it is created on first use.
+
+    Returns:
+        The shared MetarRepository.
+    """
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            _repository = MetarRepository.fromConfigFile(CONFIG_FILE)
+            atexit.register(closeRepository)
+        return _repository
+
+def closeRepository():
+    """
+    Flushes and closes the process wide repository if it was created.
+    """
+    global _repository
+    with _repository_lock:
+        if _repository is not None:
+            _repository.close()
+            _repository = None
+
+def metarToFields(metar):
+    """
+    Extracts the stored fields of a parsed METAR.
+
+    Args:
+        metar: The parsed METAR dictionary.
+
+    Returns:
+        A dictionary of the field values, keyed like the InfluxDB fields. The
+        fields of a group missing in the report, e.g. "/////KT", are None.
+    """
+    temperatures = metar["temperatures"] or {}
+    wind = metar["wind"] or {}
+    return {
+        "temperature": temperatures.get("temperature"),
+        "dewpoint": temperatures.get("dew_point"),
+        "humidity": metar["humidity"],
+        "wind_direction": wind.get("direction"),
+        "wind_speed": wind.get("speed"),
+        "wind_gust": wind.get("gust"),
+        "visibility": metar["visibility"],
+        "weather": metar["weather"],
+        "qnh": metar["QNH"],
+    }
+
+def metarToPoint(metar):
+    """
+    Converts a parsed METAR into an InfluxDB point, stamped with the observation time.
+
+    The wind_direction field is an integer, variable wind ("VRB") is stored
+    as wind_variable=true without a direction, see storedToFields. Fields
+    without a value are left out.
+
+    Args:
+        metar: The parsed METAR dictionary.
+
+    Returns:
+        The Point of the METAR.
+    """
+    from influxdb_client import Point
+    point = Point("metar").tag("icao", metar["station"])
+    if metar.get("time"):
+        point.time(metar["time"])
+    for field, value in metarToFields(metar).items():
+        if value is None:
+            continue
+        if field == "wind_direction":
+            variable = value == "VRB"
+            point.field("wind_variable", variable)
+            if variable:
+                continue
+        point.field(field, value)
+    return point
+
+def storedToFields(values):
+    """
+    Converts the stored fields of an observation back into the shape of metarToFields.
+
+    Args:
+        values: A dictionary of the InfluxDB field values.
+
+    Returns:
+        The dictionary with wind_direction "VRB" for variable wind and without wind_variable.
+    """
+    if values.pop("wind_variable", False):
+        values["wind_direction"] = "VRB"
+    return values
 
 def fetchMetar(icao, bucket):
     try:
-        client = InfluxDBClient.from_config_file("config.ini")
-        query_api = client.query_api()
-        
+        query_api = getRepository().client.query_api()
+
         # Query to get the latest METAR for the specified ICAO
         query = f'''
             from(bucket: "{bucket}")
@@ -37,11 +380,12 @@ def fetchMetar(icao, bucket):
                 |> filter(fn: (r) => r["icao"] == "{icao}")
                 |> last()
         '''
-        result = query_api.query(query)
-        
+        with QUERY_SECONDS.labels("latest").time():
+            result = query_api.query(query)
+
         if not result:
             return None
-            
+
         # Convert the result to a dictionary
         metar_data = {}
         for table in result:
@@ -49,11 +393,128 @@ def fetchMetar(icao, bucket):
                 field = record.get_field()
                 value = record.get_value()
                 metar_data[field] = value
-                
-        return metar_data
-        
+
+        return storedToFields(metar_data)
+
     except Exception as e:
         logger.error(f"Error querying InfluxDB: {e}")
         return None
-    finally:
-        client.close()
\ No newline at end of file
+
+def fetchLatestMetars(icaos, bucket):
+    """
+    Queries the latest METAR of many stations with a single Flux query.
+
+    Args:
+        icaos: An iterable of ICAO airport codes, or None for all stations of the last 24 hours.
+        bucket: The InfluxDB bucket.
+
+    Returns:
+        A dictionary mapping each station to its field dictionary. Stations
+        without an observation are missing from the result.
+
+    Raises:
+        ValueError: If an ICAO code is not 3 or 4 letters or digits.
+    """
+    station_filter = ""
+    if icaos is not None:
+        icaos = [icao.upper() for icao in icaos]
+        invalid = [icao for icao in icaos if not ICAO_PATTERN.match(icao)]
+        if invalid:
+            raise ValueError(f"Invalid ICAO codes: {', '.join(invalid)}")
+        if not icaos:
+            return {}
+        stations = ", ".join(f'"{icao}"' for icao in icaos)
+        station_filter = f'|> filter(fn: (r) => contains(value: r["icao"], set: [{stations}]))'
+
+    # every series (icao, field) is its own table, so last() yields the latest value per station and field
+    query = f'''
+        from(bucket: "{bucket}")
+            |> range(start: -24h)
+            |> filter(fn: (r) => r["_measurement"] == "metar")
+            {station_filter}
+            |> last()
+    '''
+    metars = {}
+    with QUERY_SECONDS.labels("latest_many").time():
+        for record in getRepository().client.query_api().query_stream(query):
+            metars.setdefault(record.values["icao"], {})[record.get_field()] = record.get_value()
+    return {icao: storedToFields(values) for icao, values in metars.items()}
+
+def parseDuration(duration):
+    """
+    Converts a Flux style duration into seconds.
+
+    Args:
+        duration: The duration (e.g., "30m", "24h", "7d").
+
+    Returns:
+        The duration in seconds.
+
+    Raises:
+        ValueError: If the duration is not a positive number followed by s, m, h, d or w.
+    """
+    match = DURATION_PATTERN.match(duration or "")
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid duration: {duration}")
+    return int(match.group(1)) * DURATION_SECONDS[match.group(2)]
+
+def fetchHistory(icao, bucket, period="24h", resolution="1h", fields=HISTORY_FIELDS, fn="mean"):
+    """
+    Queries the downsampled history of a station.
+
+    The observations are aggregated into windows of the resolution inside
+    InfluxDB with aggregateWindow and pivoted into one row per window, so only
+    the downsampled points leave the database.
+
+    Args:
+        icao: The ICAO airport code.
+        bucket: The InfluxDB bucket.
+        period: How far back to query (e.g., "30d").
+        resolution: The window size of the aggregation (e.g., "1h").
+        fields: The fields to return, a subset of HISTORY_FIELDS.
+        fn: The aggregate function of a window, one of HISTORY_FUNCTIONS.
+
+    Returns:
+        A columnar dictionary with the window times in epoch seconds under
+        "time" and one list of values per field. Windows without a value of a
+        field hold None.
+
+    Raises:
+        ValueError: If an argument is invalid or the query would return more than MAX_HISTORY_POINTS windows.
+    """
+    icao = icao.upper()
+    if not ICAO_PATTERN.match(icao):
+        raise ValueError(f"Invalid ICAO code: {icao}")
+    fields = list(fields)
+    unknown = [field for field in fields if field not in HISTORY_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Invalid fields: {', '.join(unknown)}")
+    if fn not in HISTORY_FUNCTIONS:
+        raise ValueError(f"Invalid aggregate function: {fn}")
+    if parseDuration(period) / parseDuration(resolution) > MAX_HISTORY_POINTS:
+        raise ValueError(f"More than {MAX_HISTORY_POINTS} points, use a coarser resolution")
+
+    field_set = ", ".join(f'"{field}"' for field in fields)
+    columns = ", ".join(f'"{column}"' for column in ["_time"] + fields)
+    query = f'''
+        from(bucket: "{bucket}")
+            |> range(start: -{period})
+            |> filter(fn: (r) => r["_measurement"] == "metar")
+            |> filter(fn: (r) => r["icao"] == "{icao}")
+            |> filter(fn: (r) => contains(value: r["_field"], set: [{field_set}]))
+            |> aggregateWindow(every: {resolution}, fn: {fn}, createEmpty: false)
+            |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+            |> keep(columns: [{columns}])
+            |> sort(columns: ["_time"])
+    '''
+    history = {"time": []}
+    for field in fields:
+        history[field] = []
+    with QUERY_SECONDS.labels("history").time():
+        for record in getRepository().client.query_api().query_stream(query):
+            values = record.values
+            history["time"].append(int(values["_time"].timestamp()))
+            for field in fields:
+                value = values.get(field)
+                history[field].append(round(value, 2) if isinstance(value, float) else value)
+    return history
@@ -1,13 +1,19 @@
 import metar_parser as mp
 import metar_crawler as mc
-import logging
 import json
+import logging
+import re
 from datetime import datetime
 import TimeSeriesRepository as tsr
-import schedule
+import metar_broker
+import metar_cache
+import functools
+import metar_metrics
+import metar_spool
+import metar_stations
 import threading
 import time
-from flask import Flask, jsonify, make_response
+from flask import Flask, Response, jsonify, make_response, request
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -16,100 +22,388 @@ CORS(app)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+metar_metrics.registerCache(metar_cache.latestObservations)
+metar_metrics.registerCache(mp.parseMemo, prefix="metar_parse_memo", description="parse memo")
+
 # Configuration handling
 class Config:
     FLASK_PORT = 5000
     FLASK_HOST = '0.0.0.0'
     SCHEDULER_INTERVALS = ['21', '51']  # Minutes past the hour
+    SCHEDULER_SHARDS = 10  # Stations of a cycle are split into this many shards
+    SCHEDULER_SHARD_SPACING = 15  # Seconds between the start of two shards
+    SCHEDULER_MAX_LAG = 600  # Shard jobs starting later than this are skipped, the next cycle fetches them
+    INGESTION_MODE = 'scheduler'  # 'scheduler' or 'pipeline'
+    REFRESH_INTERVAL = 30  # Seconds between two refreshes of the latest observations in API only processes
+    INGESTION_LOCK_FILE = '/tmp/metar-ingestion.lock'  # Held by the ingestion process, see ingest.py
+    INGESTION_METRICS_PORT = 9100  # Port of /metrics of the ingestion process
+    TRACKED_STATIONS = ['LOWW', 'LOWG', 'LOWI', 'LOWK', 'LOWL', 'LOWS']  # ICAO codes or prefixes, e.g. 'K' or 'ED'
+    MAX_STREAMS = 24  # Open event streams per worker, keep it below the threads of gunicorn.conf.py
+
+# Upper bound of stations per bulk weather request
+MAX_BULK_STATIONS = 1000
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Methods': 'GET',
+}
+# The weather of a station changes with every report, clients revalidate every time and mostly get a 304
+WEATHER_CACHE_CONTROL = 'public, no-cache'
+AIRPORTS_CACHE_CONTROL = 'public, max-age=3600'
+
+def trackedStations():
+    """Returns the ICAO codes of the stations selected by Config.TRACKED_STATIONS"""
+    return [station.icao for station in metar_stations.getRegistry().select(Config.TRACKED_STATIONS)]
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+@functools.cache
+def stationIndex():
+    """Returns the spatial index of the tracked stations, it is built on first use"""
+    # numpy is only loaded by workers which answer spatial queries
+    import metar_spatial
+    return metar_spatial.StationIndex(metar_stations.getRegistry().select(Config.TRACKED_STATIONS))
+
+def withWeather(stations, distances=None):
+    """Combines stations with their latest observation, resolved from the cache with at most one query"""
+    weather = dict(metar_cache.iterLatest([station.icao for station in stations], "metar"))
+    result = []
+    for index, station in enumerate(stations):
+        entry = station.to_dict()
+        if distances is not None:
+            entry["distance_km"] = round(distances[index], 1)
+        entry["weather"] = weather.get(station.icao)
+        result.append(entry)
+    return result
 
 def process(event):
     try:
         icao = event["icao"]
-        logger.info(f"Fetch METAR for airport: {icao}")
-        metar = mc.fetchMETAR(event["icao"])
-        logger.info(f"Process METAR: {metar}")
-        weather = mp.parseMETAR(metar)
-        logger.info(f"METAR transformed weather: {weather}")
-        return json.loads(json.dumps(weather, cls=DateTimeEncoder))
+        logger.debug("Fetch METAR for airport: %s", icao)
+        text = mc.fetchMETAR(event["icao"])
+        if text is None:
+            return None
+        # the response may hold several reports, the latest comes first
+        metar = next(mp.iterReports(text), None)
+        if metar is None:
+            return None
+        return processReport(icao, metar)
     except Exception as e:
         logger.error(f"Error processing METAR for airport: {icao}")
         logger.error(e)
         return None
 
-def processMetar():
-    metar = process({"icao": "LOWW"})
-    logger.info(metar)
-    if metar is not None:
-        tsr.writeMetarToInfluxDb2(metar, "metar")
+def processReport(icao, metar):
+    """Parses a single raw METAR unless it is unchanged, returns the JSON ready observation or None"""
+    # the report is remembered as seen by ingestMetars, once the observation is stored
+    if not mc.lastReports.changed(icao, metar):
+        logger.debug("METAR unchanged for airport: %s", icao)
+        return None
+    logger.debug("Process METAR: %s", metar)
+    start = time.perf_counter()
+    observation = mp.parseObservation(metar)
+    metar_metrics.PARSE_SECONDS.observe(time.perf_counter() - start)
+    logger.debug("METAR transformed weather: %s", observation)
+    if observation is None:
+        return None
+    import metar_history
+    metar_history.history.append(observation)
+    return observation.to_json()
 
-def scheduled_job():
-    processMetar()
+def processMetar(icaos):
+    """Ingests the stations with one bulk request per chunk of stations instead of one request per station"""
+    metars = []
+    reports = {}
+    for icao, report in mc.fetchMETARs(icaos).items():
+        try:
+            metar = processReport(icao, report)
+        except Exception as e:
+            logger.error(f"Error processing METAR for airport: {icao}")
+            logger.error(e)
+            continue
+        if metar is not None:
+            metars.append(metar)
+            reports[icao] = report
+    ingestMetars(metars, reports)
+
+def ingestMetars(metars, reports=None):
+    """Caches and publishes processed METARs and spools them for InfluxDB, then remembers their raw reports"""
+    for metar in metars:
+        metar_cache.storeMetar(metar)
+        metar_broker.publishMetar(metar)
+    # the spool takes the whole cycle in one append, its drainer writes to InfluxDB
+    metar_spool.spoolMetars(metars, "metar")
+    # reports maps each station to its raw METAR, if spooling failed they are processed again by the next cycle
+    for icao, report in (reports or {}).items():
+        mc.lastReports.remember(icao, report)
+
+def scheduled_job(icaos):
+    processMetar(icaos)
+
+def schedule_shards(job):
+    """Schedules job once per shard of the tracked stations, spread over every scheduler interval"""
+    import schedule
+    schedule.clear()
+    plan = metar_stations.shardSchedule(trackedStations(), Config.SCHEDULER_INTERVALS,
+                                        Config.SCHEDULER_SHARDS, Config.SCHEDULER_SHARD_SPACING)
+    for at, shard in plan:
+        scheduled = schedule.every().hour.at(at)
+        scheduled.do(run_lagged, scheduled, job, shard)
+    logger.info(f"Scheduled {len(plan)} shard jobs for intervals {Config.SCHEDULER_INTERVALS}")
+
+def run_lagged(scheduled, job, shard):
+    """Runs a scheduled job and records how late it started, next_run still holds the planned time"""
+    lag = max((datetime.now() - scheduled.next_run).total_seconds(), 0.0)
+    metar_metrics.SCHEDULER_LAG.observe(lag)
+    if lag > Config.SCHEDULER_MAX_LAG:
+        # earlier jobs ran long, catching up would only add load to a degraded upstream
+        metar_metrics.SKIPPED_JOBS.inc()
+        logger.warning(f"Skipping shard of {len(shard)} stations, it is {lag:.0f}s late")
+        return
+    job(shard)
 
 def run_scheduler():
     """Function to run the scheduler in a separate thread"""
     logger.info("Starting scheduler thread")
+    import schedule
+    schedule_shards(scheduled_job)
+
+    try:
+        while True:
+            schedule.run_pending()
+            time.sleep(1)
+    finally:
+        schedule.clear()
     
-    # Schedule jobs for :21 and :51 of every hour
-    schedule.every(1).minutes.do(scheduled_job)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-    
+def run_pipeline_scheduler():
+    """Alternative to run_scheduler which ingests the shards with the asyncio pipeline"""
+    logger.info("Starting pipeline scheduler thread")
+    import schedule
+    from metar_pipeline import IngestionPipeline
+    pipeline = IngestionPipeline()
+    schedule_shards(pipeline.run)
+
+    try:
+        while True:
+            schedule.run_pending()
+            time.sleep(1)
+    finally:
+        schedule.clear()
+        pipeline.close()
+
 # Graceful shutdown handling
 def shutdown_handler():
     logger.info("Shutting down application...")
-    # Add any cleanup code here
+    metar_spool.closeSpools()
+    tsr.closeRepository()
     
+def stationElevation(icao):
+    """Returns the elevation in feet of a station of the registry, or None"""
+    station = metar_stations.getRegistry().get(icao)
+    return station.elevation if station is not None else None
+
+@functools.cache
+def registerHistoryMetrics():
+    """Exposes the derived metrics of the history on /metrics, only the ingesting process fills the history"""
+    import metar_history
+    metar_metrics.registerHistory(metar_history.history, stationElevation)
+
 # Enhanced scheduler with error recovery
 def run_scheduler_with_recovery():
+    registerHistoryMetrics()
+    scheduler = run_pipeline_scheduler if Config.INGESTION_MODE == 'pipeline' else run_scheduler
     while True:
         try:
-            run_scheduler()
+            scheduler()
         except Exception as e:
             logger.error(f"Scheduler crashed: {e}")
             logger.info("Restarting scheduler in 60 seconds...")
             time.sleep(60)
 
+@functools.cache
+def airportsJson():
+    """Returns the encoded JSON and ETag of the tracked airports, the list only changes with the configuration"""
+    stations = metar_stations.getRegistry().select(Config.TRACKED_STATIONS)
+    return metar_cache.encodeJson([station.to_dict() for station in stations])
+
+def cachedJsonResponse(encoded, cache_control):
+    """
+    Serves pre-encoded JSON with a strong ETag, a matching If-None-Match is
+    answered with an empty 304 Not Modified.
+    """
+    body, etag = encoded
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers.update(CORS_HEADERS)
+    return response.make_conditional(request)
+
 @app.route('/v1/api/metar/airports', methods=['GET'])
 def fetchAirports():
-    response = make_response([
-        {
-            "icao": "LOWW",
-            "name": "Vienna"
-        }
-    ])
-
-    # Add CORS headers
+    return cachedJsonResponse(airportsJson(), AIRPORTS_CACHE_CONTROL)
+
+# search the station registry by ICAO code or name prefix
+@app.route('/v1/api/metar/airports/search', methods=['GET'])
+def searchAirports():
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    stations = metar_stations.getRegistry().search(request.args.get('q', ''), limit)
+    response = make_response(jsonify([station.to_dict() for station in stations]))
+
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
     response.headers.add('Access-Control-Allow-Methods', 'GET')
+    return response
+
+# nearest tracked airports to a position with their latest weather
+@app.route('/v1/api/metar/airports/nearest', methods=['GET'])
+def fetchNearestAirports():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    count = request.args.get('n', 10, type=int)
+    max_distance = request.args.get('max_km', type=float)
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        response = make_response(jsonify({"error": "lat and lon are required"}), 400)
+    elif not 0 < count <= 100:
+        response = make_response(jsonify({"error": "n must be between 1 and 100"}), 400)
+    elif max_distance is not None and not max_distance >= 0:
+        response = make_response(jsonify({"error": "max_km must not be negative"}), 400)
+    else:
+        nearest = stationIndex().nearest(latitude, longitude, count, max_distance)
+        response = make_response(jsonify(withWeather([station for station, _ in nearest],
+                                                     [distance for _, distance in nearest])))
 
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    response.headers.add('Access-Control-Allow-Methods', 'GET')
+    return response
+
+# tracked airports inside a bounding box with their latest weather
+@app.route('/v1/api/metar/airports/bbox', methods=['GET'])
+def fetchAirportsInBox():
+    bounds = [request.args.get(name, type=float) for name in ('south', 'west', 'north', 'east')]
+    if None in bounds:
+        response = make_response(jsonify({"error": "south, west, north and east are required"}), 400)
+    elif not (-90 <= bounds[0] <= 90 and -90 <= bounds[2] <= 90
+              and -180 <= bounds[1] <= 180 and -180 <= bounds[3] <= 180):
+        # also rejects nan, which fails every comparison
+        response = make_response(jsonify({"error": "latitudes must be within [-90, 90] and longitudes within [-180, 180]"}), 400)
+    else:
+        stations = stationIndex().within(*bounds)
+        if len(stations) > MAX_BULK_STATIONS:
+            response = make_response(jsonify({"error": f"More than {MAX_BULK_STATIONS} stations, use a smaller box"}), 400)
+        else:
+            response = make_response(jsonify(withWeather(stations)))
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    response.headers.add('Access-Control-Allow-Methods', 'GET')
     return response
 
 # serve a REST endpoint to provide the metar data for a airport from the influxdb
 @app.route('/v1/api/metar/airports/weather/<icao>', methods=['GET'])
 def fetchMetar(icao):
-    metar = tsr.fetchMetar(icao, "metar")
-    response = None
-    if metar is not None:
-        response = make_response(jsonify(metar))
-    else:
-        response = make_response(jsonify({"error": "METAR not found"}), 404)
-    
-    # Add CORS headers
+    encoded = metar_cache.fetchLatestEncoded(icao, "metar")
+    if encoded is not None:
+        return cachedJsonResponse(encoded, WEATHER_CACHE_CONTROL)
+
+    response = make_response(jsonify({"error": "METAR not found"}), 404)
+    response.headers.update(CORS_HEADERS)
+    return response
+
+# Every open event stream holds a worker thread, the slots leave threads for the REST requests
+_stream_slots = threading.BoundedSemaphore(Config.MAX_STREAMS)
+
+# push new observations to the browser as Server-Sent Events, served from memory without querying InfluxDB
+@app.route('/v1/api/metar/stream', methods=['GET'])
+def streamWeather():
+    icao_param = request.args.get('icao', '')
+    icaos = [icao.strip().upper() for icao in icao_param.split(',') if icao.strip()] or None
+    # isdigit() accepts digits like "²" which int() rejects, an invalid id starts a fresh stream
+    last_event_id = request.headers.get('Last-Event-ID') or ''
+    last_id = int(last_event_id) if re.fullmatch(r"[0-9]+", last_event_id) else None
+    if not _stream_slots.acquire(blocking=False):
+        response = make_response(jsonify({"error": "Too many open streams, retry later"}), 503)
+        response.headers['Retry-After'] = '30'
+        response.headers.update(CORS_HEADERS)
+        return response
+
+    def generate():
+        # send the cached state first, so a new client does not wait for the next report
+        if last_id is None:
+            for icao in icaos or []:
+                metar = metar_cache.latestObservations.get(icao)
+                if metar is not None:
+                    yield f"event: metar\ndata: {json.dumps({'icao': icao, **metar}, default=str)}\n\n"
+        yield from metar_broker.observations.events(icaos, last_id)
+
+    try:
+        response = Response(generate(), mimetype='text/event-stream')
+        # the server closes the response also when the client left before the first event
+        response.call_on_close(_stream_slots.release)
+    except BaseException:
+        # the slot is only released by closing the response, it was not built
+        _stream_slots.release()
+        raise
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+# serve the downsampled history of an airport as columnar arrays for trend charts
+@app.route('/v1/api/metar/airports/history/<icao>', methods=['GET'])
+def fetchHistory(icao):
+    fields = request.args.get('fields')
+    try:
+        history = tsr.fetchHistory(icao, "metar",
+                                   period=request.args.get('range', '24h'),
+                                   resolution=request.args.get('resolution', '1h'),
+                                   fields=fields.split(',') if fields else tsr.HISTORY_FIELDS,
+                                   fn=request.args.get('fn', 'mean'))
+        response = make_response(jsonify(history))
+    except ValueError as e:
+        response = make_response(jsonify({"error": str(e)}), 400)
+    except Exception as e:
+        logger.error(f"Error querying history of {icao}: {e}")
+        response = make_response(jsonify({"error": "History not available"}), 503)
+
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
     response.headers.add('Access-Control-Allow-Methods', 'GET')
+    return response
+
+# serve the latest weather of many airports in one request as newline delimited JSON
+@app.route('/v1/api/metar/weather', methods=['GET'])
+def fetchWeather():
+    icao_param = request.args.get('icao', '')
+    if icao_param:
+        icaos = [icao.strip().upper() for icao in icao_param.split(',') if icao.strip()]
+    else:
+        icaos = trackedStations()
+    invalid = [icao for icao in icaos if not tsr.ICAO_PATTERN.match(icao)]
+    if invalid:
+        return jsonify({"error": f"Invalid ICAO codes: {', '.join(invalid)}"}), 400
+    if len(icaos) > MAX_BULK_STATIONS:
+        return jsonify({"error": f"At most {MAX_BULK_STATIONS} stations per request"}), 400
+
+    def generate():
+        for icao, metar in metar_cache.iterLatest(icaos, "metar"):
+            if metar is None:
+                line = {"icao": icao, "error": "METAR not found"}
+            else:
+                line = {"icao": icao, **metar}
+            yield json.dumps(line, default=str) + "\n"
 
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    response.headers.add('Access-Control-Allow-Methods', 'GET')
     return response
-    
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this process"""
+    body, content_type = metar_metrics.exposition()
+    return Response(body, content_type=content_type)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -117,6 +411,10 @@ def health_check():
         'status': 'healthy',
         'scheduler_running': any(thread.name == 'scheduler' 
                                for thread in threading.enumerate()),
+        'cache': metar_cache.latestObservations.stats(),
+        'parse_memo': mp.parseMemo.stats(),
+        'upstreams': mc.upstreamStatus(),
+        'stream_subscribers': metar_broker.observations.subscribers,
         'timestamp': datetime.now().isoformat()
     })
 
@@ -131,8 +429,56 @@ def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 # Enhanced Flask startup
-def start_flask_with_config():
+def run_refresher():
+    """
+    Keeps the cache and the push stream of an API only process current.
+
+    The ingestion runs in its own process, so the API workers poll the latest
+    observations of all tracked stations with one grouped query and publish
+    the changed ones to their local subscribers.
+    """
+    logger.info("Starting refresher thread")
+    latest = {}
+    while True:
+        time.sleep(Config.REFRESH_INTERVAL)
+        try:
+            observations = tsr.fetchLatestMetars(trackedStations(), "metar")
+        except Exception as e:
+            logger.error(f"Error refreshing latest observations: {e}")
+            continue
+        for icao, observation in observations.items():
+            if latest.get(icao) != observation:
+                latest[icao] = observation
+                metar_cache.latestObservations.put(icao, observation)
+                metar_broker.observations.publish(icao, observation)
+
+_background_thread = None
+
+def create_app(ingestion=False):
+    """
+    Application factory for WSGI servers, e.g. gunicorn -c gunicorn.conf.py.
+
+    Every API worker calls the factory. Without ingestion the worker only
+    starts the refresher thread, the scheduler runs once in the separate
+    ingestion process (python ingest.py).
+
+    Args:
+        ingestion: Run the scheduler in this process, used by the development server.
+
+    Returns:
+        The configured Flask app.
+    """
+    global _background_thread
     app.config.from_object(Config)
+    if _background_thread is None:
+        if ingestion:
+            _background_thread = threading.Thread(target=run_scheduler_with_recovery, name='scheduler', daemon=True)
+        else:
+            _background_thread = threading.Thread(target=run_refresher, name='refresher', daemon=True)
+        _background_thread.start()
+    return app
+
+def start_flask_with_config():
     app.run(
         host=app.config['FLASK_HOST'],
         port=app.config['FLASK_PORT'],
@@ -141,16 +487,11 @@ def start_flask_with_config():
 
 if __name__ == '__main__':
     try:
-        # Create and start the scheduler thread
-        scheduler_thread = threading.Thread(target=run_scheduler_with_recovery)
-        scheduler_thread.daemon = True  # This ensures the thread will shut down when the main program exits
-        scheduler_thread.start()
-        
-        # Start Flask in the main thread
+        # Development mode: the scheduler runs in a thread of the single server process
+        create_app(ingestion=True)
         start_flask_with_config()
         
     except KeyboardInterrupt:
-        logger.info("Shutting down application...")
+        shutdown_handler()
     except Exception as e:
         logger.error(f"Application error: {e}")
-
@@ -0,0 +1,87 @@
+"""
+Load benchmark of the REST API.
+
+Sends requests from many threads to a running API and reports the
+throughput and latency percentiles. Start the API first, e.g.:
+
+    gunicorn -c gunicorn.conf.py
+    python bench_api.py --url http://127.0.0.1:5000/v1/api/metar/airports/weather/LOWW
+    python bench_api.py --url "http://127.0.0.1:5000/v1/api/metar/weather?icao=LOWW,LOWG" -c 64 -n 20000
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+import requests
+
+def runLoad(url, concurrency, total, timeout=10.0):
+    """
+    Requests an URL total times with concurrency keep-alive sessions.
+
+    Args:
+        url: The URL to request.
+        concurrency: The number of concurrent clients.
+        total: The total number of requests.
+        timeout: Seconds after which a request counts as error.
+
+    Returns:
+        A dictionary with requests, errors, seconds, requests_per_second
+        and the p50, p95 and p99 latency in milliseconds.
+    """
+    latencies = []
+    errors = [0]
+    remaining = [total]
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                response = session.get(url, timeout=timeout)
+                response.content
+                failed = response.status_code >= 500
+            except requests.exceptions.RequestException:
+                failed = True
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                errors[0] += failed
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(seconds, 2),
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        "p50_ms": round(quantiles[49] * 1000, 2),
+        "p95_ms": round(quantiles[94] * 1000, 2),
+        "p99_ms": round(quantiles[98] * 1000, 2),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load benchmark of the METAR API.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/v1/api/metar/airports/weather/LOWW")
+    parser.add_argument("--concurrency", "-c", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--requests", "-n", type=int, default=5000, help="total requests")
+    args = parser.parse_args(argv)
+
+    result = runLoad(args.url, args.concurrency, args.requests)
+    print(" ".join(f"{key}={value}" for key, value in result.items()))
+    return 1 if result["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Benchmark of the parser, the ingestion path and the InfluxDB write path.
+
+Times parseMETAR per category of bench_corpus.txt without the parse memo,
+parseObservation through a memo, the parser of every token group on the
+tokens of the corpus, app.process end to end against a local upstream stub
+and MetarRepository.write_many against a local InfluxDB stub. Every benchmark
+reports operations per second and the memory allocated by tracemalloc. A
+saved result can be compared with a later run to catch regressions in the
+hot path.
+
+Usage:
+    python bench_metar.py
+    python bench_metar.py --save baseline.json
+    python bench_metar.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_corpus.txt")
+
+def loadCorpus(path=CORPUS_FILE):
+    """
+    Reads the benchmark corpus.
+
+    Args:
+        path: The path of the corpus file.
+
+    Returns:
+        A dictionary mapping each category to its list of METARs.
+    """
+    corpus = {}
+    category = None
+    with open(path, encoding="ascii") as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith("# ") and len(line.split()) == 2:
+                category = line[2:]
+                corpus[category] = []
+            elif line and not line.startswith("#"):
+                corpus[category].append(line)
+    return corpus
+
+def measure(function, items, min_seconds=0.5):
+    """
+    Calls function with every item in rounds until min_seconds have passed.
+
+    Args:
+        function: Callable taking one item.
+        items: The items of one round.
+        min_seconds: The minimum duration of the timed runs.
+
+    Returns:
+        A dictionary with ops_per_second, us_per_op, the peak KiB allocated
+        during one round and the bytes still allocated per operation after it.
+    """
+    for item in items:
+        function(item)
+
+    operations = 0
+    start = time.perf_counter()
+    while True:
+        for item in items:
+            function(item)
+        operations += len(items)
+        seconds = time.perf_counter() - start
+        if seconds >= min_seconds:
+            break
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    kept = [function(item) for item in items]
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+
+    return {
+        "ops_per_second": round(operations / seconds),
+        "us_per_op": round(seconds / operations * 1e6, 2),
+        "peak_kib": round((peak - before) / 1024, 1),
+        "bytes_per_op": round((after - before) / len(items)),
+    }
+
+class _UpstreamStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, Nagle would delay every response by the delayed ACK
+    disable_nagle_algorithm = True
+    metars = {}
+
+    def do_GET(self):
+        icao = parse_qs(urlparse(self.path).query)["ids"][0]
+        body = self.metars.get(icao, "").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _InfluxStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def _serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def benchParser(corpus, min_seconds):
+    import metar_parser as mp
+    # every round repeats the same reports, through the memo parse.* would only time its lookups
+    parse = partial(mp.parseMETAR, memo=None)
+    results = {}
+    for category, metars in corpus.items():
+        results[f"parse.{category}"] = measure(parse, metars, min_seconds)
+    everything = [metar for metars in corpus.values() for metar in metars]
+    results["parse.all"] = measure(parse, everything, min_seconds)
+    results["parse_observation.all"] = measure(partial(mp.parseObservation, memo=None), everything, min_seconds)
+    memo = mp.ParseMemo()
+    results["parse_memo.all"] = measure(partial(mp.parseObservation, memo=memo), everything, min_seconds)
+    return results
+
+def tokenParsers():
+    """
+    The parsers of the token groups. The parser remembers tokens in its
+    TokenTables, the parse functions behind them are timed uncached.
+
+    Returns:
+        A dictionary mapping each group to a callable returning the value of a token or None.
+    """
+    import metar_parser as mp
+    reference = datetime.now(timezone.utc)
+    return {
+        "time": lambda token: mp.parseTime(token, reference) if mp.TIME_PATTERN.match(token) else None,
+        "wind": mp.WIND_TOKENS.parse,
+        "wind_variation": mp.WIND_VARIATION_TOKENS.parse,
+        "visibility": mp.VISIBILITY_TOKENS.parse,
+        "rvr": mp.RVR_TOKENS.parse,
+        "weather": mp.WEATHER_TOKENS.parse,
+        "clouds": mp.CLOUD_TOKENS.parse,
+        "temperature": mp.TEMPERATURE_TOKENS.parse,
+        "qnh": mp.QNH_TOKENS.parse,
+    }
+
+def benchTokens(corpus, min_seconds):
+    tokens = {token for category, metars in corpus.items() if category != "malformed"
+              for metar in metars for token in metar.split()}
+    results = {}
+    for group, parse in tokenParsers().items():
+        # every group is timed on the tokens of the corpus which belong to it
+        matching = sorted(token for token in tokens if parse(token) is not None)
+        results[f"token.{group}"] = measure(parse, matching, min_seconds)
+    return results
+
+def benchProcess(corpus, min_seconds):
+    import app
+    import metar_crawler as mc
+    metars = {}
+    for category, lines in corpus.items():
+        if category != "malformed":
+            for line in lines:
+                metars[f"B{len(metars):03d}"] = line.replace(line.split()[0], f"B{len(metars):03d}", 1)
+    _UpstreamStub.metars = metars
+    server = _serve(_UpstreamStub)
+    url, rate = mc.METAR_URL, mc.UPSTREAM_RATE
+    mc.METAR_URL = f"http://127.0.0.1:{server.server_port}/api/data/metar"
+    # the stub is not rate limited, the benchmark measures our side only
+    mc.UPSTREAM_RATE = 1e9
+
+    try:
+        # process does not remember the reports as seen, that is left to ingestMetars, so no repetition is skipped
+        return {"process.end_to_end": measure(lambda icao: app.process({"icao": icao}), list(metars), min_seconds)}
+    finally:
+        mc.METAR_URL, mc.UPSTREAM_RATE = url, rate
+        server.shutdown()
+        server.server_close()
+
+def benchWrite(corpus, min_seconds):
+    import metar_parser as mp
+    import TimeSeriesRepository as tsr
+    from influxdb_client import InfluxDBClient
+    parsed = [mp.parseMETAR(metar) for metars in corpus.values() for metar in metars]
+    parsed = [metar for metar in parsed if metar is not None and metar["time"] is not None]
+    server = _serve(_InfluxStub)
+    client = InfluxDBClient(url=f"http://127.0.0.1:{server.server_port}", token="token", org="org")
+    repository = tsr.MetarRepository(client, batch_size=500, flush_interval=1000)
+    # every batch gets new observation times, so no point is dropped as duplicate
+    batches = [[dict(metar, time=metar["time"] + timedelta(minutes=30 * round_)) for metar in parsed]
+               for round_ in range(200)]
+    rounds = itertools.count()
+    try:
+        result = measure(lambda _: repository.write_many(batches[next(rounds) % len(batches)]),
+                         [None] * 10, min_seconds)
+        repository.flush()
+    finally:
+        repository.close()
+        server.shutdown()
+        server.server_close()
+    # one operation is a batch, report points
+    points = len(parsed)
+    return {"write.points": {
+        "ops_per_second": result["ops_per_second"] * points,
+        "us_per_op": round(result["us_per_op"] / points, 2),
+        "peak_kib": result["peak_kib"],
+        "bytes_per_op": round(result["bytes_per_op"] / points),
+    }}
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a baseline.
+
+    Args:
+        results: The results of this run.
+        baseline: The results of an earlier run.
+        tolerance: The allowed relative loss of ops_per_second (e.g., 0.2 for 20%).
+
+    Returns:
+        A list of messages of the benchmarks which regressed.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]["ops_per_second"]
+        if result["ops_per_second"] < expected * (1 - tolerance):
+            regressions.append(f"{name}: {result['ops_per_second']} ops/s, baseline {expected} ops/s")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the METAR parser, ingestion and write path.")
+    parser.add_argument("--only", choices=("parse", "token", "process", "write"), help="run a single group")
+    parser.add_argument("--seconds", type=float, default=0.5, help="minimum duration of every benchmark")
+    parser.add_argument("--save", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    # the parser logs every malformed report, which would dominate the timings
+    logging.disable(logging.CRITICAL)
+    corpus = loadCorpus()
+    groups = {"parse": benchParser, "token": benchTokens, "process": benchProcess, "write": benchWrite}
+    results = {}
+    for name, bench in groups.items():
+        if args.only in (None, name):
+            results.update(bench(corpus, args.seconds))
+
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':<{width}}  {'ops/s':>10}  {'us/op':>9}  {'peak KiB':>9}  {'B/op':>7}")
+    for name, result in results.items():
+        print(f"{name:<{width}}  {result['ops_per_second']:>10}  {result['us_per_op']:>9}  "
+              f"{result['peak_kib']:>9}  {result['bytes_per_op']:>7}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
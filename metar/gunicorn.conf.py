@@ -0,0 +1,34 @@
+# Production settings of the API, start with: gunicorn -c gunicorn.conf.py
+# The ingestion is not part of the API workers, run python ingest.py once next to it.
+import multiprocessing
+import os
+
+wsgi_app = "wsgi:application"
+bind = os.environ.get("METAR_BIND", "0.0.0.0:5000")
+
+# every worker is a process with its own cache, threads serve the requests of a worker
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+# An open event stream occupies a thread for the lifetime of the connection. A
+# worker accepts at most Config.MAX_STREAMS streams (24) and answers further
+# ones with 503, so the remaining threads keep serving the REST API. For many
+# stream clients run a second instance only for /v1/api/metar/stream behind
+# the proxy, with more threads and MAX_STREAMS raised to match.
+threads = int(os.environ.get("METAR_THREADS", 32))
+
+# create the app in every worker after the fork, so the background threads run in the workers
+preload_app = False
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = os.environ.get("METAR_ACCESS_LOG")
+errorlog = "-"
+
+def child_exit(server, worker):
+    # drop the metric files of a stopped worker when metrics are aggregated over PROMETHEUS_MULTIPROC_DIR
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
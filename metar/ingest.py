@@ -0,0 +1,62 @@
+"""
+Standalone ingestion process.
+
+Runs the scheduler which fetches, parses and writes the METARs of the tracked
+stations. The API is served separately by any number of WSGI workers, see
+gunicorn.conf.py. A lock file makes sure only one ingestion process runs on
+a host. The metrics of the process are served on Config.INGESTION_METRICS_PORT.
+
+Usage:
+    python ingest.py
+"""
+import fcntl
+import logging
+import signal
+import sys
+from prometheus_client import start_http_server
+import app as metar_app
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def acquireLock(path):
+    """
+    Takes an exclusive lock on a file, it is released when the process exits.
+
+    Args:
+        path: The path of the lock file.
+
+    Returns:
+        The open lock file, or None if another process holds the lock.
+    """
+    lock_file = open(path, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+def main():
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    lock_file = acquireLock(metar_app.Config.INGESTION_LOCK_FILE)
+    if lock_file is None:
+        logger.error(f"Another ingestion process holds {metar_app.Config.INGESTION_LOCK_FILE}")
+        return 1
+    signal.signal(signal.SIGTERM, _terminate)
+    # the API workers do not see the ingestion metrics, so this process serves its own
+    start_http_server(metar_app.Config.INGESTION_METRICS_PORT)
+    try:
+        metar_app.run_scheduler_with_recovery()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metar_app.shutdown_handler()
+        lock_file.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Bulk parser for historic METAR archives.
+
+Streams a plain or gzip compressed text file with one METAR per line, parses
+it on a process pool and writes the result as newline delimited JSON or to
+InfluxDB. Date header lines like "2023/10/19 18:20", as in the NOAA files,
+are the reference time of the reports which follow them.
+
+Usage:
+    python -m metar_archive metars-2023.txt.gz --output metars-2023.ndjson
+    python -m metar_archive metars-2023.txt.gz --influx --bucket metar
+    python -m metar_archive metars-2023-06.txt.gz --reference 2023-06-30T23:59:59Z
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from itertools import islice
+import metar_parser as mp
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_CHUNK_SIZE = 5000
+HEADER_PATTERN = re.compile(r"(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2})$")
+
+class ArchiveStats:
+    """
+    Throughput and failure counters of an archive run.
+    """
+    def __init__(self):
+        self.lines = 0
+        self.parsed = 0
+        self.failures = 0
+        self.start = time.monotonic()
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.start
+
+    def __repr__(self):
+        seconds = self.seconds
+        rate = self.lines / seconds if seconds else 0.0
+        return (f"ArchiveStats(lines={self.lines}, parsed={self.parsed}, failures={self.failures}, "
+                f"seconds={seconds:.1f}, lines_per_second={rate:.0f})")
+
+def openArchive(path):
+    """
+    Opens an archive for reading, files ending with .gz are decompressed on the fly.
+
+    Args:
+        path: The path of the archive, "-" reads stdin.
+
+    Returns:
+        A text file object.
+    """
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="ascii", errors="replace")
+    return open(path, "r", encoding="ascii", errors="replace")
+
+def readChunks(lines, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Groups the non empty lines of a file into lists of chunk_size lines.
+
+    Args:
+        lines: An iterable of lines.
+        chunk_size: The number of lines per chunk.
+
+    Yields:
+        Lists of stripped lines.
+    """
+    lines = (line.strip() for line in lines)
+    lines = (line for line in lines if line)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def headerTime(line):
+    """
+    Parses a date header line of a NOAA archive.
+
+    Args:
+        line: A stripped line (e.g., "2023/10/19 18:20").
+
+    Returns:
+        The UTC time of the header, or None if the line is no header.
+    """
+    # reports start with a letter, only lines starting with a digit are worth matching
+    if not line[:1].isdigit():
+        return None
+    match = HEADER_PATTERN.match(line)
+    if match is None:
+        return None
+    try:
+        return datetime(*map(int, match.groups()), tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def lastHeaderTime(lines, default=None):
+    """
+    Finds the time of the last header line of a chunk.
+
+    Args:
+        lines: A list of stripped lines.
+        default: Returned if the chunk has no header line.
+
+    Returns:
+        The time of the last header line or default.
+    """
+    for line in reversed(lines):
+        header = headerTime(line)
+        if header is not None:
+            return header
+    return default
+
+def parseChunk(lines, as_json=True, reference=None):
+    """
+    Parses a chunk of METAR lines, runs in a worker process.
+
+    Header lines are no failures, each is the reference of the reports
+    following it.
+
+    Args:
+        lines: A list of raw METAR lines.
+        as_json: Return the parsed METARs encoded as JSON lines instead of dictionaries.
+        reference: The time the day of month of the reports before the first header line is resolved against,
+            defaults to now.
+
+    Returns:
+        A tuple of the list of parsed METARs and the number of lines which failed to parse.
+    """
+    parsed = []
+    failures = 0
+    for line in lines:
+        header = headerTime(line)
+        if header is not None:
+            reference = header
+            continue
+        observation = mp.parseObservation(line, reference)
+        if observation is None:
+            failures += 1
+        elif as_json:
+            parsed.append(json.dumps(observation.to_json()))
+        else:
+            parsed.append(observation.to_dict())
+    return parsed, failures
+
+def _initWorker():
+    # failures are counted, logging every single one would flood stderr
+    logging.disable(logging.WARNING)
+
+def parseArchive(lines, sink, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, as_json=True, progress_interval=30,
+                 reference=None):
+    """
+    Parses all lines on a process pool and hands the results to a sink in input order.
+
+    At most two chunks per worker are in flight, so the memory use does not
+    depend on the size of the input. The last header line of a chunk is the
+    reference of the reports at the start of the next chunk.
+
+    Args:
+        lines: An iterable of raw METAR lines.
+        sink: Callable receiving the list of parsed METARs of every chunk.
+        workers: The number of worker processes, defaults to the number of CPUs.
+        chunk_size: The number of lines per work unit.
+        as_json: Hand JSON lines instead of dictionaries to the sink.
+        progress_interval: Seconds between two progress log lines.
+        reference: The time the day of month of the reports before the first header line is resolved against,
+            defaults to now.
+
+    Returns:
+        The ArchiveStats of the run.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = 2 * workers
+    stats = ArchiveStats()
+    last_progress = stats.start
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker) as executor:
+        in_flight = []
+        chunks = readChunks(lines, chunk_size)
+        while True:
+            for chunk in islice(chunks, max_in_flight - len(in_flight)):
+                stats.lines += len(chunk)
+                in_flight.append(executor.submit(parseChunk, chunk, as_json, reference))
+                reference = lastHeaderTime(chunk, reference)
+            if not in_flight:
+                break
+            parsed, failures = in_flight.pop(0).result()
+            stats.parsed += len(parsed)
+            stats.failures += failures
+            sink(parsed)
+            if time.monotonic() - last_progress >= progress_interval:
+                last_progress = time.monotonic()
+                logger.info(f"Archive progress: {stats}")
+    logger.info(f"Archive finished: {stats}")
+    return stats
+
+def parseReference(value):
+    """
+    Parses the --reference argument, times without zone are UTC.
+
+    Args:
+        value: An ISO 8601 time (e.g., "2023-06-30T23:59:59Z").
+
+    Returns:
+        An aware datetime.
+    """
+    reference = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if reference.tzinfo is None:
+        reference = reference.replace(tzinfo=timezone.utc)
+    return reference
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m metar_archive",
+                                     description="Parse a METAR archive with one report per line.")
+    parser.add_argument("archive", help="plain or .gz text file, - for stdin")
+    parser.add_argument("--output", "-o", default="-", help="newline delimited JSON output, - for stdout")
+    parser.add_argument("--influx", action="store_true", help="write to InfluxDB instead of JSON")
+    parser.add_argument("--bucket", default="metar", help="InfluxDB bucket")
+    parser.add_argument("--workers", "-w", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="lines per work unit")
+    parser.add_argument("--reference", type=parseReference, default=None,
+                        help="ISO 8601 time the archive ends, reports before the first header line "
+                             "are resolved to the month before it")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+
+    with openArchive(args.archive) as lines:
+        if args.influx:
+            import TimeSeriesRepository as tsr
+            repository = tsr.getRepository()
+            try:
+                # write_many blocks while the buffer of the repository is full, that holds back the parsing
+                stats = parseArchive(lines, partial(repository.write_many, bucket=args.bucket),
+                                     args.workers, args.chunk_size, as_json=False, reference=args.reference)
+            finally:
+                tsr.closeRepository()
+        else:
+            output = sys.stdout if args.output == "-" else open(args.output, "w")
+            try:
+                stats = parseArchive(lines, lambda parsed: output.writelines(line + "\n" for line in parsed),
+                                     args.workers, args.chunk_size, reference=args.reference)
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+    return 0 if stats.parsed or not stats.lines else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
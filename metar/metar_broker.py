@@ -0,0 +1,114 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from itertools import islice
+import TimeSeriesRepository as tsr
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+class ObservationBroker:
+    """
+    In-process fan-out of new observations to push subscribers.
+
+    Every published observation is serialized once into a Server-Sent Event
+    and appended to a bounded log. Subscribers only remember the id of the
+    last event they have sent and wait on one shared condition, so an idle
+    subscriber costs a generator frame and no queue of its own. A subscriber
+    which falls behind by more than the log size skips the lost events.
+    """
+
+    def __init__(self, history=256):
+        """
+        Args:
+            history: The number of recent events kept for slow and reconnecting subscribers.
+        """
+        self.subscribers = 0
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        self._condition = threading.Condition()
+
+    @property
+    def last_id(self):
+        """The id of the most recently published event, 0 if nothing was published."""
+        return self._last_id
+
+    def publish(self, icao, observation):
+        """
+        Publishes an observation to all subscribers of the station.
+
+        Args:
+            icao: The ICAO airport code.
+            observation: The JSON serializable observation dictionary.
+
+        Returns:
+            The id of the event.
+        """
+        icao = icao.upper()
+        data = json.dumps({"icao": icao, **observation}, default=str)
+        with self._condition:
+            self._last_id += 1
+            event = f"id: {self._last_id}\nevent: metar\ndata: {data}\n\n"
+            self._events.append((self._last_id, icao, event))
+            self._condition.notify_all()
+            return self._last_id
+
+    def events(self, icaos=None, last_id=None, keepalive=15.0):
+        """
+        Yields the Server-Sent Events of new observations, runs until the consumer closes it.
+
+        Args:
+            icaos: The ICAO airport codes to receive, None receives all stations.
+            last_id: Resume after this event id, e.g. from the Last-Event-ID header.
+                None starts with the next published event.
+            keepalive: Seconds after which a comment is sent to keep idle connections open.
+
+        Yields:
+            Server-Sent Event strings.
+        """
+        icaos = frozenset(icao.upper() for icao in icaos) if icaos else None
+        with self._condition:
+            self.subscribers += 1
+            if last_id is None:
+                last_id = self._last_id
+        last_sent = time.monotonic()
+        try:
+            while True:
+                with self._condition:
+                    if self._last_id == last_id:
+                        self._condition.wait(keepalive)
+                    # event ids are consecutive, so the new events are the tail of the log
+                    missed = min(self._last_id - last_id, len(self._events))
+                    pending = list(islice(self._events, len(self._events) - missed, None))
+                    last_id = self._last_id
+                for _, icao, event in pending:
+                    if icaos is None or icao in icaos:
+                        last_sent = time.monotonic()
+                        yield event
+                if time.monotonic() - last_sent >= keepalive:
+                    last_sent = time.monotonic()
+                    yield ": keepalive\n\n"
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+observations = ObservationBroker()
+
+def publishMetar(metar, broker=observations):
+    """
+    Publishes a freshly parsed METAR in the shape of the weather endpoint.
+
+    Args:
+        metar: The parsed METAR dictionary.
+        broker: The broker to publish to.
+    """
+    try:
+        observation = tsr.metarToFields(metar)
+        observed = metar.get("time")
+        if observed is not None:
+            observation["time"] = observed.isoformat() if hasattr(observed, "isoformat") else observed
+        broker.publish(metar["station"], observation)
+    except Exception as e:
+        logger.error(f"Error publishing METAR: {e}")
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+import TimeSeriesRepository as tsr
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used without it
+    orjson = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+class LatestObservationCache:
+    """
+    Process local cache of the latest observation per station.
+
+    Entries expire after ttl seconds and the least recently used entry is
+    evicted once the cache holds maxsize stations. Every entry also keeps the
+    encoded JSON of its observation once it was requested, so a new
+    observation of the station replaces both. All methods are thread safe.
+    """
+
+    def __init__(self, maxsize=4096, ttl=1800, clock=time.monotonic):
+        """
+        Args:
+            maxsize: The maximum number of cached stations.
+            ttl: Seconds an entry stays valid.
+            clock: Returns the current time in seconds, replaceable for tests.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, icao):
+        """
+        Returns the cached observation of a station.
+
+        Args:
+            icao: The ICAO airport code.
+
+        Returns:
+            The observation, or None if it is not cached or expired.
+        """
+        with self._lock:
+            entry = self._lookup(icao.upper())
+            return None if entry is None else entry[1]
+
+    def getEncoded(self, icao):
+        """
+        Returns the encoded JSON of the cached observation of a station, it is
+        encoded once per observation.
+
+        Args:
+            icao: The ICAO airport code.
+
+        Returns:
+            A tuple of the JSON bytes and their ETag, or None if the station is not cached or expired.
+        """
+        with self._lock:
+            entry = self._lookup(icao.upper())
+            if entry is None:
+                return None
+            if entry[2] is None:
+                entry[2] = encodeJson(entry[1])
+            return entry[2]
+
+    def _lookup(self, icao):
+        entry = self._entries.get(icao)
+        if entry is not None:
+            if entry[0] > self.clock():
+                self._entries.move_to_end(icao)
+                self.hits += 1
+                return entry
+            del self._entries[icao]
+        self.misses += 1
+        return None
+
+    def put(self, icao, observation, encoded=None):
+        """
+        Stores the latest observation of a station.
+
+        Args:
+            icao: The ICAO airport code.
+            observation: The observation to cache.
+            encoded: The result of encodeJson of the observation if it is already encoded, or None.
+        """
+        icao = icao.upper()
+        with self._lock:
+            self._entries[icao] = [self.clock() + self.ttl, observation, encoded]
+            self._entries.move_to_end(icao)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, icao=None):
+        """
+        Removes a station, or all stations if no ICAO code is given.
+
+        Args:
+            icao: The ICAO airport code or None.
+        """
+        with self._lock:
+            if icao is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(icao.upper(), None)
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            A dictionary with size, hits, misses, evictions and the hit ratio.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+latestObservations = LatestObservationCache()
+
+def encodeJson(value):
+    """
+    Encodes a value as compact JSON, with orjson if it is installed.
+
+    Args:
+        value: A JSON serializable value, datetimes are encoded as strings.
+
+    Returns:
+        A tuple of the UTF-8 bytes and their strong ETag, a hash of the bytes.
+    """
+    if orjson is not None:
+        body = orjson.dumps(value, default=str)
+    else:
+        body = json.dumps(value, separators=(",", ":"), default=str).encode()
+    return body, hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def storeMetar(metar, cache=latestObservations):
+    """
+    Writes a freshly parsed METAR through to the cache.
+
+    The METAR is stored in the same shape as tsr.fetchMetar returns it, so
+    cached and queried observations are interchangeable.
+
+    Args:
+        metar: The parsed METAR dictionary.
+        cache: The cache to store the METAR in.
+    """
+    try:
+        cache.put(metar["station"], tsr.metarToFields(metar))
+    except Exception as e:
+        logger.error(f"Error caching METAR: {e}")
+
+def fetchLatest(icao, bucket, cache=latestObservations):
+    """
+    Returns the latest observation of a station, InfluxDB is only queried on a miss.
+
+    Args:
+        icao: The ICAO airport code.
+        bucket: The InfluxDB bucket.
+        cache: The cache to look up.
+
+    Returns:
+        The observation dictionary, or None if the station has no observation.
+    """
+    observation = cache.get(icao)
+    if observation is None:
+        observation = tsr.fetchMetar(icao, bucket)
+        if observation:
+            cache.put(icao, observation)
+    return observation
+
+def fetchLatestEncoded(icao, bucket, cache=latestObservations):
+    """
+    Returns the encoded JSON of the latest observation of a station, see fetchLatest.
+
+    Args:
+        icao: The ICAO airport code.
+        bucket: The InfluxDB bucket.
+        cache: The cache to look up.
+
+    Returns:
+        A tuple of the JSON bytes and their ETag, or None if the station has no observation.
+    """
+    encoded = cache.getEncoded(icao)
+    if encoded is None:
+        observation = tsr.fetchMetar(icao, bucket)
+        if observation:
+            encoded = encodeJson(observation)
+            cache.put(icao, observation, encoded)
+    return encoded
+
+def iterLatest(icaos, bucket, cache=latestObservations):
+    """
+    Yields the latest observations of many stations.
+
+    Cached stations are yielded right away, all misses are resolved with one
+    InfluxDB query afterwards. The order of the stations is therefore not
+    preserved.
+
+    Args:
+        icaos: An iterable of ICAO airport codes.
+        bucket: The InfluxDB bucket.
+        cache: The cache to look up.
+
+    Yields:
+        Tuples of the upper case ICAO code and the observation dictionary,
+        which is None if the station has no observation.
+    """
+    misses = []
+    for icao in dict.fromkeys(icao.upper() for icao in icaos):
+        observation = cache.get(icao)
+        if observation is None:
+            misses.append(icao)
+        else:
+            yield icao, observation
+    if not misses:
+        return
+    try:
+        observations = tsr.fetchLatestMetars(misses, bucket)
+    except Exception as e:
+        logger.error(f"Error querying InfluxDB: {e}")
+        observations = {}
+    for icao in misses:
+        observation = observations.get(icao)
+        if observation:
+            cache.put(icao, observation)
+        yield icao, observation or None
@@ -1,25 +1,571 @@
-import requests
 import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import metar_parser as mp
+from metar_metrics import FETCH_SECONDS, FETCH_RESPONSES, FETCH_RETRIES
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def fetchMETAR(icao):
+# METAR_UPSTREAM_URL points the crawler at another upstream, e.g. the stub of metar_replay.py
+METAR_URL = os.environ.get("METAR_UPSTREAM_URL", "https://aviationweather.gov/api/data/metar")
+
+# Keep the query string well below the common 2k URL limit of proxies and servers
+MAX_IDS_PER_REQUEST = 200
+MAX_IDS_LENGTH = 1500
+
+# A request may wait this long for the connection and for every read, a
+# request without timeout can block a scheduler thread forever
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10.0
+# Retries of failed requests, the delay doubles up to BACKOFF_MAX seconds
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+# Upper bound of a call of conditionalGet including retries and waiting for the rate limit
+FETCH_DEADLINE = 30.0
+# Responses which are retried, 429 and 503 also slow down the rate limit
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+THROTTLE_STATUSES = frozenset((429, 503))
+# Requests per second to one upstream while it is healthy. A bulk request
+# carries up to MAX_IDS_PER_REQUEST stations, so the burst alone covers a
+# cycle of UPSTREAM_BURST * MAX_IDS_PER_REQUEST stations.
+UPSTREAM_RATE = 10.0
+UPSTREAM_BURST = 20
+# Consecutive failures which open the circuit, and seconds until it is tried again
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+
+_session = None
+
+# ETag, Last-Modified and body of the last successful response per ids parameter
+_validators = {}
+_validators_lock = threading.Lock()
+
+class UpstreamUnavailable(IOError):
+    """
+    Raised without a request when the circuit of the upstream is open or its rate limit is exhausted.
+
+    Like requests.exceptions.RequestException it is an IOError, so callers can
+    handle both without importing requests.
+    """
+
+class RateLimited(UpstreamUnavailable):
+    """
+    Raised without a request when the rate limit of the upstream has no token before the deadline.
+
+    The upstream is not at fault, the stations are fetched again by the next
+    cycle.
+    """
+
+class CircuitBreaker:
+    """
+    Stops requests to an upstream which keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and every
+    request fails immediately. After reset_timeout seconds a single probe is
+    let through, its success closes the circuit and its failure opens it
+    again. All methods are thread safe.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        """
+        Args:
+            failure_threshold: Consecutive failures which open the circuit.
+            reset_timeout: Seconds the circuit stays open before a probe.
+            clock: Returns the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns:
+            True if a request may be sent now, otherwise False.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def release(self):
+        """Gives back a probe which was allowed but not sent."""
+        with self._lock:
+            self._probing = False
+
+    def recordSuccess(self):
+        """Records a request which reached the upstream, it closes the circuit."""
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Upstream recovered, closing circuit")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def recordFailure(self):
+        """Records a failed request, it opens the circuit after too many failures or a failed probe."""
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Upstream failed {self.failures} times, opening circuit for {self.reset_timeout}s")
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+class TokenBucket:
+    """
+    Rate limiter which adapts to the upstream.
+
+    Every request takes a token, tokens are refilled at rate per second up
+    to burst. When the upstream answers 429 or 503 the rate is halved and a
+    Retry-After pauses all requests, every success raises the rate again by
+    a tenth of the configured rate. All methods are thread safe.
+    """
+
+    def __init__(self, rate=UPSTREAM_RATE, burst=UPSTREAM_BURST, min_rate=0.1, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            rate: Requests per second while the upstream is healthy.
+            burst: The maximum number of tokens.
+            min_rate: The rate is never lowered below this.
+            clock: Returns the current time in seconds.
+            sleep: Waits the given seconds.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Takes a token, waiting until one is available.
+
+        Args:
+            timeout: The maximum seconds to wait, None waits as long as needed.
+
+        Returns:
+            True if a token was taken, False if it was not available within timeout.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            self.sleep(wait)
+
+    def throttle(self, retry_after=None):
+        """
+        Slows down after the upstream asked for it.
+
+        Args:
+            retry_after: Seconds in which no request may be sent, or None.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self._paused_until = max(self._paused_until, self.clock() + retry_after)
+
+    def recover(self):
+        """Speeds up again after a successful request."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+# CircuitBreaker and TokenBucket of every upstream host
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+def getUpstream(url):
+    """
+    Returns the circuit breaker and rate limiter of the host of a URL.
+
+    Args:
+        url: The request URL.
+
+    Returns:
+        A tuple of the CircuitBreaker and the TokenBucket shared by all requests to the host.
+    """
+    host = urlparse(url).netloc
+    with _upstreams_lock:
+        upstream = _upstreams.get(host)
+        if upstream is None:
+            upstream = _upstreams[host] = (CircuitBreaker(FAILURE_THRESHOLD, RESET_TIMEOUT),
+                                           TokenBucket(UPSTREAM_RATE, UPSTREAM_BURST))
+        return upstream
+
+def upstreamStatus():
+    """
+    Returns:
+        A dictionary mapping every upstream host to its circuit state and current rate.
+    """
+    with _upstreams_lock:
+        return {host: {"circuit": breaker.state, "rate": round(limiter.rate, 2)}
+                for host, (breaker, limiter) in _upstreams.items()}
+
+def backoffDelay(attempt, retry_after=None):
+    """
+    Returns the delay before a retry, exponential with full jitter.
+
+    Args:
+        attempt: The number of the failed attempt, starting at 1.
+        retry_after: The delay requested by the upstream in seconds, or None.
+
+    Returns:
+        The delay in seconds.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+    return max(delay, retry_after or 0.0)
+
+def retryAfter(response):
+    """
+    Parses the Retry-After header of a response.
+
+    Args:
+        response: The requests.Response.
+
+    Returns:
+        The seconds to wait, or None if the header is missing or invalid.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def getSession():
+    """
+    Returns the process wide HTTP session.
+
+    The session keeps connections to the upstream alive, so consecutive
+    requests reuse an established TLS connection instead of doing a new
+    handshake for every airport.
+
+    Returns:
+        The shared requests.Session.
+    """
+    global _session
+    if _session is None:
+        # requests is imported on the first fetch, processes which only parse never load it
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+def conditionalGet(ids, deadline=FETCH_DEADLINE):
+    """
+    Requests the METARs of the given ids, revalidating the last response.
+
+    The ETag and Last-Modified headers of the previous response of the same
+    ids are sent as If-None-Match and If-Modified-Since. When the upstream
+    answers 304 Not Modified the body of the previous response is returned
+    without transferring it again.
+
+    Every request has a connect and a read timeout. Timeouts, connection
+    errors and the statuses in RETRY_STATUSES are retried with exponential
+    backoff as long as the deadline allows. Requests pass the circuit breaker
+    and the rate limiter of the upstream, so a degraded upstream fails fast
+    instead of blocking the caller.
+
+    Args:
+        ids: The value of the ids query parameter (e.g., "LOWW,KJFK").
+        deadline: The maximum seconds spent on the call including retries.
+
+    Returns:
+        The response body.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails.
+        UpstreamUnavailable: If the circuit is open.
+        RateLimited: If the rate limit leaves no time for a request.
+    """
+    import requests
+    with _validators_lock:
+        cached = _validators.get(ids)
+    headers = {}
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    breaker, limiter = getUpstream(METAR_URL)
+    give_up = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        # an open circuit fails before it takes a token of the rate limit
+        if not breaker.allow():
+            FETCH_RESPONSES.labels("circuit_open").inc()
+            raise UpstreamUnavailable(f"Circuit of {METAR_URL} is open")
+        if not limiter.acquire(give_up - time.monotonic()):
+            breaker.release()
+            FETCH_RESPONSES.labels("rate_limited").inc()
+            raise RateLimited(f"Rate limit of {METAR_URL} leaves no time to fetch {ids}")
+        retry_after = None
+        try:
+            with FETCH_SECONDS.time():
+                response = getSession().get(METAR_URL, params={"ids": ids}, headers=headers,
+                                            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            # every failed request counts, otherwise a failed probe keeps the circuit half open
+            breaker.recordFailure()
+            if not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                FETCH_RESPONSES.labels("error").inc()
+                raise
+            error = e
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                # the upstream answered, a client error is not its failure
+                breaker.recordSuccess()
+                limiter.recover()
+                break
+            if response.status_code in THROTTLE_STATUSES:
+                retry_after = retryAfter(response)
+                limiter.throttle(retry_after)
+            if response.status_code == 429:
+                breaker.recordSuccess()
+            else:
+                breaker.recordFailure()
+            error = requests.exceptions.HTTPError(f"{response.status_code} Server Error for url: {response.url}",
+                                                  response=response)
+        attempt += 1
+        delay = backoffDelay(attempt, retry_after)
+        if attempt > MAX_RETRIES or time.monotonic() + delay >= give_up:
+            FETCH_RESPONSES.labels("error").inc()
+            raise error
+        FETCH_RETRIES.inc()
+        logging.debug("Retrying %s in %.2fs after %s", ids, delay, error)
+        time.sleep(delay)
+
+    if response.status_code == 304 and cached is not None:
+        FETCH_RESPONSES.labels("not_modified").inc()
+        logging.debug("METARs not modified for %s", ids)
+        return cached[2]
+    try:
+        response.raise_for_status()  # Raise HTTPError for bad responses (4xx)
+    except requests.exceptions.RequestException:
+        FETCH_RESPONSES.labels("error").inc()
+        raise
+    FETCH_RESPONSES.labels("ok").inc()
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    with _validators_lock:
+        if etag or last_modified:
+            _validators[ids] = (etag, last_modified, response.text)
+        else:
+            _validators.pop(ids, None)
+    return response.text
+
+def fetchMETAR(icao, deadline=FETCH_DEADLINE):
     """
     Retrieves METAR data from aviationweather.gov API.
 
     Args:
         icao: The ICAO airport code (e.g., "KJFK").
+        deadline: The maximum seconds spent on the fetch including retries.
 
     Returns:
         The METAR data as a string, or None if an error occurs.
     """
-    url = f"https://aviationweather.gov/api/data/metar?ids={icao}"
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-        logging.info(f"Successfully fetched METAR for {icao}")
-        return response.text
-    except requests.exceptions.RequestException as e:
+        text = conditionalGet(icao, deadline)
+        logging.debug("Successfully fetched METAR for %s", icao)
+        return text
+    except IOError as e:
         logging.error(f"Error fetching METAR: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def fetchMETARs(icaos, max_ids=MAX_IDS_PER_REQUEST):
+    """
+    Retrieves the METARs of many airports with as few requests as possible.
+
+    The ids are packed as comma separated list into the ids query parameter
+    and split into chunks to stay below URL length limits. All chunks are
+    fetched through the shared keep-alive session.
+
+    Args:
+        icaos: An iterable of ICAO airport codes (e.g., ["KJFK", "LOWW"]).
+        max_ids: The maximum number of ids per request.
+
+    Returns:
+        A dictionary mapping each station to its raw METAR line. Stations
+        without a report or whose chunk failed or was rate limited are missing
+        from the result.
+    """
+    metars = {}
+    for chunk in chunkStations(icaos, max_ids=max_ids):
+        ids = ",".join(chunk)
+        try:
+            text = conditionalGet(ids)
+        except RateLimited as e:
+            logging.warning(f"Skipping {len(chunk)} stations until the next cycle: {e}")
+            continue
+        except IOError as e:
+            logging.error(f"Error fetching METARs for {ids}: {e}")
+            continue
+        metars.update(splitMETARs(text))
+    logging.info(f"Successfully fetched {len(metars)} METARs")
+    return metars
+
+def chunkStations(icaos, max_ids=MAX_IDS_PER_REQUEST, max_length=MAX_IDS_LENGTH):
+    """
+    Splits station ids into chunks which fit into a single request.
+
+    Args:
+        icaos: An iterable of ICAO airport codes.
+        max_ids: The maximum number of ids per chunk.
+        max_length: The maximum length of the joined ids per chunk.
+
+    Returns:
+        A list of lists of upper case, de-duplicated ICAO codes.
+    """
+    chunks = []
+    chunk = []
+    length = 0
+    seen = set()
+    for icao in icaos:
+        icao = icao.strip().upper()
+        if not icao or icao in seen:
+            continue
+        seen.add(icao)
+        # +1 for the separating comma
+        if chunk and (len(chunk) >= max_ids or length + len(icao) + 1 > max_length):
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(icao)
+        length += len(icao) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def splitMETARs(text):
+    """
+    Splits a response body with many METARs into single reports.
+
+    The upstream lists the latest report of a station first, later reports
+    of the same station, e.g. older SPECIs, are ignored.
+
+    Args:
+        text: The response body (e.g., "LOWW 191820Z ...\\nKJFK 202300Z ...").
+
+    Returns:
+        A dictionary mapping each station to its raw METAR line.
+    """
+    metars = {}
+    for report in mp.iterReports(text):
+        parts = report.split(None, 2)
+        # the report type is optional in the raw format
+        if parts[0] in mp.REPORT_TYPES and len(parts) > 1:
+            report = report.split(None, 1)[1]
+            station = parts[1]
+        else:
+            station = parts[0]
+        metars.setdefault(station, report)
+    return metars
+
+
+class ReportTracker:
+    """
+    Remembers the last raw METAR of every station to detect unchanged reports.
+
+    METARs are published about twice an hour while stations are polled much
+    more often, so most fetched reports are the same string as last time.
+    A report is only remembered once its observation is stored, a report
+    which failed to parse or to be stored is processed again with the next
+    poll. All methods are thread safe.
+    """
+
+    def __init__(self):
+        self._reports = {}
+        self._lock = threading.Lock()
+
+    def changed(self, icao, raw):
+        """
+        Tells whether the raw METAR of a station is new.
+
+        Args:
+            icao: The ICAO airport code.
+            raw: The raw METAR string.
+
+        Returns:
+            True if the report differs from the last remembered one, otherwise False.
+        """
+        with self._lock:
+            return self._reports.get(icao) != raw.strip()
+
+    def remember(self, icao, raw):
+        """
+        Remembers the raw METAR of a station, call it once its observation is stored.
+
+        Args:
+            icao: The ICAO airport code.
+            raw: The raw METAR string.
+        """
+        raw = raw.strip()
+        with self._lock:
+            self._reports[icao] = raw
+
+    def forget(self, icao=None):
+        """
+        Forgets the last report of a station, or of all stations if no ICAO code is given.
+
+        Args:
+            icao: The ICAO airport code or None.
+        """
+        with self._lock:
+            if icao is None:
+                self._reports.clear()
+            else:
+                self._reports.pop(icao, None)
+
+lastReports = ReportTracker()
@@ -0,0 +1,231 @@
+import threading
+import numpy as np
+from metar_observation import MAGNUS_B, MAGNUS_C
+
+FLIGHT_CATEGORIES = ("VFR", "MVFR", "IFR", "LIFR")
+
+STATUTE_MILE = 1609.34
+STANDARD_QNH = 1013.25
+
+def relativeHumidity(temperature, dew_point):
+    """
+    Calculates the relative humidity in percent with the Magnus formula.
+
+    Args:
+        temperature: Array of temperatures in degrees Celsius.
+        dew_point: Array of dew points in degrees Celsius.
+
+    Returns:
+        Array of relative humidities in percent, NaN where a value is missing.
+    """
+    temperature = np.asarray(temperature, dtype=np.float64)
+    dew_point = np.asarray(dew_point, dtype=np.float64)
+    humidity = 100 * np.exp(MAGNUS_B * dew_point / (MAGNUS_C + dew_point)
+                            - MAGNUS_B * temperature / (MAGNUS_C + temperature))
+    return np.minimum(humidity, 100.0)
+
+def densityAltitude(elevation, qnh, temperature):
+    """
+    Calculates the density altitude in feet.
+
+    Args:
+        elevation: Array of field elevations in feet.
+        qnh: Array of QNH values in hPa.
+        temperature: Array of temperatures in degrees Celsius.
+
+    Returns:
+        Array of density altitudes in feet, NaN where a value is missing.
+    """
+    elevation = np.asarray(elevation, dtype=np.float64)
+    qnh = np.asarray(qnh, dtype=np.float64)
+    temperature = np.asarray(temperature, dtype=np.float64)
+    pressure_altitude = elevation + 145366.45 * (1 - (qnh / STANDARD_QNH) ** 0.190284)
+    isa_temperature = 15 - 1.98 * pressure_altitude / 1000
+    return pressure_altitude + 118.8 * (temperature - isa_temperature)
+
+def windComponents(direction, speed, runway_heading):
+    """
+    Splits the wind into head wind and cross wind components of a runway.
+
+    Args:
+        direction: Array of wind directions in degrees, NaN for variable wind.
+        speed: Array of wind speeds.
+        runway_heading: Array of runway headings in degrees.
+
+    Returns:
+        A tuple of the head wind and the cross wind arrays. Positive cross wind
+        blows from the right, negative head wind is tail wind.
+    """
+    angle = np.radians(np.asarray(direction, dtype=np.float64) - np.asarray(runway_heading, dtype=np.float64))
+    speed = np.asarray(speed, dtype=np.float64)
+    return speed * np.cos(angle), speed * np.sin(angle)
+
+def flightCategory(visibility, ceiling):
+    """
+    Classifies observations into the flight categories VFR, MVFR, IFR and LIFR.
+
+    Args:
+        visibility: Array of visibilities in meters.
+        ceiling: Array of ceilings in feet, NaN or inf if there is no ceiling.
+
+    Returns:
+        Array of indexes into FLIGHT_CATEGORIES, -1 where the visibility is missing.
+    """
+    visibility = np.asarray(visibility, dtype=np.float64)
+    ceiling = np.nan_to_num(np.asarray(ceiling, dtype=np.float64), nan=np.inf)
+    category = np.zeros(np.broadcast(visibility, ceiling).shape, dtype=np.int8)
+    category[(ceiling <= 3000) | (visibility <= 5 * STATUTE_MILE)] = 1
+    category[(ceiling < 1000) | (visibility < 3 * STATUTE_MILE)] = 2
+    category[(ceiling < 500) | (visibility < STATUTE_MILE)] = 3
+    category[np.isnan(visibility)] = -1
+    return category
+
+class HistoryStore:
+    """
+    Columnar in-memory history of observations.
+
+    Every column is a two dimensional array with one row per station and one
+    ring buffer slot per observation, so derived metrics are calculated for
+    all stations at once. Missing values are NaN, empty slots have time 0.
+    """
+
+    COLUMNS = ("temperature", "dew_point", "wind_direction", "wind_speed", "wind_gust",
+               "qnh", "visibility", "ceiling")
+
+    def __init__(self, capacity=48, stations=1024):
+        """
+        Args:
+            capacity: The number of observations kept per station.
+            stations: The initial number of station rows, the store grows when needed.
+        """
+        self.capacity = capacity
+        self.index = {}
+        self.time = np.zeros((stations, capacity), dtype=np.int64)
+        self.columns = {name: np.full((stations, capacity), np.nan) for name in self.COLUMNS}
+        self._next = np.zeros(stations, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _row(self, icao):
+        row = self.index.get(icao)
+        if row is None:
+            row = len(self.index)
+            if row == len(self._next):
+                self._grow()
+            self.index[icao] = row
+        return row
+
+    def _grow(self):
+        rows = len(self._next)
+        self.time = np.concatenate([self.time, np.zeros_like(self.time)])
+        for name, column in self.columns.items():
+            self.columns[name] = np.concatenate([column, np.full_like(column, np.nan)])
+        self._next = np.concatenate([self._next, np.zeros(rows, dtype=np.int64)])
+
+    def append(self, observation):
+        """
+        Appends an observation, the oldest one of the station is overwritten when its row is full.
+
+        Args:
+            observation: The MetarObservation.
+        """
+        values = {
+            "temperature": observation.temperature,
+            "dew_point": observation.dew_point,
+            "wind_direction": None if observation.wind_variable else observation.wind_direction,
+            "wind_speed": observation.wind_speed,
+            "wind_gust": observation.wind_gust,
+            "qnh": observation.qnh,
+            "visibility": observation.visibility,
+            "ceiling": observation.ceiling,
+        }
+        with self._lock:
+            row = self._row(observation.station)
+            slot = self._next[row] % self.capacity
+            self._next[row] += 1
+            self.time[row, slot] = int(observation.time.timestamp()) if observation.time else 0
+            for name, value in values.items():
+                self.columns[name][row, slot] = np.nan if value is None else value
+
+    def station(self, icao):
+        """
+        Returns the history of one station in chronological order.
+
+        Args:
+            icao: The ICAO airport code.
+
+        Returns:
+            A dictionary with the time in epoch seconds and one array per column,
+            or None if the station has no observations.
+        """
+        with self._lock:
+            row = self.index.get(icao)
+            if row is None:
+                return None
+            count = min(self._next[row], self.capacity)
+            order = (np.arange(count) + self._next[row] - count) % self.capacity
+            history = {"time": self.time[row, order]}
+            for name, column in self.columns.items():
+                history[name] = column[row, order]
+            return history
+
+    def _snapshot(self):
+        # copies of the filled rows, appends after the snapshot do not change them
+        with self._lock:
+            rows = len(self.index)
+            stations = list(self.index)
+            columns = {name: column[:rows].copy() for name, column in self.columns.items()}
+            latest = (self._next[:rows] - 1) % self.capacity
+        return stations, columns, latest
+
+    def deriveMetrics(self, elevation=0.0, runway_heading=np.nan):
+        """
+        Calculates derived metrics of all observations of all stations in one batch.
+
+        Args:
+            elevation: Field elevation in feet, a scalar or an array with one value per station row.
+            runway_heading: Runway heading in degrees, a scalar or an array with one value per station row.
+
+        Returns:
+            A dictionary of (stations, capacity) arrays: humidity, density_altitude,
+            headwind, crosswind and flight_category, rows are ordered like index.
+        """
+        stations, columns, _ = self._snapshot()
+        return _derive(columns, len(stations), elevation, runway_heading)
+
+    def latestMetrics(self, elevation=None):
+        """
+        Calculates the derived metrics of the latest observation of every station.
+
+        Args:
+            elevation: Callable returning the field elevation in feet of an ICAO code, or None. Defaults to sea level.
+
+        Returns:
+            A dictionary mapping every station to a dictionary of humidity,
+            density_altitude and flight_category, missing values are NaN and -1.
+        """
+        stations, columns, latest = self._snapshot()
+        rows = np.arange(len(stations))
+        newest = {name: column[rows, latest].reshape(-1, 1) for name, column in columns.items()}
+        elevations = [(elevation(icao) if elevation else None) or 0.0 for icao in stations]
+        metrics = _derive(newest, len(stations), elevations, np.nan)
+        return {icao: {"humidity": float(metrics["humidity"][row, 0]),
+                       "density_altitude": float(metrics["density_altitude"][row, 0]),
+                       "flight_category": int(metrics["flight_category"][row, 0])}
+                for row, icao in enumerate(stations)}
+
+def _derive(columns, rows, elevation, runway_heading):
+    elevation = np.broadcast_to(np.asarray(elevation, dtype=np.float64).reshape(-1, 1), (rows, 1))
+    runway_heading = np.broadcast_to(np.asarray(runway_heading, dtype=np.float64).reshape(-1, 1), (rows, 1))
+    headwind, crosswind = windComponents(columns["wind_direction"], columns["wind_speed"], runway_heading)
+    return {
+        "humidity": relativeHumidity(columns["temperature"], columns["dew_point"]),
+        "density_altitude": densityAltitude(elevation, columns["qnh"], columns["temperature"]),
+        "headwind": headwind,
+        "crosswind": crosswind,
+        "flight_category": flightCategory(columns["visibility"], columns["ceiling"]),
+    }
+
+history = HistoryStore()
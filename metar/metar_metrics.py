@@ -0,0 +1,134 @@
+"""
+Prometheus metrics of the ingestion and the API.
+
+Hot paths only observe histograms and increment counters, both are a lock
+and a few additions. Values which are already counted elsewhere, like the
+cache statistics, are read when the metrics are scraped.
+
+Every gunicorn worker is its own process. With PROMETHEUS_MULTIPROC_DIR set
+the metrics of all workers are aggregated, except the cache statistics and
+the derived metrics of the history which are reported by the process serving
+the scrape.
+"""
+import os
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Parsing takes microseconds, the network round trips milliseconds to seconds
+PARSE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+NETWORK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+FETCH_SECONDS = Histogram("metar_fetch_seconds", "Latency of upstream METAR requests", buckets=NETWORK_BUCKETS)
+FETCH_RESPONSES = Counter("metar_fetch_responses_total", "Upstream METAR responses by result", ["result"])
+FETCH_RETRIES = Counter("metar_fetch_retries_total", "Retried upstream METAR requests")
+PARSE_SECONDS = Histogram("metar_parse_seconds", "Time to parse one METAR", buckets=PARSE_BUCKETS)
+PARSE_FAILURES = Counter("metar_parse_failures_total", "METARs which failed to parse by the group being parsed", ["group"])
+WRITE_SECONDS = Histogram("metar_influx_write_seconds", "Latency of InfluxDB batch write requests", buckets=NETWORK_BUCKETS)
+WRITE_POINTS = Counter("metar_influx_points_total", "Points written to InfluxDB")
+SPOOL_POINTS = Counter("metar_spool_points_total", "Points appended to, drained from, compacted, dropped or dead lettered from the spool",
+                       ["event"])
+SPOOL_BYTES = Gauge("metar_spool_bytes", "Bytes of points waiting in the spool", multiprocess_mode="max")
+QUERY_SECONDS = Histogram("metar_influx_query_seconds", "Latency of InfluxDB queries", ["query"], buckets=NETWORK_BUCKETS)
+SCHEDULER_LAG = Histogram("metar_scheduler_lag_seconds", "Delay between the planned and the actual start of a scheduled job",
+                          buckets=LAG_BUCKETS)
+SKIPPED_JOBS = Counter("metar_scheduler_skipped_jobs_total", "Scheduled jobs skipped because they started too late")
+
+# The registry and collector of every registered cache and history, see exposition
+_process_collectors = []
+
+class CacheCollector:
+    """Exposes the counters of a cache with a stats() method at scrape time."""
+
+    def __init__(self, cache, prefix="metar_cache", description="latest observation cache"):
+        self.cache = cache
+        self.prefix = prefix
+        self.description = description
+
+    def collect(self):
+        stats = self.cache.stats()
+        yield GaugeMetricFamily(f"{self.prefix}_size", f"Entries in the {self.description}", value=stats["size"])
+        for counter in ("hits", "misses", "evictions"):
+            yield CounterMetricFamily(f"{self.prefix}_{counter}", f"{counter.capitalize()} of the {self.description}",
+                                      value=stats[counter])
+
+class HistoryCollector:
+    """Exposes the derived metrics of the latest observation of every station in a HistoryStore at scrape time."""
+
+    # the order of metar_history.FLIGHT_CATEGORIES, metar_history loads numpy
+    FLIGHT_CATEGORIES = ("VFR", "MVFR", "IFR", "LIFR")
+
+    def __init__(self, history, elevation=None):
+        self.history = history
+        self.elevation = elevation
+
+    def collect(self):
+        humidity = GaugeMetricFamily("metar_station_humidity_percent",
+                                     "Relative humidity of the latest observation", labels=["icao"])
+        density_altitude = GaugeMetricFamily("metar_station_density_altitude_feet",
+                                             "Density altitude of the latest observation", labels=["icao"])
+        category = GaugeMetricFamily("metar_station_flight_category",
+                                     "Flight category of the latest observation, 1 for the current category",
+                                     labels=["icao", "category"])
+        for icao, metrics in self.history.latestMetrics(self.elevation).items():
+            # NaN marks a missing value, e.g. no dew point reported
+            if metrics["humidity"] == metrics["humidity"]:
+                humidity.add_metric([icao], metrics["humidity"])
+            if metrics["density_altitude"] == metrics["density_altitude"]:
+                density_altitude.add_metric([icao], metrics["density_altitude"])
+            if metrics["flight_category"] >= 0:
+                for index, name in enumerate(self.FLIGHT_CATEGORIES):
+                    category.add_metric([icao, name], 1 if index == metrics["flight_category"] else 0)
+        yield humidity
+        yield density_altitude
+        yield category
+
+def registerCache(cache, registry=REGISTRY, prefix="metar_cache", description="latest observation cache"):
+    """
+    Registers the statistics of a cache with a registry.
+
+    Args:
+        cache: The LatestObservationCache, or any cache with the same stats().
+        registry: The Prometheus registry.
+        prefix: The prefix of the metric names.
+        description: The name of the cache in the metric descriptions.
+    """
+    collector = CacheCollector(cache, prefix, description)
+    registry.register(collector)
+    _process_collectors.append((registry, collector))
+
+def registerHistory(history, elevation=None, registry=REGISTRY):
+    """
+    Registers the derived metrics of the stations of a history with a registry.
+
+    Args:
+        history: The metar_history.HistoryStore.
+        elevation: Callable returning the field elevation in feet of an ICAO code, or None.
+        registry: The Prometheus registry.
+    """
+    collector = HistoryCollector(history, elevation)
+    registry.register(collector)
+    _process_collectors.append((registry, collector))
+
+def exposition(registry=REGISTRY):
+    """
+    Renders the metrics in the Prometheus text format.
+
+    When the metrics of many processes are aggregated, the aggregate is
+    rendered with the cache and history metrics registered with the registry.
+
+    Args:
+        registry: The Prometheus registry.
+
+    Returns:
+        A tuple of the body and its content type.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        aggregate = CollectorRegistry()
+        multiprocess.MultiProcessCollector(aggregate)
+        for owner, collector in _process_collectors:
+            if owner is registry:
+                aggregate.register(collector)
+        registry = aggregate
+    return generate_latest(registry), CONTENT_TYPE_LATEST
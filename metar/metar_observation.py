@@ -0,0 +1,363 @@
+import math
+from dataclasses import dataclass, field
+from functools import lru_cache
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+class CloudCover(Enum):
+    SKC = "SKC"
+    CLR = "CLR"
+    NSC = "NSC"
+    NCD = "NCD"
+    FEW = "FEW"
+    SCT = "SCT"
+    BKN = "BKN"
+    OVC = "OVC"
+    VV = "VV"
+
+class ConvectiveCloud(Enum):
+    CB = "CB"
+    TCU = "TCU"
+
+class Intensity(Enum):
+    LIGHT = "-"
+    HEAVY = "+"
+    VICINITY = "VC"
+
+class Descriptor(Enum):
+    MI = "MI"
+    BC = "BC"
+    PR = "PR"
+    DR = "DR"
+    BL = "BL"
+    SH = "SH"
+    TS = "TS"
+    FZ = "FZ"
+
+class Phenomenon(Enum):
+    DZ = "DZ"
+    RA = "RA"
+    SN = "SN"
+    SG = "SG"
+    IC = "IC"
+    PL = "PL"
+    GR = "GR"
+    GS = "GS"
+    UP = "UP"
+    BR = "BR"
+    FG = "FG"
+    FU = "FU"
+    VA = "VA"
+    DU = "DU"
+    SA = "SA"
+    HZ = "HZ"
+    PY = "PY"
+    PO = "PO"
+    SQ = "SQ"
+    FC = "FC"
+    SS = "SS"
+    DS = "DS"
+
+CLOUD_TYPES = {
+    CloudCover.CLR: "clear of clouds below 12000ft",
+    CloudCover.SKC: "sky clear",
+    CloudCover.NSC: "no significant clouds",
+    CloudCover.NCD: "no clouds detected",
+    CloudCover.FEW: "few clouds at",
+    CloudCover.SCT: "scattered clouds at",
+    CloudCover.BKN: "broken clouds at",
+    CloudCover.OVC: "overcast at",
+    CloudCover.VV: "vertical visibility",
+}
+
+CLOUD_SUFFIXES = {
+    ConvectiveCloud.CB: " cumulonimbus",
+    ConvectiveCloud.TCU: " towering cumulus",
+}
+
+WEATHER_INTENSITIES = {
+    Intensity.LIGHT: "light ",
+    Intensity.HEAVY: "heavy ",
+    Intensity.VICINITY: "vicinity ",
+}
+
+WEATHER_DESCRIPTORS = {
+    Descriptor.MI: "shallow ",
+    Descriptor.BC: "patches of ",
+    Descriptor.PR: "partial ",
+    Descriptor.DR: "low drifting ",
+    Descriptor.BL: "blowing ",
+    Descriptor.SH: "showers ",
+    Descriptor.TS: "thunderstorm ",
+    Descriptor.FZ: "freezing ",
+}
+
+WEATHER_PHENOMENA = {
+    Phenomenon.DZ: "drizzle",
+    Phenomenon.RA: "rain",
+    Phenomenon.SN: "snow",
+    Phenomenon.SG: "snow grains",
+    Phenomenon.IC: "ice crystals",
+    Phenomenon.PL: "ice pellets",
+    Phenomenon.GR: "hail",
+    Phenomenon.GS: "small hail/snow pellets",
+    Phenomenon.UP: "unknown precipitation",
+    Phenomenon.BR: "mist",
+    Phenomenon.FG: "fog",
+    Phenomenon.FU: "smoke",
+    Phenomenon.VA: "volcanic ash",
+    Phenomenon.DU: "widespread dust",
+    Phenomenon.SA: "sand",
+    Phenomenon.HZ: "haze",
+    Phenomenon.PY: "spray",
+    Phenomenon.PO: "dust/sand whirls",
+    Phenomenon.SQ: "squalls",
+    Phenomenon.FC: "funnel cloud/tornado/waterspout",
+    Phenomenon.SS: "sandstorm",
+    Phenomenon.DS: "duststorm",
+}
+
+# Magnus formula coefficients over water
+MAGNUS_B = 17.625
+MAGNUS_C = 243.04
+
+CEILING_COVERS = frozenset((CloudCover.BKN, CloudCover.OVC, CloudCover.VV))
+SKY_CLEAR_COVERS = frozenset((CloudCover.SKC, CloudCover.CLR, CloudCover.NSC, CloudCover.NCD))
+
+# reports carry whole degrees, so a few thousand pairs cover every climate
+@lru_cache(maxsize=8192)
+def relativeHumidity(temperature, dew_point):
+    """
+    Calculates the relative humidity from temperature and dew point with the Magnus formula.
+
+    Args:
+        temperature: The temperature in degrees Celsius.
+        dew_point: The dew point in degrees Celsius.
+
+    Returns:
+        The relative humidity in percent rounded to one decimal, or None if a value is missing.
+    """
+    if temperature is None or dew_point is None:
+        return None
+    humidity = 100 * math.exp(MAGNUS_B * dew_point / (MAGNUS_C + dew_point)
+                              - MAGNUS_B * temperature / (MAGNUS_C + temperature))
+    return round(min(humidity, 100.0), 1)
+
+@dataclass(slots=True, frozen=True)
+class CloudLayer:
+    """
+    A cloud layer, the height is in feet and None for clear sky or an unknown height.
+
+    The description is built once when the layer is created, the parser
+    shares one layer between all reports with the same cloud group.
+    """
+    cover: CloudCover
+    height: Optional[int] = None
+    convective: Optional[ConvectiveCloud] = None
+    description: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.cover in SKY_CLEAR_COVERS:
+            description = CLOUD_TYPES[self.cover]
+        elif self.height is None:
+            description = CLOUD_TYPES[self.cover] + " unknown height"
+        else:
+            description = f"{CLOUD_TYPES[self.cover]} {self.height}ft"
+        if self.convective is not None and self.cover not in SKY_CLEAR_COVERS:
+            description += CLOUD_SUFFIXES[self.convective]
+        object.__setattr__(self, "description", description)
+
+    def describe(self):
+        """
+        Returns:
+            The human-readable description of the layer (e.g., "few clouds at 5000ft").
+        """
+        return self.description
+
+@dataclass(slots=True, frozen=True)
+class WeatherGroup:
+    """A present weather group (e.g., "-SHRA"), the description is built once like that of CloudLayer."""
+    intensity: Optional[Intensity]
+    descriptor: Optional[Descriptor]
+    phenomena: tuple
+    description: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        description = ""
+        if self.intensity is not None:
+            description += WEATHER_INTENSITIES[self.intensity]
+        if self.descriptor is not None:
+            description += WEATHER_DESCRIPTORS[self.descriptor]
+        description += " and ".join(WEATHER_PHENOMENA[phenomenon] for phenomenon in self.phenomena)
+        object.__setattr__(self, "description", description.strip())
+
+    def describe(self):
+        """
+        Returns:
+            The human-readable description of the group (e.g., "light showers rain").
+        """
+        return self.description
+
+@dataclass(slots=True, frozen=True)
+class RunwayVisualRange:
+    """The visual range of a runway, distances are in meters."""
+    runway: str
+    min_range: int
+    max_range: int
+    trend: Optional[str] = None
+
+    def to_dict(self):
+        return {
+            "runway": self.runway,
+            "min_range": self.min_range,
+            "max_range": self.max_range,
+            "unit": "M",
+            "trend": self.trend,
+        }
+
+@dataclass(slots=True, frozen=True)
+class Trend:
+    """
+    A trend forecast appended to a METAR, NOSIG or a TEMPO or BECMG group.
+
+    The times are "HHMM" in UTC, the units are those of MetarObservation.
+    """
+    kind: str
+    time_from: Optional[str] = None
+    time_until: Optional[str] = None
+    time_at: Optional[str] = None
+    wind_direction: Optional[int] = None
+    wind_variable: bool = False
+    wind_speed: Optional[int] = None
+    wind_gust: Optional[int] = None
+    visibility: Optional[int] = None
+    weather: tuple = ()
+    no_significant_weather: bool = False
+    clouds: tuple = ()
+
+    def to_dict(self):
+        trend = {"kind": self.kind}
+        if self.time_from is not None:
+            trend["time_from"] = self.time_from
+        if self.time_until is not None:
+            trend["time_until"] = self.time_until
+        if self.time_at is not None:
+            trend["time_at"] = self.time_at
+        if self.wind_speed is not None:
+            trend["wind"] = {
+                "direction": "VRB" if self.wind_variable else self.wind_direction,
+                "speed": self.wind_speed,
+                "unit": "KT",
+                "gust": self.wind_gust,
+            }
+        if self.visibility is not None:
+            trend["visibility"] = self.visibility
+        if self.no_significant_weather:
+            trend["weather"] = "no significant weather"
+        elif self.weather:
+            trend["weather"] = ", ".join([group.description for group in self.weather])
+        if self.clouds:
+            trend["clouds"] = [layer.description for layer in self.clouds]
+        return trend
+
+@dataclass(slots=True)
+class MetarObservation:
+    """
+    A parsed METAR with typed fields.
+
+    Speeds are in knots, visibility and RVR in meters, temperatures in degrees
+    Celsius and the QNH in hPa. Fields which are not reported are None.
+    Recent weather, trends and remarks follow the QNH, the remarks are kept
+    as raw text because their content is national practice.
+    """
+    station: str
+    time: Optional[datetime] = None
+    report_type: str = "METAR"
+    update: Optional[str] = None
+    wind_direction: Optional[int] = None
+    wind_variable: bool = False
+    wind_speed: Optional[int] = None
+    wind_gust: Optional[int] = None
+    wind_variation: Optional[tuple] = None
+    visibility: Optional[int] = None
+    rvr: tuple = ()
+    weather: tuple = ()
+    clouds: tuple = ()
+    temperature: Optional[int] = None
+    dew_point: Optional[int] = None
+    qnh: Optional[int] = None
+    recent_weather: tuple = ()
+    trends: tuple = ()
+    remarks: Optional[str] = None
+
+    @property
+    def humidity(self):
+        """The relative humidity in percent, or None if temperature or dew point are missing."""
+        return relativeHumidity(self.temperature, self.dew_point)
+
+    @property
+    def ceiling(self):
+        """The height in feet of the lowest broken, overcast or obscured layer, or None."""
+        heights = [layer.height for layer in self.clouds
+                   if layer.cover in CEILING_COVERS and layer.height is not None]
+        return min(heights) if heights else None
+
+    def to_dict(self):
+        """
+        Converts the observation into the dictionary returned by metar_parser.parseMETAR.
+
+        Returns:
+            The parsed METAR dictionary, with the time as datetime.
+        """
+        metar = {
+            "station": self.station,
+            "time": self.time,
+            "report_type": self.report_type,
+        }
+        if self.update is not None:
+            metar["update"] = self.update
+        if self.wind_speed is None:
+            metar["wind"] = None
+        else:
+            metar["wind"] = {
+                "direction": "VRB" if self.wind_variable else self.wind_direction,
+                "speed": self.wind_speed,
+                "unit": "KT",
+                "gust": self.wind_gust,
+            }
+        if self.wind_variation is not None:
+            metar["wind_variation"] = {
+                "min_direction": self.wind_variation[0],
+                "max_direction": self.wind_variation[1],
+            }
+        metar["visibility"] = self.visibility
+        metar["rvr"] = [rvr.to_dict() for rvr in self.rvr] if self.rvr else []
+        metar["weather"] = ", ".join([group.description for group in self.weather]) if self.weather else ""
+        metar["clouds"] = [layer.description for layer in self.clouds]
+        if self.temperature is None:
+            metar["temperatures"] = None
+        else:
+            metar["temperatures"] = {"temperature": self.temperature, "dew_point": self.dew_point}
+        metar["humidity"] = relativeHumidity(self.temperature, self.dew_point)
+        metar["QNH"] = self.qnh
+        metar["recent_weather"] = (", ".join([group.description for group in self.recent_weather])
+                                   if self.recent_weather else "")
+        metar["trends"] = [trend.to_dict() for trend in self.trends] if self.trends else []
+        metar["remarks"] = self.remarks
+        return metar
+
+    def to_json(self):
+        """
+        Converts the observation into a JSON serializable dictionary.
+
+        The dictionary has the shape of to_dict with the time as ISO 8601 string,
+        so it can be passed to json.dumps or jsonify as it is.
+
+        Returns:
+            The JSON ready METAR dictionary.
+        """
+        metar = self.to_dict()
+        if self.time is not None:
+            metar["time"] = self.time.isoformat()
+        return metar
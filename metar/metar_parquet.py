@@ -0,0 +1,218 @@
+"""
+Bulk export and import of the observation history as Parquet files.
+
+The export runs one Flux query which pivots the fields of every observation
+into a row and streams the CSV response through the Arrow CSV reader into a
+Parquet file, block by block. The import reads a Parquet file in record
+batches, formats each batch into line protocol with Arrow compute kernels
+and writes it with synchronous writes. Neither direction creates a Python
+object per observation besides the line protocol strings handed to the
+client, so long ranges of many stations stream in bounded memory.
+
+Usage:
+    python metar_parquet.py export history.parquet --start 2024-01-01T00:00:00Z --icao LOWW,LOWG
+    python metar_parquet.py import history.parquet --bucket metar
+"""
+import argparse
+import logging
+import sys
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+from influxdb_client import Dialect
+import TimeSeriesRepository as tsr
+from metar_metrics import QUERY_SECONDS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# The fields as written by TimeSeriesRepository.metarToPoint, integer fields
+# keep their type so an import does not conflict with the stored field types
+PARQUET_SCHEMA = pa.schema([
+    ("time", pa.timestamp("ns", tz="UTC")),
+    ("icao", pa.string()),
+    ("temperature", pa.int64()),
+    ("dewpoint", pa.int64()),
+    ("humidity", pa.float64()),
+    ("wind_direction", pa.int64()),
+    ("wind_variable", pa.bool_()),
+    ("wind_speed", pa.int64()),
+    ("wind_gust", pa.int64()),
+    ("visibility", pa.int64()),
+    ("weather", pa.string()),
+    ("qnh", pa.int64()),
+])
+FIELDS = PARQUET_SCHEMA.names[2:]
+# The columns of the CSV response, the flux time column is renamed to time. Older
+# points hold variable wind as wind_direction="VRB", so the direction is read as text
+CSV_TYPES = {("_time" if field.name == "time" else field.name):
+             (pa.string() if field.name == "wind_direction" else field.type) for field in PARQUET_SCHEMA}
+
+# Bytes of CSV per record batch of the export, each batch is one row group
+EXPORT_BLOCK_SIZE = 16 * 1024 * 1024
+IMPORT_BATCH_SIZE = 50000
+
+# Plain CSV with a single header line, the annotations are not needed with a fixed schema
+CSV_DIALECT = Dialect(header=True, annotations=[])
+
+def _exportQuery(bucket, start, stop, icaos):
+    station_filter = ""
+    if icaos is not None:
+        icaos = [icao.upper() for icao in icaos]
+        invalid = [icao for icao in icaos if not tsr.ICAO_PATTERN.match(icao)]
+        if invalid or not icaos:
+            raise ValueError(f"Invalid ICAO codes: {', '.join(invalid)}")
+        stations = ", ".join(f'"{icao}"' for icao in icaos)
+        station_filter = f'|> filter(fn: (r) => contains(value: r["icao"], set: [{stations}]))'
+    stop_argument = f", stop: {stop}" if stop else ""
+    columns = ", ".join(f'"{column}"' for column in ["_time", "icao"] + FIELDS)
+    # pivot yields one table per station, group() concatenates them into one CSV table with one header
+    return f'''
+        from(bucket: "{bucket}")
+            |> range(start: {start}{stop_argument})
+            |> filter(fn: (r) => r["_measurement"] == "metar")
+            {station_filter}
+            |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+            |> group()
+            |> keep(columns: [{columns}])
+    '''
+
+def _conform(batch):
+    # columns of fields without a value in the range are read as nulls of type null
+    columns = {field.name: batch.column(name) for name, field in zip(CSV_TYPES, PARQUET_SCHEMA)}
+    direction = columns["wind_direction"].cast(pa.string())
+    variable = pc.fill_null(pc.equal(direction, "VRB"), False)
+    columns["wind_direction"] = pc.if_else(variable, pa.scalar(None, pa.string()), direction)
+    columns["wind_variable"] = pc.if_else(variable, True, columns["wind_variable"].cast(pa.bool_()))
+    return pa.RecordBatch.from_arrays([columns[field.name].cast(field.type) for field in PARQUET_SCHEMA],
+                                      schema=PARQUET_SCHEMA)
+
+def exportParquet(path, bucket="metar", start="-30d", stop=None, icaos=None, client=None, compression="zstd"):
+    """
+    Exports observations into a Parquet file with one row per observation.
+
+    Args:
+        path: The path of the Parquet file.
+        bucket: The InfluxDB bucket.
+        start: The start of the range, a Flux duration (e.g., "-365d") or RFC3339 time.
+        stop: The end of the range, None for now.
+        icaos: The ICAO codes of the stations, None for all stations.
+        client: The InfluxDBClient, defaults to the client of the shared repository.
+        compression: The Parquet compression codec.
+
+    Returns:
+        The number of exported observations.
+
+    Raises:
+        ValueError: If an ICAO code is invalid.
+    """
+    query = _exportQuery(bucket, start, stop, icaos)
+    client = client or tsr.getRepository().client
+    rows = 0
+    response = client.query_api().query_raw(query, dialect=CSV_DIALECT)
+    try:
+        with QUERY_SECONDS.labels("export").time(), pq.ParquetWriter(path, PARQUET_SCHEMA, compression=compression) as writer:
+            try:
+                reader = csv.open_csv(
+                    response,
+                    read_options=csv.ReadOptions(block_size=EXPORT_BLOCK_SIZE),
+                    convert_options=csv.ConvertOptions(column_types=CSV_TYPES, include_columns=list(CSV_TYPES),
+                                                       include_missing_columns=True, strings_can_be_null=True))
+            except pa.ArrowInvalid as e:
+                # an empty range is answered with an empty body
+                if "Empty CSV file" not in str(e):
+                    raise
+                reader = ()
+            for batch in reader:
+                if batch.num_rows:
+                    writer.write_batch(_conform(batch))
+                    rows += batch.num_rows
+    finally:
+        response.release_conn()
+    logger.info(f"Exported {rows} observations to {path}")
+    return rows
+
+def _fieldColumn(name, column):
+    if pa.types.is_string(column.type):
+        escaped = pc.replace_substring(pc.replace_substring(column, "\\", "\\\\"), '"', '\\"')
+        return pc.binary_join_element_wise(f'{name}="', escaped, '"', "")
+    value = pc.cast(column, pa.string())
+    if pa.types.is_integer(column.type):
+        return pc.binary_join_element_wise(f"{name}=", value, "i", "")
+    return pc.binary_join_element_wise(f"{name}=", value, "")
+
+def toLineProtocol(batch):
+    """
+    Formats a record batch of PARQUET_SCHEMA into line protocol.
+
+    Null fields are left out, rows without any field or time are skipped.
+
+    Args:
+        batch: A pyarrow RecordBatch or Table.
+
+    Returns:
+        A pyarrow string array with one point per row.
+    """
+    fields = [_fieldColumn(name, batch.column(name)) for name in FIELDS if name in batch.schema.names]
+    field_set = pc.binary_join_element_wise(*fields, ",", null_handling="skip")
+    series = pc.binary_join_element_wise("metar,icao=", batch.column("icao"), "")
+    timestamps = pc.cast(pc.cast(batch.column("time"), pa.timestamp("ns", tz="UTC")), pa.int64())
+    lines = pc.binary_join_element_wise(series, field_set, pc.cast(timestamps, pa.string()), " ")
+    valid = pc.and_(pc.is_valid(lines), pc.greater(pc.utf8_length(field_set), 0))
+    return pc.filter(lines, valid)
+
+def importParquet(path, bucket="metar", batch_size=IMPORT_BATCH_SIZE, repository=None):
+    """
+    Imports a Parquet file written by exportParquet.
+
+    Args:
+        path: The path of the Parquet file.
+        bucket: The InfluxDB bucket.
+        batch_size: The number of rows per write request.
+        repository: The MetarRepository, defaults to the shared repository.
+
+    Returns:
+        The number of imported observations.
+    """
+    repository = repository or tsr.getRepository()
+    parquet = pq.ParquetFile(path)
+    points = 0
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=PARQUET_SCHEMA.names):
+        lines = toLineProtocol(batch).to_pylist()
+        if lines:
+            repository.write_lines(lines, bucket)
+            points += len(lines)
+    logger.info(f"Imported {points} observations from {path}")
+    return points
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m metar_parquet",
+                                     description="Export or import the METAR history as Parquet.")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("path", help="the Parquet file")
+    parser.add_argument("--bucket", default="metar", help="InfluxDB bucket")
+    parser.add_argument("--start", default="-30d", help="start of the export, a duration like -365d or an RFC3339 time")
+    parser.add_argument("--stop", help="end of the export, defaults to now")
+    parser.add_argument("--icao", help="comma separated ICAO codes of the export, defaults to all stations")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="rows per write of the import")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    start = time.monotonic()
+    try:
+        if args.command == "export":
+            icaos = args.icao.split(",") if args.icao else None
+            rows = exportParquet(args.path, args.bucket, args.start, args.stop, icaos)
+        else:
+            rows = importParquet(args.path, args.bucket, args.batch_size)
+    finally:
+        tsr.closeRepository()
+    seconds = time.monotonic() - start
+    logger.info(f"{args.command.capitalize()} of {rows} observations took {seconds:.1f}s "
+                f"({rows / seconds if seconds else 0:.0f}/s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
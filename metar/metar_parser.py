@@ -1,107 +1,538 @@
+import logging
 import re
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
+from metar_observation import (MetarObservation, CloudLayer, WeatherGroup, RunwayVisualRange, Trend,
+                               CloudCover, ConvectiveCloud, Intensity, Descriptor, Phenomenon)
+
+logger = logging.getLogger()
+
+# Token patterns, compiled once at import. Every pattern matches a whole token.
+STATION_PATTERN = re.compile(r"[A-Z][A-Z0-9]{3}$")
+TIME_PATTERN = re.compile(r"\d{6}Z$")
+UPDATE_CODES = frozenset(("AUTO", "COR"))
+WIND_PATTERN = re.compile(r"(\d{3}|VRB)(\d{2,3})(?:G(\d{2,3}))?(KT|MPS|KMH)$")
+WIND_VARIATION_PATTERN = re.compile(r"(\d{3})V(\d{3})$")
+VISIBILITY_METERS_PATTERN = re.compile(r"(\d{4})(?:NDV|[NSEW]{1,2})?$")
+VISIBILITY_SM_PATTERN = re.compile(r"([PM])?(\d+)SM$")
+VISIBILITY_FRACTION_PATTERN = re.compile(r"([PM])?(\d+)/(\d+)SM$")
+WHOLE_NUMBER_PATTERN = re.compile(r"\d{1,2}$")
+RVR_PATTERN = re.compile(r"R(\d{2}[LCR]?)/[PM]?(\d{4})(?:V[PM]?(\d{4}))?(FT|M)?(?:/?([UDN]))?$")
+# A weather group needs at least one phenomenon, only thunderstorms and showers
+# are also reported on their own ("TS", "VCSH")
+WEATHER_PATTERN = re.compile(
+    r"([-+]|VC)?(MI|BC|PR|DR|BL|SH|TS|FZ)?"
+    r"((?:DZ|RA|SN|SG|IC|PL|GR|GS|UP|BR|FG|FU|VA|DU|SA|HZ|PY|PO|SQ|FC|SS|DS)+|(?<=TS|SH))$")
+CLOUD_PATTERN = re.compile(r"(FEW|SCT|BKN|OVC|VV)(\d{3}|///)(CB|TCU|///)?$")
+SKY_CLEAR_CODES = frozenset(("SKC", "CLR", "NSC", "NCD"))
+TEMPERATURE_PATTERN = re.compile(r"(M?\d{2})/(M?\d{2})?$")
+QNH_PATTERN = re.compile(r"([AQ])(\d{4})$")
+REPORT_TYPES = frozenset(("METAR", "SPECI"))
+TREND_CODES = frozenset(("NOSIG", "TEMPO", "BECMG"))
+TREND_TIME_PATTERN = re.compile(r"(FM|TL|AT)(\d{4})$")
+TREND_TIMES = {"FM": "time_from", "TL": "time_until", "AT": "time_at"}
+
+# Code to enum lookups, faster than calling the enums
+CLOUD_COVERS = {cover.value: cover for cover in CloudCover}
+CONVECTIVE_CLOUDS = {cloud.value: cloud for cloud in ConvectiveCloud}
+INTENSITIES = {intensity.value: intensity for intensity in Intensity}
+DESCRIPTORS = {descriptor.value: descriptor for descriptor in Descriptor}
+PHENOMENA = {phenomenon.value: phenomenon for phenomenon in Phenomenon}
+
+FEET_TO_METERS = 0.3048
+STATUTE_MILES_TO_METERS = 1609.34
+MPS_TO_KT = 1.94384
+KMH_TO_KT = 0.539957
+SPEED_FACTORS = {"KT": 1, "MPS": MPS_TO_KT, "KMH": KMH_TO_KT}
+INHG_HUNDREDTHS_TO_MBAR = 0.338639
+
+# Distinct tokens remembered per group, see TokenTable
+TOKEN_TABLE_SIZE = 4096
+
+# The values of groups which are missing from a report
+NO_WIND = (None, False, None, None)
+NO_TEMPERATURES = (None, None)
+NO_SUPPLEMENTARY = ((), (), None)
+
+# A report may be stamped up to this far ahead of the reference time, e.g. by clock skew
+MAX_CLOCK_SKEW = timedelta(days=1)
+
+class ParseMemo:
+    """
+    Bounded memo of parsed observations keyed by the raw METAR string.
+
+    The least recently used entry is evicted once the memo holds maxsize
+    reports. Failed parses are remembered as None, so repeated garbage is
+    not parsed again either. All methods are thread safe.
+    """
+
+    def __init__(self, maxsize=4096):
+        """
+        Args:
+            maxsize: The maximum number of remembered reports, 0 disables the memo.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, metar, reference):
+        """
+        Returns the remembered observation of a report.
+
+        An observation is only returned if its time still resolves to the same
+        month for the given reference time, so the result equals a fresh parse.
+
+        Args:
+            metar: The raw METAR string.
+            reference: The reference time in UTC.
+
+        Returns:
+            A tuple of found and the observation, which is None for reports which failed to parse.
+        """
+        latest = reference + MAX_CLOCK_SKEW
+        with self._lock:
+            entry = self._entries.get(metar)
+            if entry is not None and (entry[1] is None or entry[0].time <= latest < entry[1]):
+                self._entries.move_to_end(metar)
+                self.hits += 1
+                return True, entry[0]
+            self.misses += 1
+            return False, None
+
+    def put(self, metar, observation):
+        """
+        Remembers the observation of a report.
+
+        Args:
+            metar: The raw METAR string.
+            observation: The MetarObservation or None.
+        """
+        if self.maxsize <= 0:
+            return
+        # from the next time with the same day of month on the report resolves to that, see _resolveTime
+        expires = _nextTime(observation.time) if observation is not None and observation.time is not None else None
+        with self._lock:
+            self._entries[metar] = (observation, expires)
+            self._entries.move_to_end(metar)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Forgets all reports."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the counters of the memo.
+
+        Returns:
+            A dictionary with size, hits, misses, evictions and the hit ratio.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+parseMemo = ParseMemo()
 
-def parseMETAR(metar):
+class TokenTable(dict):
+    """
+    Bounded memo of the values of the tokens of one group.
+
+    A METAR group takes only a few thousand distinct values, so after a few
+    reports almost every token is a single dict lookup instead of a pattern
+    match and conversion. Tokens which do not belong to the group are
+    remembered as None. The table is cleared once it holds maxsize tokens,
+    the values are immutable and may be shared between observations.
+    """
+    __slots__ = ("parse", "maxsize")
+
+    def __init__(self, parse, maxsize=TOKEN_TABLE_SIZE):
+        """
+        Args:
+            parse: The function converting a token into its value, or None if the token does not belong to the group.
+            maxsize: The maximum number of remembered tokens.
+        """
+        super().__init__()
+        self.parse = parse
+        self.maxsize = maxsize
+
+    def __missing__(self, token):
+        value = self.parse(token)
+        if len(self) >= self.maxsize:
+            self.clear()
+        self[token] = value
+        return value
+
+def parseMETAR(metar, reference=None, memo=parseMemo):
     """
     Parses a METAR string into a human-readable dictionary.
 
     Args:
         metar: The METAR string.
+        reference: The time the report is resolved against, see parseTime. Defaults to now.
+        memo: The ParseMemo to look up and fill, None parses every time.
 
     Returns:
         A dictionary containing parsed METAR data, or None if parsing fails.
     """
+    observation = parseObservation(metar, reference, memo)
+    if observation is None:
+        return None
+    return observation.to_dict()
 
-    metar = metar.upper().strip()  # Standardize input
-    parts = metar.split()
+def parseObservation(metar, reference=None, memo=parseMemo):
+    """
+    Parses a METAR string into a MetarObservation.
+
+    Reports which were parsed before are returned from the memo. The returned
+    observation may therefore be shared and must not be modified.
+
+    Args:
+        metar: The METAR string.
+        reference: The time the report is resolved against, see parseTime. Defaults to now.
+        memo: The ParseMemo to look up and fill, None parses every time.
+
+    Returns:
+        The MetarObservation, or None if parsing fails.
+    """
+    if reference is None:
+        reference = datetime.now(timezone.utc)
+    if memo is None:
+        return _parseObservation(metar, reference)
+    found, observation = memo.get(metar, reference)
+    if not found:
+        observation = _parseObservation(metar, reference)
+        memo.put(metar, observation)
+    return observation
+
+def _parseObservation(metar, reference):
+    # The tokens are classified in a single pass, each group is looked up in
+    # its TokenTable in the order the groups appear in a METAR.
+    parts = metar.upper().replace("=", " ").split()  # Standardize input, "=" terminates a report
+    count = len(parts)
 
-    parsed_data = {}
     nextIdx = 0
+    # the group being parsed, failures are counted by it. It is set before the
+    # first token of the group is read, so a report which ends early is
+    # counted by the group which is missing.
+    group = "station"
 
     try:
+        # the report type is optional
+        report_type = "METAR"
+        if parts[0] in REPORT_TYPES:
+            report_type = parts[0]
+            nextIdx = 1
+
         # Station Identifier
-        parsed_data["station"] = parts[nextIdx]
+        station = parts[nextIdx]
+        if not STATION_PATTERN.match(station):
+            raise ValueError(f"Invalid station: {station}")
         nextIdx += 1
 
         # Date and Time
-        parsed_data["time"] = parseTime(parts[nextIdx])
+        group = "time"
+        time = _resolveTime(parts[nextIdx], reference)
+        if time is None:
+            raise ValueError(f"Invalid time: {parts[nextIdx]}")
         nextIdx += 1
 
         # update information are optional
-        if re.match(r"^(AUTO|COR)$", parts[nextIdx].upper()):
-            parsed_data["update"] = parts[nextIdx]
+        group = "wind"
+        token = parts[nextIdx]
+        update = None
+        if token in UPDATE_CODES:
+            update = token
             nextIdx += 1
+            token = parts[nextIdx]
 
         # wind
-        parsed_data["wind"] = parseWind(parts[nextIdx])
+        wind_direction, wind_variable, wind_speed, wind_gust = WIND_TOKENS[token] or NO_WIND
         nextIdx += 1
 
         # optional wind variation
-        if re.match(r"(\d{3})V(\d{3})", parts[nextIdx]):
-            parsed_data["wind_variation"] = parseWindVariation(parts[nextIdx])
+        group = "visibility"
+        token = parts[nextIdx]
+        variation = WIND_VARIATION_TOKENS[token]
+        if variation is not None:
             nextIdx += 1
+            token = parts[nextIdx]
 
-        # Visibility
-        parsed_data["visibility"] = parseVisibility(parts[nextIdx])
-        nextIdx += 1
+        # Visibility, US reports may split it into a whole number and a fraction ("1 1/2SM")
+        if (nextIdx + 1 < count and WHOLE_NUMBER_PATTERN.match(token)
+                and VISIBILITY_FRACTION_PATTERN.match(parts[nextIdx + 1])):
+            visibility = round((int(token) + _statuteMiles(parts[nextIdx + 1])) * STATUTE_MILES_TO_METERS)
+            nextIdx += 2
+        else:
+            visibility = VISIBILITY_TOKENS[token]
+            nextIdx += 1
 
-        # optional Runway Visual Range (RVR) - more complex and optional, needs further refinement
+        # optional Runway Visual Range (RVR)
+        group = "rvr"
         rvrs = []
-        while (parts[nextIdx].startswith("R")):
-            rvrs.append(parseRVR(parts[nextIdx]))
+        while nextIdx < count:
+            value = RVR_TOKENS[parts[nextIdx]]
+            if value is None:
+                break
+            rvrs.append(value)
             nextIdx += 1
-        parsed_data["rvr"] = rvrs
 
-        # optional present weather
-        parsed_data["weather"] = parseWeatherCodes(parts[nextIdx])
-        if (parsed_data["weather"] != ""):
+        # optional present weather, one or more groups
+        group = "weather"
+        weather = []
+        while nextIdx < count:
+            value = WEATHER_TOKENS[parts[nextIdx]]
+            if value is None:
+                break
+            weather.append(value)
             nextIdx += 1
 
         # optional Cloud Cover
+        group = "clouds"
         clouds = []
-        while (re.match(r"(SKC|CLR|FEW|SCT|BKN|OVC)(\d{3})?", parts[nextIdx])):
-            clouds.append(parseClouds(parts[nextIdx]))
+        while nextIdx < count:
+            value = CLOUD_TOKENS[parts[nextIdx]]
+            if value is None:
+                break
+            clouds.append(value)
             nextIdx += 1
-        parsed_data["clouds"] = clouds
 
         # Temperature and Dew Point
-        parsed_data["temperatures"] = parseTemperatures(parts[nextIdx])
+        group = "temperature"
+        temperature, dew_point = TEMPERATURE_TOKENS[parts[nextIdx]] or NO_TEMPERATURES
         nextIdx += 1
 
         # QNH
-        parsed_data["QNH"] = parseQNH(parts[nextIdx])
+        group = "qnh"
+        qnh = QNH_TOKENS[parts[nextIdx]]
         nextIdx += 1
-       
-        return parsed_data
+
+        # recent weather, trends and remarks
+        group = "supplementary"
+        recent_weather, trends, remarks = _parseSupplementary(parts, nextIdx) if nextIdx < count else NO_SUPPLEMENTARY
+
+        return MetarObservation(station, time, report_type, update, wind_direction, wind_variable, wind_speed, wind_gust,
+                                variation, visibility, tuple(rvrs), tuple(weather), tuple(clouds),
+                                temperature, dew_point, qnh, recent_weather, trends, remarks)
     except Exception as e:
-        print(f"Error parsing METAR {metar}: {e}")
+        # the metrics pull in prometheus_client, a parse worker only loads it when a report fails
+        from metar_metrics import PARSE_FAILURES
+        PARSE_FAILURES.labels(group).inc()
+        logger.warning(f"Error parsing METAR {metar} at {group}: {e}")
         return None
 
-def parseTemperatures(metar):
+def _resolveTime(token, reference):
+    # A resolved time stays valid until the reference passes the next time
+    # with the same day of month, a fresh parse would resolve to that one
+    latest = reference + MAX_CLOCK_SKEW
+    resolved = RESOLVED_TIMES.get(token)
+    if resolved is not None and resolved[0] <= latest < resolved[1]:
+        return resolved[0]
+    time = parseTime(token, reference) if TIME_PATTERN.match(token) else None
+    if time is not None:
+        if len(RESOLVED_TIMES) >= TOKEN_TABLE_SIZE:
+            RESOLVED_TIMES.clear()
+        RESOLVED_TIMES[token] = (time, _nextTime(time))
+    return time
+
+def _nextTime(time):
+    year, month = time.year, time.month
+    # every day of month exists in one of the next twelve months
+    for _ in range(12):
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+        try:
+            return time.replace(year=year, month=month)
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid day of month: {time.day}")
+
+def _windToken(token):
+    match = WIND_PATTERN.match(token)
+    if not match:
+        return None
+    direction, speed, gust, unit = match.groups()
+    factor = SPEED_FACTORS[unit]
+    variable = direction == "VRB"
+    return (None if variable else int(direction), variable, int(int(speed) * factor),
+            int(int(gust) * factor) if gust else None)
+
+def _windVariationToken(token):
+    match = WIND_VARIATION_PATTERN.match(token)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def _rvrToken(token):
+    match = RVR_PATTERN.match(token)
+    return _rvrFromMatch(match) if match else None
+
+def _weatherToken(token):
+    match = WEATHER_PATTERN.match(token)
+    return _weatherFromMatch(match) if match else None
+
+def _cloudToken(token):
+    if token in SKY_CLEAR_CODES:
+        return CloudLayer(CLOUD_COVERS[token])
+    match = CLOUD_PATTERN.match(token)
+    return _cloudFromMatch(match) if match else None
+
+def _temperatureToken(token):
+    match = TEMPERATURE_PATTERN.match(token)
+    if not match:
+        return None
+    return convertTemp(match.group(1)), convertTemp(match.group(2)) if match.group(2) else None
+
+def _parseSupplementary(parts, nextIdx):
+    # Groups after the QNH in any order. Groups which are not decoded, like
+    # wind shear or a second altimeter setting, are skipped.
+    recent = []
+    trends = []
+    remarks = None
+    trend = None
+    count = len(parts)
+    while nextIdx < count:
+        token = parts[nextIdx]
+        if token == "RMK":
+            remarks = " ".join(parts[nextIdx + 1:]) or None
+            break
+        if token in TREND_CODES:
+            if trend is not None:
+                trends.append(TREND_TOKENS[tuple(parts[trend:nextIdx])])
+            trend = nextIdx
+        elif trend is None and token.startswith("RE"):
+            weather = WEATHER_TOKENS[token[2:]]
+            if weather is not None:
+                recent.append(weather)
+        nextIdx += 1
+    if trend is not None:
+        trends.append(TREND_TOKENS[tuple(parts[trend:nextIdx])])
+    return tuple(recent), tuple(trends), remarks
+
+def _trendTokens(tokens):
+    trend = {"kind": tokens[0]}
+    for token in tokens[1:]:
+        _parseTrendGroup(token, trend)
+    return Trend(**trend)
+
+def _parseTrendGroup(token, trend):
+    match = TREND_TIME_PATTERN.match(token)
+    if match:
+        trend[TREND_TIMES[match.group(1)]] = match.group(2)
+        return
+    match = WIND_PATTERN.match(token)
+    if match:
+        direction, speed, gust, unit = match.groups()
+        factor = SPEED_FACTORS[unit]
+        if direction == "VRB":
+            trend["wind_variable"] = True
+        else:
+            trend["wind_direction"] = int(direction)
+        trend["wind_speed"] = int(int(speed) * factor)
+        if gust:
+            trend["wind_gust"] = int(int(gust) * factor)
+        return
+    if token == "NSW":
+        trend["no_significant_weather"] = True
+        return
+    if token in SKY_CLEAR_CODES:
+        trend["clouds"] = trend.get("clouds", ()) + (CloudLayer(CLOUD_COVERS[token]),)
+        return
+    match = CLOUD_PATTERN.match(token)
+    if match:
+        trend["clouds"] = trend.get("clouds", ()) + (_cloudFromMatch(match),)
+        return
+    visibility = parseVisibility(token)
+    if visibility is not None:
+        trend["visibility"] = visibility
+        return
+    weather = WEATHER_TOKENS[token]
+    if weather is not None:
+        trend["weather"] = trend.get("weather", ()) + (weather,)
+
+def iterReports(text):
     """
-    Parses temperature and dew point from a METAR temperature string.
+    Splits a body with many METARs into single reports while reading it.
+
+    Every report starts on a new line. Indented lines continue the report
+    before them, as in the line wrapped bulletins of the NOAA servers, and
+    a trailing "=" ends a report.
 
     Args:
-        metar: The temperature string (e.g., "12/11", "M02/M05", "00/M01").
+        text: The body as string, or an iterable of lines like an open file.
 
-    Returns:
-        A tuple containing temperature and dew point as floats, or None if parsing fails.
+    Yields:
+        Every report as a single line, including a leading METAR or SPECI.
     """
-    try:
-        temp_dew = metar.split("/")
-        if len(temp_dew) != 2:
-            return None  # Invalid format
+    lines = text.splitlines() if isinstance(text, str) else text
+    report = None
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            if report is not None:
+                yield report
+                report = None
+            continue
+        if report is not None and line[0].isspace():
+            report = f"{report} {stripped}"
+        else:
+            if report is not None:
+                yield report
+            report = stripped
+        if report.endswith("="):
+            yield report.rstrip("=").rstrip()
+            report = None
+    if report is not None:
+        yield report
+
+def parseReports(text, reference=None, memo=parseMemo):
+    """
+    Parses every report of a body with many METARs in a single pass.
+
+    Args:
+        text: The body as string, or an iterable of lines like an open file.
+        reference: The time the reports are resolved against, see parseTime. Defaults to now.
+        memo: The ParseMemo to look up and fill, None parses every report.
 
-        temperature_str = temp_dew[0]
-        dew_point_str = temp_dew[1]
+    Yields:
+        The MetarObservation of every report, reports which fail to parse
+        are logged and skipped.
+    """
+    if reference is None:
+        reference = datetime.now(timezone.utc)
+    for report in iterReports(text):
+        observation = parseObservation(report, reference, memo)
+        if observation is not None:
+            yield observation
 
-        temperature = convertTemp(temperature_str)
-        dew_point = convertTemp(dew_point_str)
+def parseTemperatures(metar):
+    """
+    Parses temperature and dew point from a METAR temperature string.
 
-        return {"temperature": temperature, "dew_point": dew_point}
+    Args:
+        metar: The temperature string (e.g., "12/11", "M02/M05", "00/M01").
 
-    except (ValueError, AttributeError):
-        return None  # Parsing error
+    Returns:
+        A dictionary containing temperature and dew point as ints, or None if parsing fails.
+    """
+    match = TEMPERATURE_PATTERN.match(metar)
+    if not match:
+        return None  # Invalid format
+
+    dew_point = match.group(2)
+    return {
+        "temperature": convertTemp(match.group(1)),
+        "dew_point": convertTemp(dew_point) if dew_point else None,
+    }
 
 def convertTemp(temperature_str):
     """
@@ -113,7 +544,7 @@ def convertTemp(temperature_str):
     Returns:
         The temperature as a int.
     """
-    if temperature_str.startswith("M"):
+    if temperature_str[0] == "M":
         return -int(temperature_str[1:])
     else:
         return int(temperature_str)
@@ -128,31 +559,21 @@ def parseClouds(metar):
     Returns:
         A descriptive string of the cloud ceiling.
     """
+    if metar in SKY_CLEAR_CODES:
+        return CloudLayer(CLOUD_COVERS[metar]).describe()
 
-    cloud_types = {
-        "CLR": "clear",
-        "SKC": "sky clear",
-        "FEW": "few clouds at",
-        "SCT": "scattered clouds at",
-        "BKN": "broken clouds at",
-        "OVC": "overcast at",
-        "VV": "vertical visibility",
-    }
-
-    if metar[:2] == "VV":
-        height = int(metar[2:]) * 100
-        return f"vertical visibility {height}ft"
-    
-    if (metar[:3] == "CLR"):
-        return f"clear of clouds below 12000ft"
-
-    if metar[:3] in cloud_types:
-        cloud_type = cloud_types[metar[:3]]
-        height = int(metar[3:]) * 100
-        return f"{cloud_type} {height}ft"
+    match = CLOUD_PATTERN.match(metar)
+    if match:
+        return _cloudFromMatch(match).describe()
 
     return "unknown cloud condition"
 
+def _cloudFromMatch(match):
+    cover, height, suffix = match.groups()
+    return CloudLayer(CLOUD_COVERS[cover],
+                      None if height == "///" else int(height) * 100,
+                      CONVECTIVE_CLOUDS.get(suffix))
+
 def parseWeatherCodes(metar):
     """
     Parses weather codes from a METAR and returns a descriptive string.
@@ -163,99 +584,49 @@ def parseWeatherCodes(metar):
     Returns:
         A descriptive string of the weather conditions.
     """
+    match = WEATHER_PATTERN.match(metar)
+    if not match:
+        return ""
+    return _weatherFromMatch(match).describe()
 
-    weather_map = {
-        "-": "light ",
-        "+": "heavy ",
-        "VC": "vicinity ",
-        "MI": "shallow ",
-        "BC": "patches of ",
-        "DR": "low drifting ",
-        "BL": "blowing ",
-        "SH": "showers ",
-        "TS": "thunderstorm ",
-        "FZ": "freezing ",
-        "DZ": "drizzle",
-        "RA": "rain",
-        "SN": "snow",
-        "SG": "snow grains",
-        "IC": "ice crystals",
-        "PL": "ice pellets",
-        "GR": "hail",
-        "GS": "small hail/snow pellets",
-        "UP": "unknown precipitation",
-        "BR": "mist",
-        "FG": "fog",
-        "FU": "smoke",
-        "VA": "volcanic ash",
-        "DU": "widespread dust",
-        "SA": "sand",
-        "HZ": "haze",
-        "PO": "dust/sand whirls",
-        "SQ": "squalls",
-        "FC": "funnel cloud/tornado/waterspout",
-        "SS": "sandstorm",
-        "DS": "duststorm",
-    }
-
-    description = ""
-    i = 0
-    while i < len(metar):
-        if metar[i:i + 2] in weather_map:
-            description += weather_map[metar[i:i + 2]]
-            i += 2
-        elif metar[i] in weather_map:
-            description += weather_map[metar[i]]
-            i += 1
-        else:
-            i += 1 #handle unexpected characters, just in case.
-
-    return description.strip()
+def _weatherFromMatch(match):
+    intensity, descriptor, phenomena = match.groups()
+    return WeatherGroup(INTENSITIES.get(intensity),
+                        DESCRIPTORS.get(descriptor),
+                        tuple(PHENOMENA[phenomena[i:i + 2]] for i in range(0, len(phenomena), 2)))
 
 def parseRVR(metar):
     """
     Parses a single RVR string into a dictionary and converts distances to meters.
 
     Args:
-        metar: The RVR string (e.g., "R04R/2600FT/D", "R28R/2000V3000FT").
+        metar: The RVR string (e.g., "R04R/2600FT/D", "R28R/2000V3000FT", "R16/P1500N").
 
     Returns:
         A dictionary containing RVR data with distances in meters, or None if parsing fails.
     """
-    metar = metar.upper()
-
-    rvr_match = re.match(r"R(\d{2}[LCR]?)/P?(\d{4})V?P?(\d{4})?(FT|M)?(/U|/D|/N)?", metar)
-
-    if not rvr_match:
+    match = RVR_PATTERN.match(metar.upper())
+    if not match:
         return None
+    return _rvrFromMatch(match).to_dict()
 
-    runway = rvr_match.group(1)
-    min_range = int(rvr_match.group(2))
-    max_range = int(rvr_match.group(3)) if rvr_match.group(3) else min_range
-    unit = rvr_match.group(4) if rvr_match.group(4) else "FT"
-    trend = rvr_match.group(5)
+def _rvrFromMatch(match):
+    runway, min_range, max_range, unit, trend = match.groups()
+    min_range = int(min_range)
+    max_range = int(max_range) if max_range else min_range
 
     if unit == "FT":
-        min_range = round(min_range * 0.3048)  # Convert feet to meters
-        max_range = round(max_range * 0.3048)
-        unit = "M" #set unit to M
-
-    rvr_dict = {
-        "runway": runway,
-        "min_range": min_range,
-        "max_range": max_range,
-        "unit": unit,
-        "trend": trend[1] if trend else None, #remove leading slash
-    }
+        min_range = round(min_range * FEET_TO_METERS)  # Convert feet to meters
+        max_range = round(max_range * FEET_TO_METERS)
 
-    return rvr_dict
+    return RunwayVisualRange(runway, min_range, max_range, trend)
 
 def parseVisibility(metar):
     """
     Normalizes visibility to meters.
 
     Args:
-        visibilimetarty_str: The visibility string (e.g., "10SM", "9999", "1600", "1/2SM").
+        metar: The visibility string (e.g., "10SM", "9999", "1600", "1/2SM").
 
     Returns:
         The visibility in meters as an integer, or None if parsing fails.
@@ -264,18 +635,25 @@ def parseVisibility(metar):
 
     if metar == "9999" or metar == "CAVOK":
         return 10000  # 10km+ is considered 10000 meters
-    elif re.match(r"^\d{4}$", metar):
-        return int(metar)  # Already in meters
-    elif re.match(r"^\d+SM$", metar):
-        sm_value = int(re.match(r"^\d+SM$", metar).group(0)[:-2]) #remove SM, and convert to int
-        return round(sm_value * 1609.34)  # Convert statute miles to meters
-    elif re.match(r"^\d+\/\d+SM$", metar):
-        numerator, denominator = map(int, re.match(r"(\d+)/(\d+)SM$", metar).groups())
-        sm_value = numerator / denominator
-        return round(sm_value * 1609.34)  # Convert statute miles to meters
-    else:
-        return None
-    
+
+    match = VISIBILITY_METERS_PATTERN.match(metar)
+    if match:
+        meters = int(match.group(1))  # Already in meters
+        return 10000 if meters == 9999 else meters
+
+    match = VISIBILITY_SM_PATTERN.match(metar)
+    if match:
+        return round(int(match.group(2)) * STATUTE_MILES_TO_METERS)  # Convert statute miles to meters
+
+    if VISIBILITY_FRACTION_PATTERN.match(metar):
+        return round(_statuteMiles(metar) * STATUTE_MILES_TO_METERS)
+
+    return None
+
+def _statuteMiles(fraction):
+    match = VISIBILITY_FRACTION_PATTERN.match(fraction)
+    return int(match.group(2)) / int(match.group(3))
+
 def parseWindVariation(metar):
     """
     Parses wind variation data from a METAR string.
@@ -287,15 +665,12 @@ def parseWindVariation(metar):
         A dictionary containing the minimum and maximum wind directions,
         or None if parsing fails.
     """
-    metar = metar.upper()
-
-    variation_match = re.match(r"(\d{3})V(\d{3})", metar)
-    if variation_match:
-        variation_data = {
-            "min_direction": int(variation_match.group(1)),
-            "max_direction": int(variation_match.group(2)),
+    match = WIND_VARIATION_PATTERN.match(metar.upper())
+    if match:
+        return {
+            "min_direction": int(match.group(1)),
+            "max_direction": int(match.group(2)),
         }
-        return variation_data
     else:
         return None
 
@@ -311,34 +686,22 @@ def parseWind(metar):
         or None if parsing fails.
     """
     metar = metar.upper()
+    wind = _windFromMatch(WIND_PATTERN.match(metar))
+    if wind is None and metar.startswith("VRB"):
+        return {"direction": "VRB", "speed": None, "unit": None, "gust": None}
+    return wind
 
-    # Variable wind direction
-    if metar.startswith("VRB"):
-        wind_match = re.match(r"VRB(\d{2,3})(G(\d{2,3}))?(KT|MPS|KMH)", metar)
-        if wind_match:
-            wind_data = {
-                "direction": "VRB",
-                "speed": int(wind_match.group(1)),
-                "unit": wind_match.group(2),
-                "gust": int(wind_match.group(4)) if wind_match.group(4) else None,
-            }
-            return convertSpeedsToKT(wind_data)
-        else:
-            return {"direction": "VRB", "speed": None, "unit": None, "gust": None}
-
-    # Regular wind direction
-    wind_match = re.match(r"(\d{3})(\d{2,3})(G(\d{2,3}))?(KT|MPS|KMH)", metar)
-    if wind_match:
-        wind_data = {
-            "direction": int(wind_match.group(1)),
-            "speed": int(wind_match.group(2)),
-            "unit": wind_match.group(3),
-            "gust": int(wind_match.group(4)) if wind_match.group(4) else None,
-        }
-        return convertSpeedsToKT(wind_data)
-    else:
+def _windFromMatch(match):
+    if not match:
         return None
-    
+    direction, speed, gust, unit = match.groups()
+    return convertSpeedsToKT({
+        "direction": direction if direction == "VRB" else int(direction),
+        "speed": int(speed),
+        "unit": unit,
+        "gust": int(gust) if gust else None,
+    })
+
 def convertSpeedsToKT(wind_data):
     """
     Converts wind speeds from MPS or KMH to KT.
@@ -350,36 +713,56 @@ def convertSpeedsToKT(wind_data):
         The wind data dictionary with speeds converted to KT.
     """
     if wind_data["unit"] == "MPS":
-        wind_data["speed"] = int(wind_data["speed"] * 1.94384)
-        wind_data["unit"] = "KT"
+        factor = MPS_TO_KT
     elif wind_data["unit"] == "KMH":
-        wind_data["speed"] = int(wind_data["speed"] * 0.539957)
-        wind_data["unit"] = "KT"
+        factor = KMH_TO_KT
+    else:
+        return wind_data
+    wind_data["speed"] = int(wind_data["speed"] * factor)
+    if wind_data["gust"] is not None:
+        wind_data["gust"] = int(wind_data["gust"] * factor)
+    wind_data["unit"] = "KT"
     return wind_data
 
-def parseTime(metar):
+def parseTime(metar, reference=None):
     """
     Parses a METAR time string (DDHHMMZ) into a datetime object.
 
+    A METAR only carries the day of month, the month and year are those of
+    the latest matching time not later than the reference time plus
+    MAX_CLOCK_SKEW. A report from the 31st parsed on the 1st therefore
+    belongs to the previous month, also across a year boundary.
+
     Args:
         metar: The METAR time string (e.g., "202200Z").
+        reference: The reference time, an aware datetime. Defaults to now.
 
     Returns:
         A datetime object in UTC, or None if parsing fails.
     """
+    if reference is None:
+        reference = datetime.now(timezone.utc)
     try:
-        day = int(metar[:2])
-        hour = int(metar[2:4])
-        minute = int(metar[4:6])
-
-        now = datetime.now(timezone.utc)
-        year = now.year
-        month = now.month
-
-        return datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+        return _utcTime(int(metar[:2]), int(metar[2:4]), int(metar[4:6]), reference)
     except (ValueError, IndexError):
         return None
 
+def _utcTime(day, hour, minute, reference):
+    latest = reference.astimezone(timezone.utc) + MAX_CLOCK_SKEW
+    year, month = latest.year, latest.month
+    # go back at most a year, every day of month exists in one of the last twelve months
+    for _ in range(12):
+        try:
+            time = datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+        except ValueError:
+            if not 1 <= day <= 31:
+                raise
+            time = None
+        if time is not None and time <= latest:
+            return time
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    raise ValueError(f"Invalid day of month: {day}")
+
 def parseQNH(metar):
     """
     Parses the QNH (altimeter setting) from a METAR and converts it to millibars (mbar).
@@ -388,17 +771,24 @@ def parseQNH(metar):
         metar: The QNH string (e.g., "A3015", "Q1013").
 
     Returns:
-        The QNH in millibars as a float, or None if parsing fails.
+        The QNH in millibars as an int, or None if parsing fails.
     """
-    try:
-        if metar.startswith("A"):
-            inches_hg = int(metar[1:])
-            mbar = inches_hg * 0.338639
-            return int(round(mbar, 0)) #round to 1 decimal place.
-        elif metar.startswith("Q"):
-            return int(metar[1:])
-        else:
-            return None  # Invalid format
-
-    except (ValueError, AttributeError):
-        return None  # Parsing error
\ No newline at end of file
+    match = QNH_PATTERN.match(metar)
+    if not match:
+        return None  # Invalid format
+    if match.group(1) == "A":
+        return int(round(int(match.group(2)) * INHG_HUNDREDTHS_TO_MBAR, 0))
+    return int(match.group(2))
+
+WIND_TOKENS = TokenTable(_windToken)
+WIND_VARIATION_TOKENS = TokenTable(_windVariationToken)
+VISIBILITY_TOKENS = TokenTable(parseVisibility)
+RVR_TOKENS = TokenTable(_rvrToken)
+WEATHER_TOKENS = TokenTable(_weatherToken)
+CLOUD_TOKENS = TokenTable(_cloudToken)
+TEMPERATURE_TOKENS = TokenTable(_temperatureToken)
+QNH_TOKENS = TokenTable(parseQNH)
+# the trend groups keyed by their tokens from the trend code on
+TREND_TOKENS = TokenTable(_trendTokens)
+# token to the last time it resolved to and the next time with the same day, see _resolveTime
+RESOLVED_TIMES = {}
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metar_parser as mp
+import metar_crawler as mc
+import metar_spool
+import metar_broker
+import metar_cache
+import metar_history
+from metar_metrics import PARSE_SECONDS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Marks the end of the input of a stage queue
+_DONE = object()
+
+def writeBatch(metars, bucket="metar"):
+    """
+    Default writer of the pipeline, appends a batch of METARs to the spool
+    of the bucket, its drainer writes them to InfluxDB.
+
+    Args:
+        metars: A list of parsed METAR dictionaries.
+        bucket: The InfluxDB bucket.
+    """
+    metar_spool.spoolMetars(metars, bucket)
+
+class CycleResult:
+    """
+    Counters of a single ingestion cycle, requests counts upstream requests,
+    the other counters count stations or METARs.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.fetched = 0
+        self.unchanged = 0
+        self.fetch_failures = 0
+        self.timeouts = 0
+        self.rate_limited = 0
+        self.parsed = 0
+        self.parse_failures = 0
+        self.written = 0
+        self.write_failures = 0
+        self.duration = 0.0
+
+    def __repr__(self):
+        return (f"CycleResult(requests={self.requests}, fetched={self.fetched}, unchanged={self.unchanged}, fetch_failures={self.fetch_failures}, "
+                f"timeouts={self.timeouts}, rate_limited={self.rate_limited}, parsed={self.parsed}, parse_failures={self.parse_failures}, "
+                f"written={self.written}, write_failures={self.write_failures}, duration={self.duration:.3f}s)")
+
+class IngestionPipeline:
+    """
+    Asyncio based ingestion engine which fetches, parses and writes METARs
+    concurrently.
+
+    The three stages are connected by bounded queues. A slow stage fills its
+    input queue and thereby throttles the stage before it, so the memory of a
+    cycle stays bounded no matter how many stations are processed. Stations
+    are fetched in chunks of up to max_ids with one upstream request each, the
+    response is split into the reports of the stations. Fetching and writing
+    are blocking I/O and run on a thread pool each, so hanging fetches cannot
+    take the threads of the writers. Parsing is CPU bound and
+    runs in a single worker on the event loop, more threads would only
+    contend for the GIL. Parsed observations are appended to the history,
+    cached and published before they are written.
+    """
+
+    def __init__(self,
+                 fetch=mc.conditionalGet,
+                 parse=mp.parseObservation,
+                 write=writeBatch,
+                 cache=metar_cache.latestObservations,
+                 history=metar_history.history,
+                 reports=mc.lastReports,
+                 broker=metar_broker.observations,
+                 fetch_concurrency=4,
+                 write_concurrency=2,
+                 queue_size=256,
+                 write_batch_size=100,
+                 write_flush_interval=1.0,
+                 max_ids=mc.MAX_IDS_PER_REQUEST,
+                 fetch_timeout=10.0):
+        """
+        Args:
+            fetch: Callable taking the comma separated ids of a chunk and the seconds the fetch may take, returns the
+                response body with the METARs of the chunk and raises an IOError if the request fails, or
+                mc.RateLimited if the rate limit left no time for it.
+            parse: Callable returning the MetarObservation of a raw METAR or None.
+            write: Callable storing a list of parsed METARs.
+            cache: The LatestObservationCache parsed METARs are written through to, or None.
+            history: The HistoryStore observations are appended to, or None.
+            reports: The ReportTracker used to skip unchanged reports, or None to process every report. A report
+                is remembered once its batch is written.
+            broker: The ObservationBroker parsed METARs are published to, or None.
+            fetch_concurrency: Number of chunks fetched in parallel.
+            write_concurrency: Number of batches written in parallel.
+            queue_size: Capacity of each queue between two stages.
+            write_batch_size: Maximum number of METARs per write call.
+            write_flush_interval: Seconds after which a partial batch is written.
+            max_ids: The maximum number of stations per upstream request.
+            fetch_timeout: Seconds after which the fetch of a chunk is abandoned, also the deadline of fetch.
+        """
+        self.fetch = fetch
+        self.parse = parse
+        self.write = write
+        self.cache = cache
+        self.history = history
+        self.reports = reports
+        self.broker = broker
+        self.fetch_concurrency = fetch_concurrency
+        self.write_concurrency = write_concurrency
+        self.queue_size = queue_size
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        self.max_ids = max_ids
+        self.fetch_timeout = fetch_timeout
+        self._fetch_executor = ThreadPoolExecutor(max_workers=fetch_concurrency, thread_name_prefix="ingestion-fetch")
+        self._write_executor = ThreadPoolExecutor(max_workers=write_concurrency, thread_name_prefix="ingestion-write")
+
+    def run(self, icaos):
+        """
+        Runs one ingestion cycle from synchronous code, e.g. a scheduler job.
+
+        Args:
+            icaos: An iterable of ICAO airport codes.
+
+        Returns:
+            The CycleResult of the cycle.
+        """
+        return asyncio.run(self.runCycle(icaos))
+
+    async def runCycle(self, icaos):
+        """
+        Fetches, parses and writes the METARs of all given stations.
+
+        Args:
+            icaos: An iterable of ICAO airport codes.
+
+        Returns:
+            The CycleResult of the cycle.
+        """
+        result = CycleResult()
+        start = time.monotonic()
+        fetch_queue = asyncio.Queue(self.queue_size)
+        parse_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.queue_size)
+
+        fetchers = [asyncio.create_task(self._fetchWorker(fetch_queue, parse_queue, result))
+                    for _ in range(self.fetch_concurrency)]
+        parsers = [asyncio.create_task(self._parseWorker(parse_queue, write_queue, result))]
+        writers = [asyncio.create_task(self._writeWorker(write_queue, result))
+                   for _ in range(self.write_concurrency)]
+
+        for chunk in mc.chunkStations(icaos, max_ids=self.max_ids):
+            await fetch_queue.put(chunk)
+        await self._finishStage(fetch_queue, fetchers, parse_queue, len(parsers))
+        await self._finishStage(parse_queue, parsers, write_queue, len(writers))
+        await asyncio.gather(*writers)
+
+        result.duration = time.monotonic() - start
+        logger.info(f"Ingestion cycle finished: {result}")
+        return result
+
+    def close(self):
+        """Releases the worker threads."""
+        self._fetch_executor.shutdown(wait=False, cancel_futures=True)
+        self._write_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _finishStage(self, queue, workers, next_queue, next_workers):
+        # stop the workers of a stage, once they are done signal the next stage
+        for _ in workers:
+            await queue.put(_DONE)
+        await asyncio.gather(*workers)
+        for _ in range(next_workers):
+            await next_queue.put(_DONE)
+
+    async def _fetchWorker(self, fetch_queue, parse_queue, result):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await fetch_queue.get()
+            if chunk is _DONE:
+                return
+            ids = ",".join(chunk)
+            result.requests += 1
+            try:
+                # the fetch gives up on its own by the deadline, an abandoned fetch does not keep its thread for long
+                text = await asyncio.wait_for(
+                    loop.run_in_executor(self._fetch_executor, self.fetch, ids, self.fetch_timeout),
+                    self.fetch_timeout)
+            except asyncio.TimeoutError:
+                result.timeouts += len(chunk)
+                logger.error(f"Timeout fetching METARs for {len(chunk)} airports: {ids}")
+                continue
+            except mc.RateLimited as e:
+                # no request was sent, nothing is remembered, so the next cycle fetches the stations again
+                result.rate_limited += len(chunk)
+                logger.warning(f"Rate limited, {len(chunk)} airports are fetched by the next cycle: {e}")
+                continue
+            except Exception as e:
+                result.fetch_failures += len(chunk)
+                logger.error(f"Error fetching METARs for {len(chunk)} airports: {ids}: {e}")
+                continue
+            # the latest report of every station, stations without a report are missing
+            reports = mc.splitMETARs(text or "")
+            for icao in chunk:
+                raw = reports.get(icao)
+                if raw is None:
+                    result.fetch_failures += 1
+                    continue
+                result.fetched += 1
+                if self.reports is not None and not self.reports.changed(icao, raw):
+                    result.unchanged += 1
+                    continue
+                await parse_queue.put((icao, raw))
+
+    async def _parseWorker(self, parse_queue, write_queue, result):
+        while True:
+            item = await parse_queue.get()
+            if item is _DONE:
+                return
+            icao, raw = item
+            try:
+                start = time.perf_counter()
+                observation = self.parse(raw)
+                PARSE_SECONDS.observe(time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Error parsing METAR for airport: {icao}: {e}")
+                observation = None
+            if observation is None:
+                result.parse_failures += 1
+                continue
+            if self.history is not None:
+                self.history.append(observation)
+            # the same JSON ready dictionary as app.processReport
+            metar = observation.to_json()
+            result.parsed += 1
+            if self.cache is not None:
+                metar_cache.storeMetar(metar, self.cache)
+            if self.broker is not None:
+                metar_broker.publishMetar(metar, self.broker)
+            await write_queue.put((icao, raw, metar))
+
+    async def _writeWorker(self, write_queue, result):
+        loop = asyncio.get_running_loop()
+        batch = []
+        done = False
+        while not done:
+            try:
+                timeout = self.write_flush_interval if batch else None
+                item = await asyncio.wait_for(write_queue.get(), timeout)
+                if item is _DONE:
+                    done = True
+                else:
+                    batch.append(item)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                if not done and len(batch) < self.write_batch_size:
+                    continue
+            if not batch:
+                continue
+            try:
+                await loop.run_in_executor(self._write_executor, self.write, [metar for _, _, metar in batch])
+                result.written += len(batch)
+            except Exception as e:
+                result.write_failures += len(batch)
+                logger.error(f"Error writing {len(batch)} METARs: {e}")
+            else:
+                # only stored reports are skipped as unchanged, a failed batch is processed again next cycle
+                if self.reports is not None:
+                    for icao, raw, _ in batch:
+                        self.reports.remember(icao, raw)
+            batch = []
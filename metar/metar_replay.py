@@ -0,0 +1,512 @@
+"""
+Replay mode for load tests of the ingestion without the real upstream.
+
+ReplayUpstream is a local stub of the aviationweather.gov METAR API which
+serves recorded reports, by default bench_corpus.txt, for any station. Every
+cycle a station gets the next report of the corpus with its ICAO code and a
+new observation time, so the ingestion sees changed reports. The stub limits
+its request rate, delays its responses and answers a configurable share of
+requests with errors or not at all.
+
+MemorySink is an in-memory stand-in for the InfluxDB write API, which keeps
+the line protocol it receives.
+
+runLoad drives simulated stations through app.process and the write path of
+the scheduler (cache, broker, spool and its drainer) into the sink and
+reports the sustained throughput and the latency percentiles of process.
+
+Usage:
+    python metar_replay.py load --stations 500 --cycles 3 --concurrency 16 --errors 500=0.02,timeout=0.01
+    python metar_replay.py serve --port 8090 --sink-port 8096
+"""
+import argparse
+import configparser
+import gzip
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import metar_parser as mp
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_corpus.txt")
+METAR_PATH = "/api/data/metar"
+
+# Minutes between the observation times of two cycles, the times repeat after a day
+CYCLE_MINUTES = 30
+CYCLES_PER_DAY = 24 * 60 // CYCLE_MINUTES
+
+TIME_GROUP_PATTERN = re.compile(r"^\d{6}Z$")
+STATION_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def loadCorpus(path=CORPUS_FILE):
+    """
+    Reads recorded METARs, one report per line, lines starting with # are comments.
+
+    Args:
+        path: The path of the corpus file.
+
+    Returns:
+        The list of reports.
+    """
+    with open(path, encoding="ascii") as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith("#")]
+
+def stationCode(index):
+    """
+    Returns the ICAO code of a simulated station, Z000 to ZZZZ.
+
+    Args:
+        index: The index of the station, below 36 ** 3.
+
+    Returns:
+        The four letter code.
+    """
+    code = ""
+    for _ in range(3):
+        index, digit = divmod(index, len(STATION_ALPHABET))
+        code = STATION_ALPHABET[digit] + code
+    return "Z" + code
+
+def parseErrors(text):
+    """
+    Parses an error mix like "500=0.02,429=0.01,timeout=0.005".
+
+    Args:
+        text: Comma separated status codes or "timeout" with the share of requests.
+
+    Returns:
+        A dictionary mapping status codes and "timeout" to shares.
+
+    Raises:
+        ValueError: If the text is malformed or the shares exceed 1.
+    """
+    errors = {}
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        kind, _, share = item.partition("=")
+        errors["timeout" if kind == "timeout" else int(kind)] = float(share)
+    if sum(errors.values()) > 1:
+        raise ValueError(f"The error shares of {text} exceed 1")
+    return errors
+
+def percentile(values, fraction):
+    """Returns the nearest rank percentile of sorted values, None if there are none"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+class _UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, Nagle would delay every response by the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        replay = self.server.replay
+        url = urlparse(self.path)
+        ids = parse_qs(url.query).get("ids", [""])[0]
+        outcome = replay._outcome()
+        if outcome == "timeout":
+            # hold the request until the client gives up, the connection is closed without response
+            replay._stopped.wait(replay.hang)
+            self.close_connection = True
+            return
+        if replay.latency or replay.jitter:
+            time.sleep(replay.latency + replay._random(replay.jitter))
+        if url.path != METAR_PATH:
+            outcome = 404
+        body = b""
+        if outcome == 200:
+            body = replay.body(ids.split(",")).encode()
+        self.send_response(outcome)
+        self.send_header("Content-Type", "text/plain")
+        if outcome in (429, 503):
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ReplayUpstream:
+    """
+    Serves recorded METARs like the upstream API at GET /api/data/metar?ids=...
+
+    Every station is mapped to a report of the corpus by a hash of its code,
+    advance moves all stations to their next report. Requests beyond rate per
+    second are answered with 429, a share of the others with the statuses of
+    errors or, for "timeout", not at all. All methods are thread safe.
+    """
+
+    def __init__(self, corpus=None, rate=None, latency=0.0, jitter=0.0, errors=None, hang=15.0,
+                 cycle_seconds=None, seed=None, port=0):
+        """
+        Args:
+            corpus: The list of recorded reports, defaults to bench_corpus.txt.
+            rate: The maximum requests per second, None for no limit.
+            latency: Seconds every response is delayed.
+            jitter: Maximum random seconds added to the latency.
+            errors: A dictionary mapping status codes and "timeout" to the share of requests.
+            hang: Seconds a "timeout" request is held open.
+            cycle_seconds: Advance to the next cycle every this many seconds, None to advance by calls of advance.
+            seed: The seed of the random error mix and jitter.
+            port: The port to listen on, 0 for any free port.
+        """
+        self.corpus = corpus or loadCorpus()
+        self.rate = rate
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(errors or {})
+        self.hang = hang
+        self.cycle_seconds = cycle_seconds
+        self.responses = {}
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        # the observation times of a day of cycles all lie in the past
+        self.epoch = now - timedelta(days=1, minutes=now.minute % CYCLE_MINUTES)
+        self._cycle = 0
+        self._started = time.monotonic()
+        self._stopped = threading.Event()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = None
+        self._window_requests = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _UpstreamHandler)
+        self._server.replay = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """The METAR URL of the stub, e.g. for metar_crawler.METAR_URL"""
+        return f"http://127.0.0.1:{self._server.server_port}{METAR_PATH}"
+
+    @property
+    def cycle(self):
+        """The number of the current cycle"""
+        if self.cycle_seconds:
+            return int((time.monotonic() - self._started) / self.cycle_seconds)
+        return self._cycle
+
+    def start(self):
+        """Serves requests in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="replay-upstream", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving, hanging requests are released"""
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def advance(self):
+        """Moves every station to its next report"""
+        with self._lock:
+            self._cycle += 1
+
+    def report(self, icao, cycle=None):
+        """
+        Returns the report of a station in a cycle.
+
+        Args:
+            icao: The ICAO code of the station.
+            cycle: The cycle, defaults to the current one.
+
+        Returns:
+            The raw METAR with the code of the station and the observation time of the cycle.
+        """
+        cycle = self.cycle if cycle is None else cycle
+        tokens = self.corpus[(zlib.crc32(icao.encode()) + cycle) % len(self.corpus)].split()
+        first = 1 if tokens[0] in mp.REPORT_TYPES else 0
+        tokens = tokens[first:]
+        tokens[0] = icao
+        if len(tokens) > 1 and TIME_GROUP_PATTERN.match(tokens[1]):
+            observed = self.epoch + timedelta(minutes=CYCLE_MINUTES * (cycle % CYCLES_PER_DAY))
+            tokens[1] = observed.strftime("%d%H%MZ")
+        return " ".join(tokens)
+
+    def body(self, icaos):
+        """Returns the response body of the ids parameter, one report per line"""
+        cycle = self.cycle
+        return "\n".join(self.report(icao.strip().upper(), cycle) for icao in icaos if icao.strip())
+
+    def _random(self, scale):
+        with self._lock:
+            return self._rng.random() * scale
+
+    def _outcome(self):
+        # the status of a request, or "timeout"
+        with self._lock:
+            outcome = 200
+            if self.rate is not None:
+                window = int(time.monotonic())
+                if window != self._window:
+                    self._window, self._window_requests = window, 0
+                self._window_requests += 1
+                if self._window_requests > self.rate:
+                    outcome = 429
+            if outcome == 200 and self.errors:
+                draw = self._rng.random()
+                for kind, share in self.errors.items():
+                    if draw < share:
+                        outcome = kind
+                        break
+                    draw -= share
+            self.responses[outcome] = self.responses.get(outcome, 0) + 1
+            return outcome
+
+class _SinkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        sink = self.server.sink
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        if url.path == "/api/v2/write":
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            bucket = parse_qs(url.query).get("bucket", [""])[0]
+            sink._store(bucket, body.decode().splitlines())
+            self._respond(204)
+        elif url.path == "/api/v2/query":
+            # no data, the query API reads an empty result
+            self._respond(200, "text/csv")
+        else:
+            self._respond(404)
+
+    def do_GET(self):
+        self._respond(204 if urlparse(self.path).path == "/ping" else 404)
+
+    def _respond(self, status, content_type=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class MemorySink:
+    """
+    Accepts InfluxDB v2 writes (POST /api/v2/write) and keeps the points in memory.
+
+    Queries are answered with an empty result. All methods are thread safe.
+    """
+
+    def __init__(self, port=0):
+        """
+        Args:
+            port: The port to listen on, 0 for any free port.
+        """
+        self.writes = 0
+        self._points = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _SinkHandler)
+        self._server.sink = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """The URL of the sink, e.g. for the [influx2] section of a config file"""
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        """Serves requests in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="replay-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def points(self, bucket="metar"):
+        """Returns a copy of the points written to a bucket in line protocol"""
+        with self._lock:
+            return list(self._points.get(bucket, ()))
+
+    def count(self, bucket="metar"):
+        """Returns the number of points written to a bucket"""
+        with self._lock:
+            return len(self._points.get(bucket, ()))
+
+    def writeConfig(self, path, spool_directory):
+        """
+        Writes a config file which points the repository and the spool at the sink, see METAR_CONFIG.
+
+        Args:
+            path: The path of the config file.
+            spool_directory: The directory of the spool.
+        """
+        config = configparser.ConfigParser()
+        config["influx2"] = {"url": self.url, "org": "replay", "token": "replay", "timeout": "6000"}
+        config["batching"] = {"batch_size": "500", "flush_interval": "1000", "jitter_interval": "0",
+                              "retry_interval": "1000", "max_retries": "3"}
+        config["spool"] = {"directory": spool_directory, "fsync": "false"}
+        with open(path, "w") as file:
+            config.write(file)
+
+    def _store(self, bucket, lines):
+        with self._lock:
+            self.writes += 1
+            self._points.setdefault(bucket, []).extend(line for line in lines if line)
+
+def runLoad(upstream, sink, stations=100, cycles=3, concurrency=8, client_rate=None):
+    """
+    Runs simulated stations through app.process and the write path into the sink.
+
+    Every cycle advances the upstream and processes all stations on
+    concurrency threads like the ingestion of the scheduler. The observations
+    of a cycle are cached, published and spooled with app.ingestMetars, the
+    run ends when the drainer has written the spool to the sink.
+
+    Args:
+        upstream: The started ReplayUpstream.
+        sink: The started MemorySink.
+        stations: The number of simulated stations.
+        cycles: The number of ingestion cycles.
+        concurrency: The number of threads which call app.process.
+        client_rate: Requests per second of the rate limiter of the crawler, None keeps UPSTREAM_RATE.
+
+    Returns:
+        A dictionary with the numbers of stations, processed, failed and
+        written observations, seconds, observations_per_second, the latency
+        percentiles of process in milliseconds and the responses of the
+        upstream by status.
+    """
+    # the ingestion modules import InfluxDB, requests and Flask, only the driver needs them
+    import app
+    import metar_crawler as mc
+    import metar_spool
+    import TimeSeriesRepository as tsr
+
+    icaos = [stationCode(index) for index in range(stations)]
+    directory = tempfile.TemporaryDirectory()
+    config_file = os.path.join(directory.name, "replay.ini")
+    sink.writeConfig(config_file, os.path.join(directory.name, "spool"))
+    settings = (mc.METAR_URL, mc.UPSTREAM_RATE, tsr.CONFIG_FILE)
+    metar_spool.closeSpools()
+    tsr.closeRepository()
+    mc.METAR_URL = upstream.url
+    tsr.CONFIG_FILE = config_file
+    if client_rate is not None:
+        mc.UPSTREAM_RATE = client_rate
+    mc._upstreams.pop(urlparse(upstream.url).netloc, None)
+    written = sink.count()
+
+    latencies = []
+    def timedProcess(icao):
+        start = time.perf_counter()
+        metar = app.process({"icao": icao})
+        latencies.append(time.perf_counter() - start)
+        return metar
+
+    processed = 0
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as executor:
+            for _ in range(cycles):
+                upstream.advance()
+                metars = [metar for metar in executor.map(timedProcess, icaos) if metar is not None]
+                app.ingestMetars(metars)
+                processed += len(metars)
+        # the last drain writes what is left in the spool
+        metar_spool.closeSpools()
+        seconds = time.monotonic() - start
+    finally:
+        metar_spool.closeSpools()
+        tsr.closeRepository()
+        mc.METAR_URL, mc.UPSTREAM_RATE, tsr.CONFIG_FILE = settings
+        directory.cleanup()
+
+    latencies.sort()
+    return {
+        "stations": stations,
+        "processed": processed,
+        "missing": stations * cycles - processed,
+        "written": sink.count() - written,
+        "seconds": round(seconds, 3),
+        "observations_per_second": round(processed / seconds, 1) if seconds else 0.0,
+        "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+                       for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "responses": dict(upstream.responses),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m metar_replay",
+                                     description="Replay recorded METARs from a local stub upstream.")
+    parser.add_argument("command", choices=("load", "serve"))
+    parser.add_argument("--corpus", default=CORPUS_FILE, help="file of recorded METARs, one per line")
+    parser.add_argument("--rate", type=float, help="requests per second of the stub, more are answered with 429")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random seconds added to the latency")
+    parser.add_argument("--errors", default="", help="error mix, e.g. 500=0.02,429=0.01,timeout=0.005")
+    parser.add_argument("--seed", type=int, help="seed of the error mix")
+    parser.add_argument("--stations", type=int, default=100, help="simulated stations of the load run")
+    parser.add_argument("--cycles", type=int, default=3, help="ingestion cycles of the load run")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads of the load run")
+    parser.add_argument("--client-rate", type=float, default=1000.0,
+                        help="requests per second of the crawler's rate limiter in the load run")
+    parser.add_argument("--port", type=int, default=8090, help="port of the stub upstream of serve")
+    parser.add_argument("--sink-port", type=int, default=8096, help="port of the sink of serve")
+    parser.add_argument("--cycle-seconds", type=float, default=60.0, help="seconds per report cycle of serve")
+    parser.add_argument("--config", default=os.path.join(tempfile.gettempdir(), "metar-replay.ini"),
+                        help="config file written by serve, which points at the sink")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    options = dict(corpus=loadCorpus(args.corpus), rate=args.rate, latency=args.latency, jitter=args.jitter,
+                   errors=parseErrors(args.errors), seed=args.seed)
+    if args.command == "load":
+        # the parser and the crawler log every failed report, which would dominate the run
+        logging.disable(logging.ERROR)
+        with ReplayUpstream(**options) as upstream, MemorySink() as sink:
+            result = runLoad(upstream, sink, args.stations, args.cycles, args.concurrency, args.client_rate)
+        logging.disable(logging.NOTSET)
+        latency = "  ".join(f"{name} {value}ms" for name, value in result["latency_ms"].items())
+        print(f"{result['processed']} of {result['stations'] * args.cycles} observations processed, "
+              f"{result['written']} written in {result['seconds']}s ({result['observations_per_second']}/s)")
+        print(f"process latency  {latency}")
+        print(f"upstream responses  {result['responses']}")
+        return 0
+
+    with ReplayUpstream(cycle_seconds=args.cycle_seconds, port=args.port, **options) as upstream, \
+            MemorySink(port=args.sink_port) as sink:
+        sink.writeConfig(args.config, os.path.join(tempfile.gettempdir(), "metar-replay-spool"))
+        logger.info(f"Replaying METARs at {upstream.url}, writes are kept by the sink at {sink.url}")
+        logger.info(f"Run the ingestion with: METAR_UPSTREAM_URL={upstream.url} METAR_CONFIG={args.config} python ingest.py")
+        try:
+            while True:
+                time.sleep(args.cycle_seconds)
+                logger.info(f"Cycle {upstream.cycle}: {sink.count()} points written, responses {upstream.responses}")
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import heapq
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Stations per leaf of the k-d tree, leaves are scanned with NumPy
+LEAF_SIZE = 16
+
+def toUnitVectors(latitudes, longitudes):
+    """
+    Converts coordinates into points on the unit sphere.
+
+    Args:
+        latitudes: Array of latitudes in degrees.
+        longitudes: Array of longitudes in degrees.
+
+    Returns:
+        An (n, 3) array of x, y, z coordinates.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_latitudes = np.cos(latitudes)
+    return np.column_stack((cos_latitudes * np.cos(longitudes),
+                            cos_latitudes * np.sin(longitudes),
+                            np.sin(latitudes)))
+
+def chordToKm(chord):
+    """Converts the straight line distance of two points on the unit sphere into the great circle distance in km."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+def kmToChord(km):
+    """Converts a great circle distance in km into the straight line distance on the unit sphere."""
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+class StationIndex:
+    """
+    Spatial index over stations for nearest neighbour and bounding box queries.
+
+    Nearest neighbours are found with a k-d tree over the stations as points
+    on the unit sphere, so distances are exact great circle distances with no
+    special cases at the poles or the antimeridian. Bounding boxes are
+    answered from a grid of one degree cells.
+    """
+
+    def __init__(self, stations, cell_size=1.0):
+        """
+        Args:
+            stations: A list of Station.
+            cell_size: The size of a grid cell in degrees.
+        """
+        self.stations = list(stations)
+        self.cell_size = cell_size
+        self._latitudes = np.array([station.latitude for station in self.stations], dtype=np.float64)
+        self._longitudes = np.array([station.longitude for station in self.stations], dtype=np.float64)
+        self._points = toUnitVectors(self._latitudes, self._longitudes)
+        # the tree is implicit: the median of every range [start, end) is at its middle
+        self._order = np.arange(len(self.stations))
+        self._axes = np.zeros(len(self.stations), dtype=np.int8)
+        self._build(0, len(self.stations))
+        self._sorted_points = self._points[self._order]
+        self._grid = {}
+        cells = zip(self._cell(self._latitudes), self._cell(self._longitudes))
+        for index, cell in enumerate(cells):
+            self._grid.setdefault(cell, []).append(index)
+        self._grid = {cell: np.array(indexes) for cell, indexes in self._grid.items()}
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _cell(self, degrees):
+        return np.floor(np.asarray(degrees) / self.cell_size).astype(int).tolist()
+
+    def _build(self, start, end):
+        if end - start <= LEAF_SIZE:
+            return
+        points = self._points[self._order[start:end]]
+        axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        middle = (end - start) // 2
+        partition = np.argpartition(points[:, axis], middle)
+        self._order[start:end] = self._order[start:end][partition]
+        self._axes[start + middle] = axis
+        self._build(start, start + middle)
+        self._build(start + middle + 1, end)
+
+    def nearest(self, latitude, longitude, count=10, max_distance=None):
+        """
+        Finds the stations closest to a position.
+
+        Args:
+            latitude: The latitude in degrees.
+            longitude: The longitude in degrees.
+            count: The maximum number of stations.
+            max_distance: Only return stations within this many km, None for no limit.
+
+        Returns:
+            A list of tuples of Station and the distance in km, closest first.
+        """
+        if count <= 0 or not self.stations:
+            return []
+        target = toUnitVectors([latitude], [longitude])[0]
+        limit = kmToChord(max_distance) ** 2 if max_distance is not None else math.inf
+        # max heap of (-squared chord, position) of the best candidates
+        best = []
+        self._search(target, 0, len(self.stations), count, best, limit)
+        result = sorted((-distance, position) for distance, position in best)
+        return [(self.stations[self._order[position]], chordToKm(math.sqrt(distance)))
+                for distance, position in result]
+
+    def _search(self, target, start, end, count, best, limit):
+        bound = -best[0][0] if len(best) == count else limit
+        if end - start <= LEAF_SIZE:
+            distances = ((self._sorted_points[start:end] - target) ** 2).sum(axis=1)
+            for offset in np.flatnonzero(distances <= bound):
+                distance = float(distances[offset])
+                if len(best) < count:
+                    heapq.heappush(best, (-distance, start + int(offset)))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, start + int(offset)))
+            return
+        middle = start + (end - start) // 2
+        axis = self._axes[middle]
+        delta = target[axis] - self._sorted_points[middle, axis]
+        near, far = ((start, middle), (middle + 1, end)) if delta < 0 else ((middle + 1, end), (start, middle))
+        self._search(target, near[0], near[1], count, best, limit)
+        distance = float(((self._sorted_points[middle] - target) ** 2).sum())
+        if distance <= limit and (len(best) < count or distance < -best[0][0]):
+            if len(best) < count:
+                heapq.heappush(best, (-distance, middle))
+            else:
+                heapq.heapreplace(best, (-distance, middle))
+        bound = -best[0][0] if len(best) == count else limit
+        if delta * delta <= bound:
+            self._search(target, far[0], far[1], count, best, limit)
+
+    def within(self, south, west, north, east):
+        """
+        Finds the stations inside a bounding box.
+
+        Args:
+            south: The southern latitude in degrees.
+            west: The western longitude in degrees.
+            north: The northern latitude in degrees.
+            east: The eastern longitude in degrees, smaller than west if the box crosses the antimeridian.
+
+        Returns:
+            A list of Station ordered like the registry.
+
+        Raises:
+            ValueError: If a bound is not a finite number.
+        """
+        if not all(math.isfinite(bound) for bound in (south, west, north, east)):
+            raise ValueError("The bounds must be finite")
+        # the cells of the box are enumerated, bounds beyond the globe would enumerate cells forever
+        south, north = max(south, -90.0), min(north, 90.0)
+        west, east = min(max(west, -180.0), 180.0), min(max(east, -180.0), 180.0)
+        if south > north or not self.stations:
+            return []
+        crosses = west > east
+        south_cell, north_cell = self._cell([south, north])
+        if crosses:
+            longitude_cells = (list(range(self._cell(west), self._cell(180.0) + 1))
+                               + list(range(self._cell(-180.0), self._cell(east) + 1)))
+        else:
+            longitude_cells = range(self._cell(west), self._cell(east) + 1)
+        candidates = [self._grid[cell] for cell in
+                      ((lat, lon) for lat in range(south_cell, north_cell + 1) for lon in longitude_cells)
+                      if cell in self._grid]
+        if not candidates:
+            return []
+        candidates = np.sort(np.concatenate(candidates))
+        latitudes = self._latitudes[candidates]
+        longitudes = self._longitudes[candidates]
+        inside = (latitudes >= south) & (latitudes <= north)
+        if crosses:
+            inside &= (longitudes >= west) | (longitudes <= east)
+        else:
+            inside &= (longitudes >= west) & (longitudes <= east)
+        return [self.stations[index] for index in candidates[inside]]
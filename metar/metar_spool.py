@@ -0,0 +1,497 @@
+"""
+Write-ahead spool of InfluxDB points.
+
+Observations are appended to segment files on the local disk in the InfluxDB
+line protocol and a background drainer replays them to InfluxDB in large
+batches. Appending takes microseconds, so ingestion never waits for the
+database. While InfluxDB is slow or down the points stay on disk, also
+across restarts of the process.
+
+Segments are append-only files named by an increasing sequence number, only
+the newest one is appended to. The drainer reads segments through mmap and
+deletes them once all of their points are stored, how far the oldest
+segment is drained is kept in a checkpoint file. Compaction merges the
+segments which piled up during an outage and drops points which were
+spooled twice, the size cap drops the oldest segments. Batches which
+InfluxDB rejects for good, e.g. for a field type conflict, are moved to a
+dead letter file instead of blocking the points behind them.
+"""
+import atexit
+import configparser
+import logging
+import mmap
+import os
+import re
+import threading
+import TimeSeriesRepository as tsr
+from metar_metrics import SPOOL_BYTES, SPOOL_POINTS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SPOOL_DIRECTORY = "/tmp/metar-spool"
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint"
+# Rejected points in line protocol, it is never drained
+DEAD_LETTER_FILE = "dead-letter.lp"
+SEGMENT_BYTES = 4 * 1024 * 1024
+MAX_BYTES = 256 * 1024 * 1024
+
+# The series of a line ends at the first space which is not escaped
+SERIES_END_PATTERN = re.compile(rb"(?<!\\) ")
+# A point with timestamp ends with a space and an integer, a string field always ends with a quote
+TIMESTAMP_PATTERN = re.compile(rb" (-?\d+)$")
+
+class Spool:
+    """
+    Append-only segment files of line protocol points.
+
+    Every point is one line. A line is only read once its newline is on
+    disk, so a write torn by a crash is ignored. All methods are thread
+    safe, the segments are read and acknowledged by a single drainer.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_BYTES, fsync=False):
+        """
+        Args:
+            directory: The directory of the segment files, it is created if missing.
+            segment_bytes: A new segment is started once the newest one holds this many bytes.
+            max_bytes: The oldest segments are dropped once the spool holds more bytes.
+            fsync: Flush every append to the disk, otherwise a crash of the machine may lose the latest points.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                sequence = int(name[:-len(SEGMENT_SUFFIX)])
+                self._sizes[sequence] = os.path.getsize(self._path(sequence))
+        self._segments = sorted(self._sizes)
+        self._next = self._segments[-1] + 1 if self._segments else 0
+        self._active = None
+        self._active_file = None
+        self._checkpoint = self._readCheckpoint()
+        SPOOL_BYTES.set(self.size)
+
+    @classmethod
+    def fromConfigFile(cls, config_file=tsr.CONFIG_FILE, bucket="metar"):
+        """
+        Creates the spool of a bucket from the optional [spool] section of a
+        config file with directory, segment_bytes, max_bytes and fsync.
+
+        Args:
+            config_file: The path of the config file.
+            bucket: The bucket, every bucket is spooled in its own subdirectory.
+
+        Returns:
+            A new Spool.
+        """
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        section = config["spool"] if config.has_section("spool") else {}
+        return cls(os.path.join(section.get("directory", SPOOL_DIRECTORY), bucket),
+                   segment_bytes=int(section.get("segment_bytes", SEGMENT_BYTES)),
+                   max_bytes=int(section.get("max_bytes", MAX_BYTES)),
+                   fsync=str(section.get("fsync", "false")).lower() in ("1", "true", "yes"))
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:020d}{SEGMENT_SUFFIX}")
+
+    def _readCheckpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as file:
+                sequence, offset = file.read().split()
+                return int(sequence), int(offset)
+        except (OSError, ValueError):
+            return None
+
+    def _writeCheckpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        if self._checkpoint is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        # replace atomically, a crash leaves the old or the new checkpoint
+        with open(path + ".tmp", "w") as file:
+            file.write(f"{self._checkpoint[0]} {self._checkpoint[1]}")
+        os.replace(path + ".tmp", path)
+
+    @property
+    def size(self):
+        """The bytes of all segments."""
+        return sum(self._sizes.values())
+
+    def segments(self):
+        """
+        Returns:
+            The sequence numbers of all segments, oldest first.
+        """
+        with self._lock:
+            return list(self._segments)
+
+    def append(self, lines):
+        """
+        Appends points to the newest segment.
+
+        Args:
+            lines: A list of points in line protocol, without newlines.
+
+        Returns:
+            The number of appended points.
+        """
+        if not lines:
+            return 0
+        data = ("\n".join(lines) + "\n").encode()
+        with self._lock:
+            if self._active is None or (self._sizes[self._active] > 0
+                                        and self._sizes[self._active] + len(data) > self.segment_bytes):
+                self._rotate()
+            self._active_file.write(data)
+            self._active_file.flush()
+            if self.fsync:
+                os.fsync(self._active_file.fileno())
+            self._sizes[self._active] += len(data)
+            self._enforceCap()
+            SPOOL_BYTES.set(self.size)
+        SPOOL_POINTS.labels("appended").inc(len(lines))
+        return len(lines)
+
+    def _rotate(self):
+        if self._active_file is not None:
+            self._active_file.close()
+        self._active = self._next
+        self._next += 1
+        self._active_file = open(self._path(self._active), "ab")
+        self._segments.append(self._active)
+        self._sizes[self._active] = 0
+
+    def _enforceCap(self):
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            sequence = self._segments.pop(0)
+            with open(self._path(sequence), "rb") as file:
+                dropped = file.read().count(b"\n")
+            os.remove(self._path(sequence))
+            del self._sizes[sequence]
+            if self._checkpoint is not None and self._checkpoint[0] == sequence:
+                self._checkpoint = None
+                self._writeCheckpoint()
+            SPOOL_POINTS.labels("dropped").inc(dropped)
+            logger.error(f"Spool exceeds {self.max_bytes} bytes, dropped segment {sequence} with {dropped} points")
+
+    def offset(self, sequence):
+        """
+        Returns:
+            The offset up to which a segment is drained.
+        """
+        with self._lock:
+            if self._checkpoint is not None and self._checkpoint[0] == sequence:
+                return self._checkpoint[1]
+            return 0
+
+    def read(self, sequence, offset=0):
+        """
+        Reads the complete lines of a segment through mmap.
+
+        Args:
+            sequence: The sequence number of the segment.
+            offset: The offset of the first line.
+
+        Yields:
+            Tuples of the offset after a line and the line.
+        """
+        try:
+            file = open(self._path(sequence), "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if size <= offset:
+                return
+            with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as data:
+                while True:
+                    end = data.find(b"\n", offset)
+                    if end < 0:
+                        return
+                    yield end + 1, data[offset:end].decode()
+                    offset = end + 1
+
+    def ack(self, sequence, offset):
+        """
+        Marks a segment as drained up to an offset, a drained segment which
+        is no longer appended to is deleted.
+
+        Args:
+            sequence: The sequence number of the segment.
+            offset: The offset after the last stored line.
+        """
+        with self._lock:
+            if sequence not in self._sizes:
+                return
+            if sequence != self._active and offset >= self._sizes[sequence]:
+                os.remove(self._path(sequence))
+                self._segments.remove(sequence)
+                del self._sizes[sequence]
+                self._checkpoint = None
+            elif offset == 0 or self._checkpoint == (sequence, offset):
+                return
+            else:
+                self._checkpoint = (sequence, offset)
+            self._writeCheckpoint()
+            SPOOL_BYTES.set(self.size)
+
+    def compact(self):
+        """
+        Merges the segments which are no longer appended to into one and
+        keeps only the last point of every series and timestamp.
+
+        Returns:
+            The number of dropped duplicate points.
+        """
+        with self._lock:
+            sequences = [sequence for sequence in self._segments if sequence != self._active]
+        if len(sequences) < 2:
+            return 0
+        points = {}
+        count = 0
+        for sequence in sequences:
+            for _, line in self.read(sequence, self.offset(sequence)):
+                count += 1
+                encoded = line.encode()
+                series = SERIES_END_PATTERN.search(encoded)
+                timestamp = TIMESTAMP_PATTERN.search(encoded)
+                # points without timestamp are stamped by the server and never duplicates
+                if series and timestamp and timestamp.start() > series.start():
+                    key = (encoded[:series.start()], timestamp.group(1))
+                else:
+                    key = count
+                points.pop(key, None)
+                points[key] = line
+        target = sequences[-1]
+        temporary = self._path(target) + ".tmp"
+        with open(temporary, "w") as file:
+            file.writelines(line + "\n" for line in points.values())
+        with self._lock:
+            os.replace(temporary, self._path(target))
+            for sequence in sequences[:-1]:
+                if sequence in self._sizes:
+                    os.remove(self._path(sequence))
+                    self._segments.remove(sequence)
+                    del self._sizes[sequence]
+            self._sizes[target] = os.path.getsize(self._path(target))
+            if target not in self._segments:
+                self._segments.insert(0, target)
+            self._checkpoint = None
+            self._writeCheckpoint()
+            SPOOL_BYTES.set(self.size)
+        dropped = count - len(points)
+        SPOOL_POINTS.labels("compacted").inc(dropped)
+        logger.info(f"Compacted {len(sequences)} spool segments, dropped {dropped} duplicate points")
+        return dropped
+
+    def deadLetter(self, lines):
+        """
+        Appends points which InfluxDB rejected to the dead letter file of the spool.
+
+        Args:
+            lines: A list of points in line protocol.
+        """
+        with self._lock, open(os.path.join(self.directory, DEAD_LETTER_FILE), "a") as file:
+            file.writelines(line + "\n" for line in lines)
+        SPOOL_POINTS.labels("dead_lettered").inc(len(lines))
+
+    def close(self):
+        """Closes the newest segment, the next append starts a new one."""
+        with self._lock:
+            if self._active_file is not None:
+                self._active_file.close()
+                self._active_file = None
+                self._active = None
+
+class SpoolDrainer:
+    """
+    Background thread which replays a spool to InfluxDB.
+
+    Points are written in batches of batch_size with a synchronous write, a
+    batch is acknowledged only after InfluxDB accepted it. A batch which is
+    rejected for good is moved to the dead letter file. While writes fail
+    for other reasons the drainer backs off by the backoff policy and
+    compacts the spool once it holds more than compact_segments segments.
+    """
+
+    def __init__(self, spool, write, batch_size=5000, interval=1.0, max_backoff=60.0, compact_segments=8,
+                 backoff=None):
+        """
+        Args:
+            spool: The Spool to drain.
+            write: Callable storing a list of line protocol points, raises on failure.
+            batch_size: The maximum number of points per write.
+            interval: Seconds between two drains while InfluxDB is healthy.
+            max_backoff: The maximum seconds between two drains while writes fail.
+            compact_segments: Compact the spool once writes fail and it holds more segments.
+            backoff: Callable returning the seconds to wait after the given number of consecutive failed drains,
+                defaults to doubling the interval.
+        """
+        self.spool = spool
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.compact_segments = compact_segments
+        self.backoff = backoff or (lambda failures: interval * 2 ** failures)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def drain(self):
+        """
+        Writes all spooled points.
+
+        Returns:
+            The number of written points.
+
+        Raises:
+            Exception: The error of a transiently failed write, the points stay in the spool.
+        """
+        drained = 0
+        for sequence in self.spool.segments():
+            offset = self.spool.offset(sequence)
+            batch = []
+            for end, line in self.spool.read(sequence, offset):
+                batch.append(line)
+                offset = end
+                if len(batch) >= self.batch_size:
+                    drained += self._write(batch)
+                    self.spool.ack(sequence, offset)
+                    batch = []
+            if batch:
+                drained += self._write(batch)
+            self.spool.ack(sequence, offset)
+        if drained:
+            SPOOL_POINTS.labels("drained").inc(drained)
+        return drained
+
+    def _write(self, batch):
+        try:
+            self.write(batch)
+        except Exception as e:
+            if not tsr.isPermanent(e):
+                raise
+            self.spool.deadLetter(batch)
+            logger.error(f"InfluxDB rejected {len(batch)} points, moved them to the dead letter file: {e}")
+            return 0
+        return len(batch)
+
+    def start(self):
+        """Starts the drainer thread."""
+        self._thread = threading.Thread(target=self._run, name="spool-drainer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """
+        Stops the drainer thread after a last drain.
+
+        Args:
+            timeout: The maximum seconds to wait for the last drain.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        delay = self.interval
+        failures = 0
+        while True:
+            stopping = self._stop.wait(delay)
+            try:
+                self.drain()
+                delay = self.interval
+                failures = 0
+            except Exception as e:
+                failures += 1
+                delay = min(self.max_backoff, self.backoff(failures))
+                logger.error(f"Error draining spool to InfluxDB, retrying in {delay:.0f}s: {e}")
+                if len(self.spool.segments()) > self.compact_segments:
+                    self.spool.compact()
+            if stopping:
+                return
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+def getSpool(bucket="metar"):
+    """
+    Returns the spool of a bucket, it is created with its drainer on first use.
+
+    Args:
+        bucket: The InfluxDB bucket.
+
+    Returns:
+        The shared Spool of the bucket.
+    """
+    with _spools_lock:
+        entry = _spools.get(bucket)
+        if entry is None:
+            spool = Spool.fromConfigFile(tsr.CONFIG_FILE, bucket)
+            # the client is created in the drainer thread, never on the ingestion path. The drainer retries
+            # with the backoff of the repository, so every write follows the [batching] retry settings
+            drainer = SpoolDrainer(spool, lambda lines: tsr.getRepository().write_lines(lines, bucket),
+                                   backoff=lambda failures: tsr.getRepository().retryDelay(failures))
+            drainer.start()
+            if not _spools:
+                atexit.register(closeSpools)
+            entry = _spools[bucket] = (spool, drainer)
+        return entry[0]
+
+def closeSpools():
+    """
+    Stops the drainers after a last drain and closes the spools.
+    """
+    with _spools_lock:
+        for spool, drainer in _spools.values():
+            drainer.stop()
+            spool.close()
+        _spools.clear()
+
+# The observation time of the last spooled METAR of every station by bucket
+_spooled_times = {}
+_spooled_times_lock = threading.Lock()
+
+def spoolMetars(metars, bucket="metar"):
+    """
+    Appends parsed METARs to the spool of a bucket, they are written to
+    InfluxDB by its drainer.
+
+    Every ingestion path spools through here, so a METAR is spooled once per
+    station and observation time. The time is remembered once the append
+    succeeded, a METAR whose append failed is spooled by the next call.
+    METARs which can not be converted to a point are logged and skipped.
+
+    Args:
+        metars: An iterable of parsed METAR dictionaries.
+        bucket: The InfluxDB bucket.
+
+    Returns:
+        The number of spooled points.
+    """
+    with _spooled_times_lock:
+        spooled = _spooled_times.setdefault(bucket, {})
+        lines = []
+        times = {}
+        for metar in metars:
+            station, observed = metar.get("station"), metar.get("time")
+            # reports without time are always spooled
+            if observed is not None and observed in (spooled.get(station), times.get(station)):
+                continue
+            try:
+                lines.append(tsr.metarToPoint(metar).to_line_protocol())
+            except Exception as e:
+                logger.error(f"Error converting METAR to point: {e}")
+                continue
+            if observed is not None:
+                times[station] = observed
+        appended = getSpool(bucket).append(lines)
+        spooled.update(times)
+        return appended
@@ -0,0 +1,221 @@
+"""
+Registry of METAR stations.
+
+The station data in stations.csv is derived from the airportsdata package
+(MIT License, https://github.com/mborsetti/airportsdata) and holds every
+airport with a four letter ICAO code. The elevation is in feet.
+"""
+import csv
+import logging
+import os
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass, asdict
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+STATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations.csv")
+
+@dataclass(slots=True, frozen=True)
+class Station:
+    """A station with its position, the elevation is in feet."""
+    icao: str
+    name: str
+    city: str
+    country: str
+    latitude: float
+    longitude: float
+    elevation: int
+
+    def to_dict(self):
+        return asdict(self)
+
+class StationRegistry:
+    """
+    Read-only index of stations.
+
+    Stations are looked up by ICAO code in a dictionary. ICAO codes and
+    lower case names are additionally kept in sorted lists, so prefix
+    searches are a binary search instead of a scan over all stations.
+    """
+
+    def __init__(self, stations):
+        """
+        Args:
+            stations: An iterable of Station.
+        """
+        self._by_icao = {station.icao: station for station in stations}
+        self._codes = sorted(self._by_icao)
+        self._names = sorted((station.name.lower(), station.icao) for station in self._by_icao.values())
+
+    @classmethod
+    def fromCsv(cls, path=STATION_FILE):
+        """
+        Loads a registry from a CSV file with the columns icao, name, city,
+        country, latitude, longitude and elevation.
+
+        Args:
+            path: The path of the CSV file.
+
+        Returns:
+            A new StationRegistry.
+        """
+        with open(path, encoding="utf-8", newline="") as file:
+            stations = [Station(row["icao"].upper(), row["name"], row["city"], row["country"],
+                                float(row["latitude"]), float(row["longitude"]), int(float(row["elevation"] or 0)))
+                        for row in csv.DictReader(file)]
+        logger.info(f"Loaded {len(stations)} stations from {path}")
+        return cls(stations)
+
+    def __len__(self):
+        return len(self._by_icao)
+
+    def __iter__(self):
+        return iter(self._by_icao.values())
+
+    def __contains__(self, icao):
+        return icao.upper() in self._by_icao
+
+    def get(self, icao):
+        """
+        Args:
+            icao: The ICAO airport code.
+
+        Returns:
+            The Station, or None if the code is unknown.
+        """
+        return self._by_icao.get(icao.upper())
+
+    def withPrefix(self, prefix, limit=None):
+        """
+        Returns the stations whose ICAO code starts with a prefix, ordered by code.
+
+        Args:
+            prefix: The prefix (e.g., "LOW" or "K").
+            limit: The maximum number of stations, None returns all.
+
+        Returns:
+            A list of Station.
+        """
+        prefix = prefix.upper()
+        stations = []
+        for index in range(bisect_left(self._codes, prefix), len(self._codes)):
+            code = self._codes[index]
+            if not code.startswith(prefix) or (limit is not None and len(stations) >= limit):
+                break
+            stations.append(self._by_icao[code])
+        return stations
+
+    def search(self, query, limit=20):
+        """
+        Searches stations by ICAO code prefix and by name prefix.
+
+        Args:
+            query: The search text (e.g., "LOW" or "vienna").
+            limit: The maximum number of stations.
+
+        Returns:
+            A list of Station, ICAO code matches first.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        stations = self.withPrefix(query, limit)
+        found = {station.icao for station in stations}
+        name = query.lower()
+        for index in range(bisect_left(self._names, (name, "")), len(self._names)):
+            if len(stations) >= limit:
+                break
+            station_name, icao = self._names[index]
+            if not station_name.startswith(name):
+                break
+            if icao not in found:
+                stations.append(self._by_icao[icao])
+        return stations
+
+    def select(self, selectors):
+        """
+        Resolves a list of ICAO codes and prefixes into stations.
+
+        Args:
+            selectors: Four letter ICAO codes and shorter prefixes (e.g., ["LOWW", "ED"]).
+
+        Returns:
+            A list of Station without duplicates, in the order of the selectors.
+            Unknown ICAO codes are logged and skipped.
+        """
+        stations = {}
+        for selector in selectors:
+            selector = selector.strip().upper()
+            if len(selector) >= 4:
+                station = self.get(selector)
+                if station is None:
+                    logger.warning(f"Unknown station: {selector}")
+                    continue
+                stations[station.icao] = station
+            elif selector:
+                for station in self.withPrefix(selector):
+                    stations[station.icao] = station
+        return list(stations.values())
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def getRegistry():
+    """
+    Returns the process wide registry, it is loaded from STATION_FILE on first use.
+
+    Returns:
+        The shared StationRegistry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = StationRegistry.fromCsv(STATION_FILE)
+        return _registry
+
+def shardStations(icaos, shards):
+    """
+    Splits stations into shards of nearly equal size.
+
+    Args:
+        icaos: A list of ICAO airport codes.
+        shards: The number of shards.
+
+    Returns:
+        A list of at most shards non empty lists of ICAO codes.
+    """
+    shards = max(1, min(shards, len(icaos)))
+    size, remainder = divmod(len(icaos), shards)
+    result = []
+    start = 0
+    for index in range(shards):
+        end = start + size + (1 if index < remainder else 0)
+        result.append(icaos[start:end])
+        start = end
+    return [shard for shard in result if shard]
+
+def shardSchedule(icaos, intervals, shards, spacing):
+    """
+    Plans the hourly start times of the shards of every ingestion interval.
+
+    Shard n of an interval starts n * spacing seconds after the interval, so
+    the upstream and InfluxDB see a steady stream of small cycles instead of
+    one burst.
+
+    Args:
+        icaos: A list of ICAO airport codes.
+        intervals: Minutes past the hour at which an ingestion cycle starts (e.g., ["21", "51"]).
+        shards: The number of shards per cycle.
+        spacing: Seconds between the start of two shards.
+
+    Returns:
+        A list of tuples of the start time as "MM:SS" past the hour and the shard.
+    """
+    plan = []
+    for interval in intervals:
+        for index, shard in enumerate(shardStations(icaos, shards)):
+            offset = (int(interval) * 60 + index * spacing) % 3600
+            plan.append((f"{offset // 60:02d}:{offset % 60:02d}", shard))
+    return plan
@@ -0,0 +1,207 @@
+import unittest
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from influxdb_client import InfluxDBClient
+import metar_parser as mp
+import TimeSeriesRepository as tsr
+from prometheus_client import REGISTRY
+
+def metar(station, temperature):
+    return {
+        "station": station,
+        "temperatures": {"temperature": temperature, "dew_point": -5},
+        "humidity": 45.0,
+        "wind": {"direction": 150, "speed": 10, "unit": "KT", "gust": None},
+        "visibility": 10000,
+        "weather": "",
+        "QNH": 1029,
+    }
+
+def sample(name):
+    return REGISTRY.get_sample_value(name) or 0
+
+class StubInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    writes = []
+    # the status of the next requests, the stored requests answer 204
+    statuses = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = StubInfluxHandler.statuses.pop(0) if StubInfluxHandler.statuses else 204
+        if status == 204:
+            StubInfluxHandler.writes.append(body.decode().splitlines())
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class TestMetarRepository(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubInfluxHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubInfluxHandler.writes = []
+        StubInfluxHandler.statuses = []
+        client = InfluxDBClient(url=f"http://127.0.0.1:{self.server.server_port}", token="token", org="org")
+        self.repository = tsr.MetarRepository(client, batch_size=100, flush_interval=60000, retry_interval=10,
+                                              max_retries=2)
+        self.addCleanup(self.repository.close)
+
+    def testOneRequestPerBatch(self):
+        points, requests = sample("metar_influx_points_total"), sample("metar_influx_write_seconds_count")
+        queued = self.repository.write_many([metar(f"LOW{i}", i) for i in range(10)])
+        self.assertEqual(queued, 10)
+        self.repository.flush()
+        self.assertEqual(len(StubInfluxHandler.writes), 1)
+        self.assertEqual(len(StubInfluxHandler.writes[0]), 10)
+        self.assertTrue(StubInfluxHandler.writes[0][0].startswith("metar,icao=LOW0 "))
+        self.assertEqual(sample("metar_influx_points_total") - points, 10)
+        self.assertEqual(sample("metar_influx_write_seconds_count") - requests, 1)
+        # the repository keeps writing after a flush
+        self.repository.write(metar("LOWG", 4))
+        self.repository.flush()
+        self.assertEqual(len(StubInfluxHandler.writes), 2)
+
+    def testFullBatchIsWrittenWithoutFlush(self):
+        self.repository.write_many([metar(f"LOW{i}", i) for i in range(250)])
+        deadline = time.monotonic() + 5
+        while len(StubInfluxHandler.writes) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([len(lines) for lines in StubInfluxHandler.writes], [100, 100])
+
+    def testFullBufferBlocksTheProducer(self):
+        self.repository.max_buffered = 10
+        stored = threading.Event()
+        post = self.repository._post
+        def slowPost(bucket, records):
+            stored.wait(5)
+            post(bucket, records)
+        self.repository._post = slowPost
+        self.repository.write_many([metar(f"LOW{i}", i) for i in range(10)])
+        producer = threading.Thread(target=self.repository.write_many, args=([metar("LOWG", 4)],))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+        stored.set()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.repository.flush()
+        self.assertEqual(sum(len(lines) for lines in StubInfluxHandler.writes), 11)
+
+    def testFailedBatchIsRetried(self):
+        points = sample("metar_influx_points_total")
+        StubInfluxHandler.statuses = [503]
+        with self.assertLogs(level="WARNING"):
+            self.repository.write(metar("LOWW", 6))
+            self.repository.flush()
+        self.assertEqual(len(StubInfluxHandler.writes), 1)
+        self.assertEqual(sample("metar_influx_points_total") - points, 1)
+
+    def testRetryDelayDoublesWithJitter(self):
+        self.repository.retry_interval, self.repository.jitter_interval = 1000, 200
+        for attempt, delay in ((1, 1.0), (2, 2.0), (3, 4.0)):
+            self.assertTrue(delay <= self.repository.retryDelay(attempt) <= delay + 0.2, attempt)
+
+    def testRejectedBatchIsNotCounted(self):
+        points = sample("metar_influx_points_total")
+        StubInfluxHandler.statuses = [400]
+        with self.assertLogs(level="ERROR"):
+            self.repository.write(metar("LOWW", 6))
+            self.repository.flush()
+        self.assertEqual(StubInfluxHandler.writes, [])
+        self.assertEqual(sample("metar_influx_points_total") - points, 0)
+
+    def testInvalidMetarIsSkipped(self):
+        queued = self.repository.write_many([metar("LOWW", 6), {"station": "BROK"}])
+        self.assertEqual(queued, 1)
+
+    def testCloseFlushes(self):
+        self.repository.write(metar("LOWW", 6))
+        self.assertEqual(StubInfluxHandler.writes, [])
+        start = time.monotonic()
+        self.repository.close()
+        # the buffer is written right away, not after the flush interval
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(len(StubInfluxHandler.writes), 1)
+        with self.assertRaises(RuntimeError):
+            self.repository.write(metar("LOWW", 7))
+
+    def testWriteLinesIsSynchronous(self):
+        lines = [tsr.metarToPoint(metar("LOWW", 6)).to_line_protocol()]
+        self.repository.write_lines(lines)
+        self.assertEqual(StubInfluxHandler.writes, [lines])
+
+class TestPoints(unittest.TestCase):
+
+    def testVariableWindIsStoredAsFlag(self):
+        variable = metar("LOWW", 6)
+        variable["wind"] = {"direction": "VRB", "speed": 3, "unit": "KT", "gust": None}
+        line = tsr.metarToPoint(variable).to_line_protocol()
+        self.assertIn("wind_variable=true", line)
+        self.assertNotIn("wind_direction", line)
+        line = tsr.metarToPoint(metar("LOWW", 6)).to_line_protocol()
+        self.assertIn("wind_direction=150i", line)
+        self.assertIn("wind_variable=false", line)
+        self.assertEqual(tsr.storedToFields({"wind_variable": True, "wind_speed": 3}),
+                         {"wind_speed": 3, "wind_direction": "VRB"})
+        self.assertEqual(tsr.storedToFields({"wind_variable": False, "wind_direction": 150}), {"wind_direction": 150})
+
+    def testMissingGroupsAreLeftOut(self):
+        calm = mp.parseObservation("LOWW 191820Z AUTO /////KT 9999 NCD 06/M05 Q1029").to_json()
+        line = tsr.metarToPoint(calm).to_line_protocol()
+        self.assertIn("temperature=6i", line)
+        self.assertNotIn("wind", line)
+        unknown = mp.parseObservation("LOWW 191820Z AUTO 15010KT 9999 NCD ///// Q1029").to_json()
+        line = tsr.metarToPoint(unknown).to_line_protocol()
+        self.assertIn("wind_speed=10i", line)
+        self.assertNotIn("temperature", line)
+        self.assertNotIn("humidity", line)
+        self.assertIsNone(tsr.metarToFields(unknown)["dewpoint"])
+
+class TestFetchHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.query_api = mock.Mock()
+        repository = SimpleNamespace(client=SimpleNamespace(query_api=lambda: self.query_api))
+        patcher = mock.patch("TimeSeriesRepository.getRepository", return_value=repository)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testColumnarResult(self):
+        self.query_api.query_stream.return_value = [
+            SimpleNamespace(values={"_time": datetime(2024, 10, 19, 18, tzinfo=timezone.utc), "temperature": 6.25, "qnh": 1029.0}),
+            SimpleNamespace(values={"_time": datetime(2024, 10, 19, 19, tzinfo=timezone.utc), "temperature": 5.5}),
+        ]
+        history = tsr.fetchHistory("loww", "metar", period="2h", resolution="1h", fields=["temperature", "qnh"])
+        self.assertEqual(history, {"time": [1729360800, 1729364400], "temperature": [6.25, 5.5], "qnh": [1029.0, None]})
+        query = self.query_api.query_stream.call_args[0][0]
+        self.assertIn("range(start: -2h)", query)
+        self.assertIn("aggregateWindow(every: 1h, fn: mean", query)
+        self.assertIn('r["icao"] == "LOWW"', query)
+
+    def testInvalidArguments(self):
+        for kwargs in ({"period": "24"}, {"resolution": "0h"}, {"fields": ["weather"]}, {"fn": "sum"},
+                       {"period": "365d", "resolution": "1m"}):
+            with self.assertRaises(ValueError):
+                tsr.fetchHistory("LOWW", "metar", **kwargs)
+        with self.assertRaises(ValueError):
+            tsr.fetchHistory('LOWW") |> drop(', "metar")
+        self.query_api.query_stream.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import unittest
+from unittest import mock
+import app
+
+class TestStreamSlots(unittest.TestCase):
+
+    def testStreamsAreCapped(self):
+        client = app.app.test_client()
+        # the broker would wait for the first event or keepalive
+        events = mock.patch.object(app.metar_broker.observations, "events", return_value=iter([": keepalive\n\n"]))
+        cached = mock.patch.object(app.metar_cache.latestObservations, "get", return_value=None)
+        with mock.patch.object(app, "_stream_slots", threading.BoundedSemaphore(1)), events, cached:
+            first = client.get("/v1/api/metar/stream?icao=LOWW")
+            self.assertEqual(first.status_code, 200)
+            second = client.get("/v1/api/metar/stream?icao=LOWW")
+            self.assertEqual(second.status_code, 503)
+            self.assertEqual(second.headers["Retry-After"], "30")
+            # closing the first stream frees its slot
+            first.close()
+            third = client.get("/v1/api/metar/stream?icao=LOWW")
+            self.assertEqual(third.status_code, 200)
+            third.close()
+
+    def testInvalidLastEventIdKeepsNoSlot(self):
+        client = app.app.test_client()
+        events = mock.patch.object(app.metar_broker.observations, "events", return_value=iter([": keepalive\n\n"]))
+        cached = mock.patch.object(app.metar_cache.latestObservations, "get", return_value=None)
+        slots = threading.BoundedSemaphore(1)
+        with mock.patch.object(app, "_stream_slots", slots), events as events, cached:
+            for last_event_id in ("\u00b2", "-1", "12"):
+                response = client.get("/v1/api/metar/stream?icao=LOWW", headers={"Last-Event-ID": last_event_id})
+                self.assertEqual(response.status_code, 200)
+                response.close()
+            self.assertEqual([call.args[1] for call in events.call_args_list], [None, None, 12])
+            self.assertTrue(slots.acquire(blocking=False))
+
+class TestProcessMetar(unittest.TestCase):
+
+    REPORT = "LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG"
+
+    def setUp(self):
+        app.mc.lastReports.forget("LOWW")
+        self.addCleanup(app.mc.lastReports.forget, "LOWW")
+        patches = [mock.patch.object(app.mc, "fetchMETARs", return_value={"LOWW": self.REPORT}),
+                   mock.patch.object(app.metar_cache, "storeMetar"),
+                   mock.patch.object(app.metar_broker, "publishMetar")]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def testReportIsRememberedOnceSpooled(self):
+        with mock.patch.object(app.metar_spool, "spoolMetars", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                app.processMetar(["LOWW"])
+        self.assertTrue(app.mc.lastReports.changed("LOWW", self.REPORT))
+        with mock.patch.object(app.metar_spool, "spoolMetars") as spoolMetars:
+            app.processMetar(["LOWW"])
+            app.processMetar(["LOWW"])
+        self.assertEqual([len(call.args[0]) for call in spoolMetars.call_args_list], [1, 0])
+
+if __name__ == '__main__':
+    unittest.main()
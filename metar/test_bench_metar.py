@@ -0,0 +1,34 @@
+import unittest
+import bench_metar
+import metar_parser as mp
+
+class TestBenchMetar(unittest.TestCase):
+
+    def testCorpusCoversAllCategories(self):
+        corpus = bench_metar.loadCorpus()
+        self.assertEqual(set(corpus), {"us", "icao", "rvr", "vrb", "gust", "vv", "weather", "malformed"})
+        for category, metars in corpus.items():
+            self.assertTrue(all((mp.parseMETAR(metar) is None) == (category == "malformed") for metar in metars),
+                            category)
+
+    def testEveryTokenGroupIsTimed(self):
+        corpus = bench_metar.loadCorpus()
+        results = bench_metar.benchTokens(corpus, min_seconds=0)
+        self.assertEqual(set(results), {f"token.{group}" for group in bench_metar.tokenParsers()})
+        self.assertTrue(all(result["ops_per_second"] > 0 for result in results.values()))
+
+    def testParserIsTimedWithoutTheMemo(self):
+        lookups = mp.parseMemo.hits + mp.parseMemo.misses
+        results = bench_metar.benchParser(bench_metar.loadCorpus(), min_seconds=0)
+        self.assertEqual(mp.parseMemo.hits + mp.parseMemo.misses, lookups)
+        self.assertIn("parse_memo.all", results)
+
+    def testCompareReportsRegressions(self):
+        baseline = {"parse.all": {"ops_per_second": 1000}, "write.points": {"ops_per_second": 1000}}
+        results = {"parse.all": {"ops_per_second": 900}, "write.points": {"ops_per_second": 700},
+                   "parse.us": {"ops_per_second": 1}}
+        self.assertEqual(bench_metar.compare(results, baseline, 0.2),
+                         ["write.points: 700 ops/s, baseline 1000 ops/s"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import gzip
+import json
+import os
+import tempfile
+import metar_archive
+
+ARCHIVE = """2023/10/19 18:20
+LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG
+
+KJFK 202300Z 24004KT 10SM CLR 28/22 A2992
+ZZZZ BROKEN
+EDDF 191820Z 22008KT 9999 FEW040 12/04 Q1021 NOSIG
+"""
+
+class TestMetarArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.archive = os.path.join(self.directory.name, "metars.txt.gz")
+        with gzip.open(self.archive, "wt") as archive:
+            archive.write(ARCHIVE)
+
+    def testReadChunks(self):
+        chunks = list(metar_archive.readChunks(ARCHIVE.splitlines(), chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+    def testParseArchiveToJson(self):
+        output = os.path.join(self.directory.name, "metars.ndjson")
+        self.assertEqual(metar_archive.main([self.archive, "--output", output, "--workers", "2", "--chunk-size", "2"]), 0)
+        with open(output) as lines:
+            metars = [json.loads(line) for line in lines]
+        self.assertEqual([metar["station"] for metar in metars], ["LOWW", "KJFK", "EDDF"])
+        self.assertEqual(metars[0]["time"], "2023-10-19T18:20:00+00:00")
+
+    def testStats(self):
+        batches = []
+        with metar_archive.openArchive(self.archive) as lines:
+            stats = metar_archive.parseArchive(lines, batches.append, workers=1, chunk_size=3, as_json=False)
+        self.assertEqual((stats.lines, stats.parsed, stats.failures), (5, 3, 1))
+        self.assertEqual(batches[0][0]["station"], "LOWW")
+
+    def testHeaderLinesAreTheReference(self):
+        lines = ["2023/10/19 18:20", "LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG",
+                 "2023/11/02 06:50", "EDDF 020650Z 22008KT 9999 FEW040 12/04 Q1021 NOSIG",
+                 "EDDM 020650Z 26012KT 9999 SCT030 10/05 Q1018 NOSIG"]
+        batches = []
+        stats = metar_archive.parseArchive(lines, batches.extend, workers=1, chunk_size=4, as_json=False)
+        self.assertEqual((stats.parsed, stats.failures), (3, 0))
+        # the last report is in the second chunk, its header in the first
+        self.assertEqual([metar["time"].isoformat() for metar in batches],
+                         ["2023-10-19T18:20:00+00:00", "2023-11-02T06:50:00+00:00", "2023-11-02T06:50:00+00:00"])
+
+if __name__ == '__main__':
+    unittest.main()
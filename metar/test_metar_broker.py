@@ -0,0 +1,52 @@
+import json
+import threading
+import time
+import unittest
+from metar_broker import ObservationBroker
+import metar_broker
+
+class TestObservationBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = ObservationBroker(history=4)
+
+    def testEventsAreFilteredByStation(self):
+        self.broker.publish("KJFK", {"temperature": 28})
+        self.broker.publish("loww", {"temperature": 6})
+        events = self.broker.events(["LOWW"], last_id=0, keepalive=0.05)
+        event = next(events)
+        self.assertTrue(event.startswith("id: 2\nevent: metar\ndata: "))
+        self.assertEqual(json.loads(event.split("data: ", 1)[1]), {"icao": "LOWW", "temperature": 6})
+        self.assertEqual(next(events), ": keepalive\n\n")
+        self.assertEqual(self.broker.subscribers, 1)
+        events.close()
+        self.assertEqual(self.broker.subscribers, 0)
+
+    def testSubscriberIsWokenByPublish(self):
+        events = self.broker.events(keepalive=5)
+        received = []
+        consumer = threading.Thread(target=lambda: received.append(next(events)))
+        consumer.start()
+        while self.broker.subscribers == 0:
+            time.sleep(0.001)
+        self.broker.publish("LOWW", {"temperature": 6})
+        consumer.join(2)
+        self.assertIn('"icao": "LOWW"', received[0])
+        events.close()
+
+    def testSlowSubscriberSkipsLostEvents(self):
+        for temperature in range(6):
+            self.broker.publish("LOWW", {"temperature": temperature})
+        events = self.broker.events(last_id=0, keepalive=0.05)
+        self.assertTrue(next(events).startswith("id: 3\n"))
+
+    def testPublishMetar(self):
+        metar = {"station": "LOWW", "time": None, "temperatures": {"temperature": 6, "dew_point": -5},
+                 "humidity": 45.0, "wind": {"direction": 150, "speed": 10, "unit": "KT", "gust": None},
+                 "visibility": 10000, "weather": "", "QNH": 1029}
+        metar_broker.publishMetar(metar, self.broker)
+        event = next(self.broker.events(last_id=0))
+        self.assertEqual(json.loads(event.split("data: ", 1)[1])["qnh"], 1029)
+
+if __name__ == '__main__':
+    unittest.main()
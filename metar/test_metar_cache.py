@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+import metar_cache
+from metar_cache import LatestObservationCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestLatestObservationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LatestObservationCache(maxsize=2, ttl=60, clock=self.clock)
+
+    def testHitAndMiss(self):
+        self.assertIsNone(self.cache.get("LOWW"))
+        self.cache.put("loww", {"temperature": 6})
+        self.assertEqual(self.cache.get("LOWW"), {"temperature": 6})
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def testExpiry(self):
+        self.cache.put("LOWW", {"temperature": 6})
+        self.clock.now = 61
+        self.assertIsNone(self.cache.get("LOWW"))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        self.cache.put("LOWW", {})
+        self.cache.put("KJFK", {})
+        self.cache.get("LOWW")
+        self.cache.put("EDDF", {})
+        self.assertIsNone(self.cache.get("KJFK"))
+        self.assertIsNotNone(self.cache.get("LOWW"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def testFetchLatestQueriesOnlyOnMiss(self):
+        with mock.patch("TimeSeriesRepository.fetchMetar", return_value={"temperature": 6}) as fetch:
+            self.assertEqual(metar_cache.fetchLatest("LOWW", "metar", self.cache), {"temperature": 6})
+            self.assertEqual(metar_cache.fetchLatest("LOWW", "metar", self.cache), {"temperature": 6})
+        fetch.assert_called_once_with("LOWW", "metar")
+
+    def testIterLatestQueriesAllMissesAtOnce(self):
+        self.cache.put("LOWW", {"temperature": 6})
+        with mock.patch("TimeSeriesRepository.fetchLatestMetars", return_value={"KJFK": {"temperature": 28}}) as fetch:
+            result = list(metar_cache.iterLatest(["LOWW", "kjfk", "XXXX", "KJFK"], "metar", self.cache))
+        fetch.assert_called_once_with(["KJFK", "XXXX"], "metar")
+        self.assertEqual(result, [("LOWW", {"temperature": 6}), ("KJFK", {"temperature": 28}), ("XXXX", None)])
+        self.assertEqual(self.cache.get("KJFK"), {"temperature": 28})
+
+    def testEncodedOnceAndReplacedByNewObservation(self):
+        self.assertIsNone(self.cache.getEncoded("LOWW"))
+        self.cache.put("LOWW", {"temperature": 6})
+        with mock.patch("metar_cache.encodeJson", wraps=metar_cache.encodeJson) as encode:
+            body, etag = self.cache.getEncoded("LOWW")
+            self.assertIs(self.cache.getEncoded("loww")[0], body)
+        encode.assert_called_once()
+        self.assertEqual(body, b'{"temperature":6}')
+        self.cache.put("LOWW", {"temperature": 7})
+        self.assertNotEqual(self.cache.getEncoded("LOWW")[1], etag)
+
+    def testFetchLatestEncodedQueriesOnlyOnMiss(self):
+        with mock.patch("TimeSeriesRepository.fetchMetar", return_value={"temperature": 6}) as fetch:
+            first = metar_cache.fetchLatestEncoded("LOWW", "metar", self.cache)
+            self.assertEqual(metar_cache.fetchLatestEncoded("LOWW", "metar", self.cache), first)
+        fetch.assert_called_once_with("LOWW", "metar")
+        self.assertEqual(self.cache.get("LOWW"), {"temperature": 6})
+
+if __name__ == '__main__':
+    unittest.main()
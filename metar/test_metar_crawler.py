@@ -1,8 +1,283 @@
 import unittest
+import threading
+import time
+import requests
+import zlib
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 import metar_crawler as mc
+import metar_replay
+
+STUB_METARS = {
+    "LOWW": "LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG",
+    "KJFK": "KJFK 202300Z 24004KT 10SM CLR 28/22 A2992",
+    "EDDF": "EDDF 191820Z 22008KT 9999 FEW040 12/04 Q1021 NOSIG",
+}
+
+class StubMetarHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+    not_modified = 0
+
+    def do_GET(self):
+        ids = parse_qs(urlparse(self.path).query)["ids"][0].split(",")
+        StubMetarHandler.requests.append((ids, self.client_address))
+        body = "\n".join(STUB_METARS[icao] for icao in ids if icao in STUB_METARS)
+        body = body.encode()
+        etag = f'"{zlib.crc32(body):08x}"'
+        if self.headers.get("If-None-Match") == etag:
+            StubMetarHandler.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 class TestMetarCrawler(unittest.TestCase):
 
+    def setUp(self):
+        # the replay stub stands in for aviationweather.gov
+        upstream = metar_replay.ReplayUpstream(corpus=[STUB_METARS["LOWW"]]).start()
+        self.addCleanup(upstream.stop)
+        self.addCleanup(setattr, mc, "METAR_URL", mc.METAR_URL)
+        mc.METAR_URL = upstream.url
+        mc._validators.clear()
+
     def testFetchLOWW(self):
-        metar = mc.fetchMetar("LOWW")
-        self.assertTrue(metar.startswith("LOWW"))
\ No newline at end of file
+        metar = mc.fetchMETAR("LOWW")
+        self.assertTrue(metar.startswith("LOWW"))
+
+class TestFetchMETARs(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubMetarHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = mc.METAR_URL
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        mc.METAR_URL = f"http://127.0.0.1:{self.server.server_port}/api/data/metar"
+        StubMetarHandler.requests = []
+        StubMetarHandler.not_modified = 0
+        mc._validators.clear()
+
+    def tearDown(self):
+        mc.METAR_URL = self.url
+
+    def testFetchMany(self):
+        metars = mc.fetchMETARs(["LOWW", "kjfk", "EDDF", "XXXX"])
+        self.assertEqual(metars, STUB_METARS)
+        self.assertEqual(len(StubMetarHandler.requests), 1)
+
+    def testChunkedRequestsReuseConnection(self):
+        chunks = mc.chunkStations(STUB_METARS, max_ids=1)
+        self.assertEqual(chunks, [["LOWW"], ["KJFK"], ["EDDF"]])
+
+        metars = mc.fetchMETARs(STUB_METARS, max_ids=1)
+        self.assertEqual(metars, STUB_METARS)
+        self.assertEqual(len(StubMetarHandler.requests), 3)
+        # one keep-alive connection serves all chunks
+        self.assertEqual(len({address for _, address in StubMetarHandler.requests}), 1)
+
+    def testConditionalRequest(self):
+        self.assertEqual(mc.fetchMETAR("LOWW"), STUB_METARS["LOWW"])
+        self.assertEqual(mc.fetchMETAR("LOWW"), STUB_METARS["LOWW"])
+        self.assertEqual(len(StubMetarHandler.requests), 2)
+        self.assertEqual(StubMetarHandler.not_modified, 1)
+
+    def testReportTracker(self):
+        tracker = mc.ReportTracker()
+        self.assertTrue(tracker.changed("LOWW", STUB_METARS["LOWW"]))
+        # a report is only seen once it is remembered
+        self.assertTrue(tracker.changed("LOWW", STUB_METARS["LOWW"]))
+        tracker.remember("LOWW", STUB_METARS["LOWW"])
+        self.assertFalse(tracker.changed("LOWW", STUB_METARS["LOWW"] + "\n"))
+        self.assertTrue(tracker.changed("LOWW", "LOWW 191850Z 15012KT CAVOK 06/M05 Q1029 NOSIG"))
+        tracker.forget("LOWW")
+        self.assertTrue(tracker.changed("LOWW", STUB_METARS["LOWW"]))
+
+    def testChunkByLength(self):
+        chunks = mc.chunkStations(["LOWW", "KJFK", "EDDF"], max_length=10)
+        self.assertEqual(chunks, [["LOWW", "KJFK"], ["EDDF"]])
+
+    def testSplitMETARs(self):
+        metars = mc.splitMETARs("METAR LOWW 191820Z 15010KT CAVOK 06/M05 Q1029\n\nSPECI KJFK 202300Z 24004KT 10SM CLR 28/22 A2992\n")
+        self.assertEqual(metars["LOWW"], "LOWW 191820Z 15010KT CAVOK 06/M05 Q1029")
+        self.assertEqual(metars["KJFK"], "KJFK 202300Z 24004KT 10SM CLR 28/22 A2992")
+
+    def testSplitKeepsLatestReportOfStation(self):
+        metars = mc.splitMETARs("SPECI LOWW 191835Z 15015KT 4000 RA BKN010 06/04 Q1028\n"
+                                "METAR LOWW 191820Z 15010KT CAVOK 06/M05 Q1029\n")
+        self.assertEqual(metars, {"LOWW": "LOWW 191835Z 15015KT 4000 RA BKN010 06/04 Q1028"})
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def testOpensAndProbes(self):
+        clock = FakeClock()
+        breaker = mc.CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+        breaker.recordFailure()
+        self.assertTrue(breaker.allow())
+        breaker.recordFailure()
+        self.assertEqual(breaker.state, mc.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        clock.now = 10
+        # a single probe after the reset timeout
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.recordFailure()
+        self.assertEqual(breaker.state, mc.CircuitBreaker.OPEN)
+        clock.now = 20
+        self.assertTrue(breaker.allow())
+        breaker.recordSuccess()
+        self.assertEqual(breaker.state, mc.CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def testFailedProbeReopensCircuit(self):
+        breaker, limiter = mc.getUpstream("http://127.0.0.1:1/api/data/metar")
+        self.addCleanup(mc._upstreams.clear)
+        breaker.state, breaker._opened_at = mc.CircuitBreaker.OPEN, time.monotonic() - mc.RESET_TIMEOUT
+        session = mock.Mock()
+        session.get.side_effect = requests.exceptions.ChunkedEncodingError("truncated body")
+        with mock.patch.object(mc, "METAR_URL", "http://127.0.0.1:1/api/data/metar"), \
+                mock.patch.object(mc, "getSession", return_value=session):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                mc.conditionalGet("LOWW")
+            self.assertEqual(breaker.state, mc.CircuitBreaker.OPEN)
+            self.assertFalse(breaker._probing)
+            # the open circuit fails without taking a token
+            tokens = limiter._tokens
+            with self.assertRaises(mc.UpstreamUnavailable):
+                mc.conditionalGet("LOWW")
+            self.assertEqual(limiter._tokens, tokens)
+
+class TestTokenBucket(unittest.TestCase):
+
+    def testRateAdaptsToThrottling(self):
+        clock = FakeClock()
+        bucket = mc.TokenBucket(rate=10, burst=2, clock=clock, sleep=clock.sleep)
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertAlmostEqual(clock.now, 0.1)
+        bucket.throttle(retry_after=5)
+        self.assertEqual(bucket.rate, 5)
+        self.assertFalse(bucket.acquire(timeout=1))
+        self.assertTrue(bucket.acquire())
+        self.assertGreaterEqual(clock.now, 5.1)
+        bucket.recover()
+        self.assertEqual(bucket.rate, 6)
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # statuses answered before the stub recovers, None hangs the request
+    failures = []
+    requests = 0
+
+    def do_GET(self):
+        FlakyHandler.requests += 1
+        status = FlakyHandler.failures.pop(0) if FlakyHandler.failures else 200
+        if status is None:
+            time.sleep(1)
+            return
+        body = STUB_METARS["LOWW"].encode() if status == 200 else b""
+        self.send_response(status)
+        if status in (429, 503):
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestResilientFetch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings = (mc.METAR_URL, mc.BACKOFF_BASE, mc.READ_TIMEOUT)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        mc.METAR_URL = f"http://127.0.0.1:{self.server.server_port}/api/data/metar"
+        mc.BACKOFF_BASE = 0.01
+        mc.READ_TIMEOUT = 0.2
+        mc._upstreams.clear()
+        mc._validators.clear()
+        FlakyHandler.failures = []
+        FlakyHandler.requests = 0
+
+    def tearDown(self):
+        mc.METAR_URL, mc.BACKOFF_BASE, mc.READ_TIMEOUT = self.settings
+
+    def testRetriesAndThrottles(self):
+        FlakyHandler.failures = [503, 429]
+        self.assertEqual(mc.conditionalGet("LOWW"), STUB_METARS["LOWW"])
+        self.assertEqual(FlakyHandler.requests, 3)
+        breaker, limiter = mc.getUpstream(mc.METAR_URL)
+        self.assertEqual(breaker.state, mc.CircuitBreaker.CLOSED)
+        self.assertLess(limiter.rate, mc.UPSTREAM_RATE)
+
+    def testHangingUpstreamTimesOut(self):
+        FlakyHandler.failures = [None] * (mc.MAX_RETRIES + 1)
+        start = time.monotonic()
+        with self.assertRaises(requests.exceptions.Timeout):
+            mc.conditionalGet("LOWW")
+        self.assertLess(time.monotonic() - start, 3)
+
+    def testOpenCircuitFailsFast(self):
+        FlakyHandler.failures = [500] * mc.FAILURE_THRESHOLD
+        with self.assertRaises(requests.exceptions.HTTPError):
+            mc.conditionalGet("LOWW")
+        # the circuit opens during the retries of the second call
+        with self.assertRaises(mc.UpstreamUnavailable):
+            mc.conditionalGet("LOWW")
+        requests_sent = FlakyHandler.requests
+        self.assertEqual(requests_sent, mc.FAILURE_THRESHOLD)
+        with self.assertRaises(mc.UpstreamUnavailable):
+            mc.conditionalGet("LOWW")
+        self.assertIsNone(mc.fetchMETAR("LOWW"))
+        self.assertEqual(FlakyHandler.requests, requests_sent)
+        self.assertEqual(mc.upstreamStatus()[f"127.0.0.1:{self.server.server_port}"]["circuit"], "open")
+
+    def testExhaustedRateLimitIsNoFailure(self):
+        breaker, limiter = mc.getUpstream(mc.METAR_URL)
+        limiter._tokens, limiter.rate = 0.0, 0.1
+        with self.assertRaises(mc.RateLimited):
+            mc.conditionalGet("LOWW", deadline=1)
+        self.assertEqual(FlakyHandler.requests, 0)
+        self.assertEqual((breaker.state, breaker.failures), (mc.CircuitBreaker.CLOSED, 0))
+
+if __name__ == '__main__':
+    unittest.main()
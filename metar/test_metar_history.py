@@ -0,0 +1,100 @@
+import time
+import unittest
+import numpy as np
+import metar_history as mh
+from metar_history import HistoryStore
+import metar_parser as mp
+
+class TestDerivedMetrics(unittest.TestCase):
+
+    def testRelativeHumidity(self):
+        humidity = mh.relativeHumidity([6, 20, np.nan], [4, 20, 5])
+        self.assertAlmostEqual(humidity[0], 87.0, delta=0.1)
+        self.assertEqual(humidity[1], 100.0)
+        self.assertTrue(np.isnan(humidity[2]))
+
+    def testDensityAltitude(self):
+        # ISA conditions at sea level and 5000ft
+        altitude = mh.densityAltitude([0, 5000], [1013.25, 1013.25], [15, 30])
+        self.assertAlmostEqual(altitude[0], 0.0, delta=1)
+        self.assertAlmostEqual(altitude[1], 5000 + 118.8 * (30 - 5.1), delta=1)
+
+    def testWindComponents(self):
+        headwind, crosswind = mh.windComponents([290, 200, np.nan], [20, 10, 5], 290)
+        self.assertAlmostEqual(headwind[0], 20)
+        self.assertAlmostEqual(crosswind[0], 0)
+        self.assertAlmostEqual(crosswind[1], -10)
+        self.assertTrue(np.isnan(headwind[2]))
+
+    def testFlightCategory(self):
+        categories = mh.flightCategory([9999, 9999, 4000, 1000, 9999, np.nan],
+                                       [np.nan, 2500, np.nan, 5000, 300, np.nan])
+        self.assertEqual([mh.FLIGHT_CATEGORIES[c] for c in categories[:5]],
+                         ["VFR", "MVFR", "IFR", "LIFR", "LIFR"])
+        self.assertEqual(categories[5], -1)
+
+class TestHistoryStore(unittest.TestCase):
+
+    def testRingBuffer(self):
+        store = HistoryStore(capacity=2, stations=1)
+        for metar in ("LOWW 301050Z 30010KT 9999 FEW030 10/05 Q1015",
+                      "LOWW 301120Z 30012KT 9999 BKN030 11/05 Q1014",
+                      "LOWW 301150Z 30014KT 9999 OVC030 12/05 Q1013",
+                      "LOWG 301150Z VRB02KT 9999 NSC 08/07 Q1020"):
+            store.append(mp.parseObservation(metar))
+        self.assertEqual(len(store), 2)
+        loww = store.station("LOWW")
+        self.assertEqual(list(loww["temperature"]), [11, 12])
+        self.assertEqual(list(loww["ceiling"]), [3000, 3000])
+        self.assertTrue(np.isnan(store.station("LOWG")["wind_direction"][0]))
+        self.assertIsNone(store.station("EDDM"))
+
+        metrics = store.deriveMetrics(elevation=[600, 1100], runway_heading=[290, 350])
+        self.assertEqual(metrics["humidity"].shape, (2, 2))
+        self.assertAlmostEqual(metrics["headwind"][0, 0], 14 * np.cos(np.radians(10)))
+        self.assertEqual(mh.FLIGHT_CATEGORIES[metrics["flight_category"][1, 0]], "VFR")
+
+    def testLatestMetrics(self):
+        store = HistoryStore(capacity=2, stations=1)
+        for metar in ("LOWW 301050Z 30010KT 9999 FEW030 10/05 Q1015",
+                      "LOWW 301120Z 30012KT 1200 BR OVC004 11/11 Q1014",
+                      "LOWI 301150Z 24004KT 9999 FEW050 15/M02 Q1013"):
+            store.append(mp.parseObservation(metar))
+        latest = store.latestMetrics({"LOWW": 600, "LOWI": 1900}.get)
+        self.assertEqual(latest["LOWW"]["humidity"], 100.0)
+        self.assertEqual(mh.FLIGHT_CATEGORIES[latest["LOWW"]["flight_category"]], "LIFR")
+        self.assertEqual(mh.FLIGHT_CATEGORIES[latest["LOWI"]["flight_category"]], "VFR")
+        self.assertAlmostEqual(latest["LOWI"]["density_altitude"],
+                               mh.densityAltitude(1900, 1013, 15), delta=0.01)
+
+    def testMetricsAreCalculatedOnACopy(self):
+        store = HistoryStore(capacity=2, stations=1)
+        store.append(mp.parseObservation("LOWW 301050Z 30010KT 9999 FEW030 10/05 Q1015"))
+        stations, columns, latest = store._snapshot()
+        store.append(mp.parseObservation("LOWW 301120Z 30012KT 9999 FEW030 20/05 Q1014"))
+        self.assertEqual(store.columns["temperature"][0, 1], 20)
+        self.assertTrue(np.isnan(columns["temperature"][0, 1]))
+        self.assertEqual(list(latest), [0])
+
+    def testDeriveMetricsSpeed(self):
+        store = HistoryStore(capacity=48, stations=10000)
+        store.index = {f"S{row:04d}": row for row in range(10000)}
+        shape = (10000, 48)
+        store.columns["temperature"][:] = np.random.uniform(-20, 35, shape)
+        store.columns["dew_point"][:] = store.columns["temperature"] - np.random.uniform(0, 15, shape)
+        store.columns["wind_direction"][:] = np.random.uniform(0, 360, shape)
+        store.columns["wind_speed"][:] = np.random.uniform(0, 40, shape)
+        store.columns["qnh"][:] = np.random.uniform(980, 1040, shape)
+        store.columns["visibility"][:] = np.random.uniform(100, 9999, shape)
+        store.columns["ceiling"][:] = np.random.uniform(100, 10000, shape)
+        elevation = np.random.uniform(0, 8000, 10000)
+        heading = np.random.uniform(0, 360, 10000)
+
+        start = time.perf_counter()
+        metrics = store.deriveMetrics(elevation, heading)
+        seconds = time.perf_counter() - start
+        self.assertEqual(metrics["density_altitude"].shape, shape)
+        self.assertLess(seconds, 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
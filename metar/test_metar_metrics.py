@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from prometheus_client import CollectorRegistry, REGISTRY
+import metar_metrics
+import metar_parser as mp
+from metar_cache import LatestObservationCache
+from metar_history import HistoryStore
+
+class TestMetarMetrics(unittest.TestCase):
+
+    def testParseFailuresByGroup(self):
+        reports = {
+            "station": "12 191820Z 15010KT CAVOK 06/M05 Q1029",
+            "time": "BROK GARBAGE",
+            "wind": "LOWW 191820Z",
+            "visibility": "LOWW 191820Z AUTO 15010KT",
+            "temperature": "LOWW 191820Z 15010KT CAVOK",
+        }
+        for group, report in reports.items():
+            before = REGISTRY.get_sample_value("metar_parse_failures_total", {"group": group}) or 0
+            self.assertIsNone(mp.parseObservation(report, memo=None))
+            self.assertEqual(REGISTRY.get_sample_value("metar_parse_failures_total", {"group": group}), before + 1, group)
+
+    def testCacheStatisticsAreCollected(self):
+        registry = CollectorRegistry()
+        cache = LatestObservationCache()
+        metar_metrics.registerCache(cache, registry)
+        cache.put("LOWW", {})
+        cache.get("LOWW")
+        cache.get("KJFK")
+        self.assertEqual(registry.get_sample_value("metar_cache_hits_total"), 1)
+        self.assertEqual(registry.get_sample_value("metar_cache_misses_total"), 1)
+        self.assertEqual(registry.get_sample_value("metar_cache_size"), 1)
+        body, content_type = metar_metrics.exposition(registry)
+        self.assertIn(b"metar_cache_evictions_total 0.0", body)
+
+    def testDerivedMetricsOfTheHistory(self):
+        registry = CollectorRegistry()
+        history = HistoryStore(stations=1)
+        history.append(mp.parseObservation("LOWW 301120Z 30012KT 1200 BR OVC004 11/11 Q1014"))
+        metar_metrics.registerHistory(history, {"LOWW": 600}.get, registry)
+        self.assertEqual(registry.get_sample_value("metar_station_humidity_percent", {"icao": "LOWW"}), 100.0)
+        self.assertEqual(registry.get_sample_value("metar_station_flight_category", {"icao": "LOWW", "category": "LIFR"}), 1)
+        self.assertEqual(registry.get_sample_value("metar_station_flight_category", {"icao": "LOWW", "category": "VFR"}), 0)
+        self.assertIsNotNone(registry.get_sample_value("metar_station_density_altitude_feet", {"icao": "LOWW"}))
+
+    def testCacheStatisticsAreAggregatedWithTheOtherProcesses(self):
+        registry = CollectorRegistry()
+        metar_metrics.registerCache(LatestObservationCache(), registry, prefix="metar_test_cache")
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}):
+            body, content_type = metar_metrics.exposition(registry)
+        self.assertIn(b"metar_test_cache_size 0.0", body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import json
+from datetime import datetime, timezone
+import metar_parser as mp
+from metar_observation import MetarObservation, CloudCover, CloudLayer, ConvectiveCloud, Intensity, Phenomenon
+
+class TestMetarObservation(unittest.TestCase):
+
+    def test_typed_fields(self):
+        observation = mp.parseObservation("KDEN 191853Z 36008G15KT 1/2SM +TSRAGR BKN005 OVC015CB 14/12 A3001")
+        self.assertEqual((observation.wind_direction, observation.wind_speed, observation.wind_gust), (360, 8, 15))
+        self.assertEqual(observation.visibility, 805)
+        self.assertEqual(observation.weather[0].intensity, Intensity.HEAVY)
+        self.assertEqual(observation.weather[0].phenomena, (Phenomenon.RA, Phenomenon.GR))
+        self.assertEqual(observation.clouds[1], CloudLayer(CloudCover.OVC, 1500, ConvectiveCloud.CB))
+        self.assertEqual((observation.temperature, observation.dew_point, observation.qnh), (14, 12, 1016))
+        self.assertEqual(observation.humidity, 87.7)
+        self.assertEqual(observation.ceiling, 500)
+
+    def test_to_dict_matches_legacy_shape(self):
+        metar = "EGLL 191820Z AUTO 24015G25KT 200V280 9999 -RA BKN012 OVC025 12/10 Q1003"
+        result = mp.parseObservation(metar).to_dict()
+        self.assertEqual(result["update"], "AUTO")
+        self.assertEqual(result["wind"], {"direction": 240, "speed": 15, "unit": "KT", "gust": 25})
+        self.assertEqual(result["wind_variation"], {"min_direction": 200, "max_direction": 280})
+        self.assertEqual(result["weather"], "light rain")
+        self.assertEqual(result["clouds"], ["broken clouds at 1200ft", "overcast at 2500ft"])
+        self.assertEqual(result["temperatures"], {"temperature": 12, "dew_point": 10})
+        self.assertEqual(result, mp.parseMETAR(metar))
+
+    def test_to_json(self):
+        observation = MetarObservation("LOWW", datetime(2024, 10, 19, 18, 20, tzinfo=timezone.utc))
+        result = observation.to_json()
+        self.assertEqual(result["time"], "2024-10-19T18:20:00+00:00")
+        self.assertIsNone(result["wind"])
+        self.assertEqual(json.loads(json.dumps(result)), result)
+
+    def test_slots(self):
+        observation = MetarObservation("LOWW")
+        with self.assertRaises(AttributeError):
+            observation.unknown = 1
+
+if __name__ == '__main__':
+    unittest.main()
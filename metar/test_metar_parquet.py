@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pyarrow.parquet as pq
+from influxdb_client import InfluxDBClient
+import TimeSeriesRepository as tsr
+import metar_parquet
+
+# the response of the export query, wind_gust has no value in the range, the
+# second LOWW point holds variable wind as written before wind_variable existed
+EXPORT_CSV = (
+    ",result,table,_time,icao,dewpoint,humidity,qnh,temperature,visibility,weather,wind_direction,wind_speed,wind_variable\r\n"
+    ",_result,0,2024-10-19T18:20:00Z,LOWW,-5,45.2,1029,6,10000,,150,10,false\r\n"
+    ",_result,0,2024-10-19T18:50:00Z,LOWW,-4,47.1,1028,6,9000,\"light rain, mist\",VRB,12,\r\n"
+    ",_result,0,2024-10-19T18:20:00Z,LOWG,,,1027,,,,,,\r\n"
+    "\r\n"
+)
+
+class StubInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    queries = []
+    writes = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        if self.path.startswith("/api/v2/query"):
+            StubInfluxHandler.queries.append(json.loads(body)["query"])
+            response = EXPORT_CSV.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+        else:
+            StubInfluxHandler.writes.append(body.splitlines())
+            response = b""
+            self.send_response(204)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestParquet(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubInfluxHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubInfluxHandler.queries = []
+        StubInfluxHandler.writes = []
+        client = InfluxDBClient(url=f"http://127.0.0.1:{self.server.server_port}", token="token", org="org")
+        self.repository = tsr.MetarRepository(client)
+        self.addCleanup(self.repository.close)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "history.parquet")
+
+    def testExportAndImport(self):
+        rows = metar_parquet.exportParquet(self.path, start="-7d", icaos=["loww", "LOWG"], client=self.repository.client)
+        self.assertEqual(rows, 3)
+        self.assertIn('set: ["LOWW", "LOWG"]', StubInfluxHandler.queries[0])
+
+        table = pq.read_table(self.path)
+        self.assertEqual(table.schema, metar_parquet.PARQUET_SCHEMA)
+        self.assertEqual(table.column("temperature").to_pylist(), [6, 6, None])
+        self.assertEqual(table.column("wind_gust").null_count, 3)
+        self.assertEqual(table.column("weather").to_pylist(), [None, "light rain, mist", None])
+        self.assertEqual(table.column("wind_direction").to_pylist(), [150, None, None])
+        self.assertEqual(table.column("wind_variable").to_pylist(), [False, True, None])
+
+        self.assertEqual(metar_parquet.importParquet(self.path, batch_size=2, repository=self.repository), 3)
+        self.assertEqual(len(StubInfluxHandler.writes), 2)
+        self.assertEqual(StubInfluxHandler.writes[0][1],
+                         'metar,icao=LOWW temperature=6i,dewpoint=-4i,humidity=47.1,wind_variable=true,'
+                         'wind_speed=12i,visibility=9000i,weather="light rain, mist",qnh=1028i 1729363800000000000')
+        self.assertEqual(StubInfluxHandler.writes[1], ["metar,icao=LOWG qnh=1027i 1729362000000000000"])
+
+    def testInvalidStation(self):
+        with self.assertRaises(ValueError):
+            metar_parquet.exportParquet(self.path, icaos=["LOWW\") |> drop("], client=self.repository.client)
+
+if __name__ == '__main__':
+    unittest.main()
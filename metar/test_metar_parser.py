@@ -1,4 +1,5 @@
 import unittest
+from datetime import datetime, timezone
 import metar_parser as mp
 
 class TestMetarParser(unittest.TestCase):
@@ -24,5 +25,140 @@ class TestMetarParser(unittest.TestCase):
         result = mp.parseMETAR(metar)
         self.assertEqual(result["wind"]["gust"], 29)
 
+    def test_fractional_visibility_rvr_and_weather_groups(self):
+        metar = "KORD 191851Z 27012G20KT 1 1/2SM R28R/2600FT/D -SN BR OVC008 M02/M04 A2990 RMK AO2"
+        result = mp.parseMETAR(metar)
+        self.assertEqual(result["visibility"], 2414)
+        self.assertEqual(result["rvr"], [{'runway': '28R', 'min_range': 792, 'max_range': 792, 'unit': 'M', 'trend': 'D'}])
+        self.assertEqual(result["weather"], "light snow, mist")
+        self.assertEqual(result["clouds"], ["overcast at 800ft"])
+        self.assertEqual(result["temperatures"], {"temperature": -2, "dew_point": -4})
+
+    def test_metric_rvr_vertical_visibility_and_variable_wind(self):
+        metar = "EDDF 191820Z VRB03KT 0400 R25L/0550N R25C/P1500U FG VV002 04/04 Q1021 BECMG 1500"
+        result = mp.parseMETAR(metar)
+        self.assertEqual(result["wind"], {'direction': 'VRB', 'speed': 3, 'unit': 'KT', 'gust': None})
+        self.assertEqual([rvr["min_range"] for rvr in result["rvr"]], [550, 1500])
+        self.assertEqual(result["weather"], "fog")
+        self.assertEqual(result["clouds"], ["vertical visibility 200ft"])
+
+    def test_convective_clouds_and_wind_variation(self):
+        metar = "RJTT 191800Z 34005KT 300V020 6000 VCSH FEW020CB SCT030 BKN100 18/14 Q1015 NOSIG"
+        result = mp.parseMETAR(metar)
+        self.assertEqual(result["wind_variation"], {"min_direction": 300, "max_direction": 20})
+        self.assertEqual(result["weather"], "vicinity showers")
+        self.assertEqual(result["clouds"][0], "few clouds at 2000ft cumulonimbus")
+
+    def test_mps_wind_is_converted(self):
+        result = mp.parseMETAR("UUEE 191830Z 03005G10MPS 1200 BR NSC M05/M07 Q1031")
+        self.assertEqual(result["wind"], {'direction': 30, 'speed': 9, 'unit': 'KT', 'gust': 19})
+        self.assertEqual(result["clouds"], ["no significant clouds"])
+
+    def test_malformed_metar(self):
+        self.assertIsNone(mp.parseMETAR("ZZZZ BROKEN"))
+
+    def test_weather_group_needs_a_phenomenon(self):
+        for token in ("-", "+", "VC", "FZ", "VCFZ", "-BC"):
+            self.assertIsNone(mp.WEATHER_PATTERN.match(token), token)
+        self.assertEqual(mp.parseWeatherCodes("TS"), "thunderstorm")
+        self.assertEqual(mp.parseWeatherCodes("VCSH"), "vicinity showers")
+        self.assertEqual(mp.parseWeatherCodes("+TSRAGR"), "heavy thunderstorm rain and hail")
+
+    def test_token_table_is_bounded(self):
+        table = mp.TokenTable(mp.parseQNH, maxsize=2)
+        self.assertEqual([table[token] for token in ("Q1013", "A2992", "Q1013", "XXXX")], [1013, 1013, 1013, None])
+        self.assertLessEqual(len(table), 2)
+
+class TestReferenceTime(unittest.TestCase):
+    def test_day_is_resolved_to_latest_month_with_that_day(self):
+        reference = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+        self.assertEqual(mp.parseTime("311200Z", reference), datetime(2024, 1, 31, 12, 0, tzinfo=timezone.utc))
+        self.assertEqual(mp.parseTime("011150Z", reference), datetime(2024, 3, 1, 11, 50, tzinfo=timezone.utc))
+
+    def test_year_boundary(self):
+        reference = datetime(2025, 1, 1, 0, 10, tzinfo=timezone.utc)
+        self.assertEqual(mp.parseTime("312350Z", reference), datetime(2024, 12, 31, 23, 50, tzinfo=timezone.utc))
+
+    def test_clock_skew_allows_reports_slightly_ahead(self):
+        reference = datetime(2024, 12, 31, 23, 55, tzinfo=timezone.utc)
+        self.assertEqual(mp.parseTime("010005Z", reference), datetime(2025, 1, 1, 0, 5, tzinfo=timezone.utc))
+
+    def test_invalid_day(self):
+        self.assertIsNone(mp.parseTime("321200Z", datetime(2024, 3, 1, tzinfo=timezone.utc)))
+
+class TestParseMemo(unittest.TestCase):
+    METAR = "LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG"
+
+    def test_repeated_report_is_parsed_once(self):
+        memo = mp.ParseMemo()
+        reference = datetime(2024, 3, 20, tzinfo=timezone.utc)
+        first = mp.parseObservation(self.METAR, reference, memo)
+        self.assertIs(mp.parseObservation(self.METAR, reference, memo), first)
+        self.assertEqual(memo.stats()["hits"], 1)
+        self.assertEqual(memo.stats()["misses"], 1)
+
+    def test_entry_is_parsed_again_once_the_month_changes(self):
+        memo = mp.ParseMemo()
+        march = mp.parseObservation(self.METAR, datetime(2024, 3, 20, tzinfo=timezone.utc), memo)
+        april = mp.parseObservation(self.METAR, datetime(2024, 4, 20, tzinfo=timezone.utc), memo)
+        self.assertEqual(march.time.month, 3)
+        self.assertEqual(april.time.month, 4)
+        self.assertEqual(memo.stats()["hits"], 0)
+
+    def test_entry_older_than_a_month_is_found(self):
+        # 191820Z resolves to the 19th of February until the reference passes the 18th of March 18:20
+        memo = mp.ParseMemo()
+        reference = datetime(2024, 3, 18, 12, tzinfo=timezone.utc)
+        first = mp.parseObservation(self.METAR, reference, memo)
+        self.assertEqual(first.time.month, 2)
+        self.assertIs(mp.parseObservation(self.METAR, datetime(2024, 3, 18, 13, tzinfo=timezone.utc), memo), first)
+        self.assertEqual(memo.stats()["hits"], 1)
+
+    def test_failures_are_remembered(self):
+        memo = mp.ParseMemo()
+        self.assertIsNone(mp.parseObservation("ZZZZ BROKEN", memo=memo))
+        self.assertIsNone(mp.parseObservation("ZZZZ BROKEN", memo=memo))
+        self.assertEqual(memo.stats()["hits"], 1)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        memo = mp.ParseMemo(maxsize=2)
+        reference = datetime(2024, 3, 20, tzinfo=timezone.utc)
+        for icao in ("LOWW", "LOWG", "LOWW", "LOWI"):
+            mp.parseObservation(self.METAR.replace("LOWW", icao), reference, memo)
+        stats = memo.stats()
+        self.assertEqual((stats["size"], stats["evictions"]), (2, 1))
+        self.assertTrue(memo.get(self.METAR, reference)[0])
+        self.assertFalse(memo.get(self.METAR.replace("LOWW", "LOWG"), reference)[0])
+
+class TestFullReport(unittest.TestCase):
+    def test_recent_weather_trends_and_remarks(self):
+        result = mp.parseMETAR("SPECI EDDF 191820Z 24012KT 9999 -RA BKN012 08/06 Q1008 RERA "
+                               "TEMPO 3000 RA BKN008 BECMG FM1900 TL2000 27015G25KT NSW RMK WIND 2000FT 25030KT=")
+        self.assertEqual(result["report_type"], "SPECI")
+        self.assertEqual(result["QNH"], 1008)
+        self.assertEqual(result["recent_weather"], "rain")
+        self.assertEqual(result["trends"], [
+            {"kind": "TEMPO", "visibility": 3000, "weather": "rain", "clouds": ["broken clouds at 800ft"]},
+            {"kind": "BECMG", "time_from": "1900", "time_until": "2000",
+             "wind": {"direction": 270, "speed": 15, "unit": "KT", "gust": 25}, "weather": "no significant weather"},
+        ])
+        self.assertEqual(result["remarks"], "WIND 2000FT 25030KT")
+
+    def test_nosig(self):
+        result = mp.parseMETAR("LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG")
+        self.assertEqual(result["report_type"], "METAR")
+        self.assertEqual(result["trends"], [{"kind": "NOSIG"}])
+        self.assertIsNone(result["remarks"])
+
+    def test_split_reports(self):
+        text = ("METAR LOWW 191820Z 15010KT CAVOK 06/M05\n  Q1029 NOSIG=\n\n"
+                "KJFK 202300Z 24004KT 10SM CLR 28/22 A2992\nZZZZ BROKEN\n")
+        self.assertEqual(list(mp.iterReports(text)), [
+            "METAR LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG",
+            "KJFK 202300Z 24004KT 10SM CLR 28/22 A2992",
+            "ZZZZ BROKEN",
+        ])
+        self.assertEqual([observation.station for observation in mp.parseReports(text, memo=None)], ["LOWW", "KJFK"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
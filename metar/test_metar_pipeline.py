@@ -0,0 +1,158 @@
+import unittest
+import threading
+import time
+import metar_crawler as mc
+from metar_crawler import ReportTracker
+from metar_history import HistoryStore
+from metar_pipeline import IngestionPipeline
+
+METARS = {
+    "LOWW": "LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG",
+    "KJFK": "KJFK 202300Z 24004KT 10SM CLR 28/22 A2992",
+    "EDDF": "EDDF 191820Z 22008KT 9999 FEW040 12/04 Q1021 NOSIG",
+    "BROK": "BROK GARBAGE",
+}
+
+def fetchMETARs(ids, deadline):
+    return "\n".join(METARS[icao] for icao in ids.split(",") if icao in METARS)
+
+def stationReports(ids):
+    return "\n".join(METARS["LOWW"].replace("LOWW", icao) for icao in ids.split(","))
+
+class TestIngestionPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.threads = set()
+
+    def write(self, batch):
+        self.threads.add(threading.current_thread().name.rsplit("_", 1)[0])
+        self.batches.append(list(batch))
+
+    def testCycle(self):
+        history = HistoryStore(stations=4)
+        pipeline = IngestionPipeline(fetch=fetchMETARs, write=self.write, reports=ReportTracker(), history=history,
+                                     write_batch_size=2)
+        try:
+            result = pipeline.run(list(METARS) + ["XXXX"])
+        finally:
+            pipeline.close()
+        self.assertEqual(result.requests, 1)
+        self.assertEqual(result.fetched, 4)
+        self.assertEqual(result.fetch_failures, 1)
+        self.assertEqual(result.parse_failures, 1)
+        self.assertEqual(result.written, 3)
+        stations = sorted(metar["station"] for batch in self.batches for metar in batch)
+        self.assertEqual(stations, ["EDDF", "KJFK", "LOWW"])
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+        self.assertEqual(sorted(history.index), ["EDDF", "KJFK", "LOWW"])
+        self.assertEqual(history.station("LOWW")["temperature"][0], 6)
+
+    def testUnchangedReportsAreSkipped(self):
+        pipeline = IngestionPipeline(fetch=fetchMETARs, write=self.write, reports=ReportTracker())
+        try:
+            pipeline.run(list(METARS))
+            result = pipeline.run(list(METARS))
+        finally:
+            pipeline.close()
+        self.assertEqual(result.fetched, 4)
+        # the broken report was never stored, it is parsed again
+        self.assertEqual(result.unchanged, 3)
+        self.assertEqual(result.parse_failures, 1)
+        self.assertEqual(result.written, 0)
+        self.assertEqual(sum(len(batch) for batch in self.batches), 3)
+
+    def testReportsOfFailedBatchesAreProcessedAgain(self):
+        failures = [OSError("InfluxDB is down")]
+        def write(batch):
+            if failures:
+                raise failures.pop()
+            self.write(batch)
+
+        pipeline = IngestionPipeline(fetch=fetchMETARs, write=write, reports=ReportTracker(), history=None)
+        try:
+            failed = pipeline.run(["LOWW"])
+            result = pipeline.run(["LOWW"])
+        finally:
+            pipeline.close()
+        self.assertEqual((failed.write_failures, failed.written), (1, 0))
+        self.assertEqual((result.unchanged, result.written), (0, 1))
+
+    def testSlowStationTimesOut(self):
+        deadlines = []
+        def fetch(ids, deadline):
+            deadlines.append(deadline)
+            if ids == "KJFK":
+                time.sleep(1)
+            return METARS[ids]
+
+        pipeline = IngestionPipeline(fetch=fetch, write=self.write, reports=ReportTracker(), max_ids=1,
+                                     fetch_timeout=0.1)
+        try:
+            start = time.monotonic()
+            result = pipeline.run(["LOWW", "KJFK", "EDDF"])
+            self.assertLess(time.monotonic() - start, 0.9)
+        finally:
+            pipeline.close()
+        self.assertEqual(result.timeouts, 1)
+        self.assertEqual(result.written, 2)
+        # the fetch itself gives up by the fetch timeout
+        self.assertEqual(set(deadlines), {0.1})
+        # writes do not share threads with hanging fetches
+        self.assertEqual(self.threads, {"ingestion-write"})
+
+    def testFetchConcurrencyIsBounded(self):
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def fetch(ids, deadline):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return stationReports(ids)
+
+        pipeline = IngestionPipeline(fetch=fetch, write=self.write, reports=None, fetch_concurrency=4, queue_size=2,
+                                     max_ids=1)
+        try:
+            result = pipeline.run([f"L{index:03d}" for index in range(40)])
+        finally:
+            pipeline.close()
+        self.assertEqual(result.written, 40)
+        self.assertLessEqual(active[1], 4)
+
+    def testRateLimitedStationsAreFetchedNextCycle(self):
+        limited = [mc.RateLimited("no token")]
+        def fetch(ids, deadline):
+            if limited:
+                raise limited.pop()
+            return fetchMETARs(ids, deadline)
+
+        pipeline = IngestionPipeline(fetch=fetch, write=self.write, reports=ReportTracker(), history=None)
+        try:
+            with self.assertLogs(level="WARNING"):
+                first = pipeline.run(["LOWW", "EDDF"])
+            second = pipeline.run(["LOWW", "EDDF"])
+        finally:
+            pipeline.close()
+        self.assertEqual((first.rate_limited, first.fetch_failures, first.written), (2, 0, 0))
+        self.assertEqual((second.rate_limited, second.unchanged, second.written), (0, 0, 2))
+
+    def testOneRequestPerChunk(self):
+        requests = []
+        def fetch(ids, deadline):
+            requests.append(ids)
+            return stationReports(ids)
+
+        pipeline = IngestionPipeline(fetch=fetch, write=self.write, reports=None)
+        try:
+            result = pipeline.run([f"L{index:03d}" for index in range(1000)])
+        finally:
+            pipeline.close()
+        self.assertEqual((result.requests, len(requests)), (5, 5))
+        self.assertEqual(result.written, 1000)
+
+if __name__ == '__main__':
+    unittest.main()
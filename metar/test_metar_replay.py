@@ -0,0 +1,60 @@
+import unittest
+import requests
+import metar_parser as mp
+import metar_replay
+
+CORPUS = ["LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG",
+          "METAR KJFK 202300Z 24004KT 10SM CLR 28/22 A2992"]
+
+class TestReplayUpstream(unittest.TestCase):
+
+    def upstream(self, **options):
+        upstream = metar_replay.ReplayUpstream(**options).start()
+        self.addCleanup(upstream.stop)
+        return upstream
+
+    def testReportsAdvanceWithCycles(self):
+        upstream = self.upstream(corpus=CORPUS)
+        first = upstream.report("LOWW")
+        upstream.advance()
+        second = upstream.report("LOWW")
+        self.assertNotEqual(first.split()[1:], second.split()[1:])
+        for report in (first, second):
+            metar = mp.parseMETAR(report)
+            self.assertEqual(metar["station"], "LOWW")
+            self.assertEqual(metar["time"].strftime("%d%H%MZ"), report.split()[1])
+
+        response = requests.get(upstream.url, params={"ids": "LOWW,kjfk"}, timeout=5)
+        self.assertEqual(response.text.splitlines(), [second, upstream.report("KJFK")])
+
+    def testErrorMixAndRateLimit(self):
+        upstream = self.upstream(errors={500: 1.0})
+        self.assertEqual(requests.get(upstream.url, params={"ids": "LOWW"}, timeout=5).status_code, 500)
+
+        upstream = self.upstream(rate=2)
+        statuses = [requests.get(upstream.url, params={"ids": "LOWW"}, timeout=5).status_code for _ in range(5)]
+        self.assertIn(429, statuses)
+        self.assertEqual(sum(upstream.responses.values()), 5)
+
+    def testParseErrors(self):
+        self.assertEqual(metar_replay.parseErrors("500=0.02, timeout=0.01"), {500: 0.02, "timeout": 0.01})
+        with self.assertRaises(ValueError):
+            metar_replay.parseErrors("500=0.8,503=0.3")
+
+    def testStationCodes(self):
+        self.assertEqual([metar_replay.stationCode(index) for index in (0, 35, 36)], ["Z000", "Z00Z", "Z010"])
+
+class TestRunLoad(unittest.TestCase):
+
+    def testStationsAreWrittenToTheSink(self):
+        with metar_replay.ReplayUpstream(seed=1) as upstream, metar_replay.MemorySink() as sink:
+            result = metar_replay.runLoad(upstream, sink, stations=20, cycles=2, concurrency=4)
+        self.assertGreater(result["processed"], 0)
+        self.assertEqual(result["processed"] + result["missing"], 40)
+        self.assertEqual(result["written"], result["processed"])
+        self.assertTrue(all(point.startswith("metar,icao=Z") for point in sink.points()))
+        self.assertLessEqual(result["latency_ms"]["p50"], result["latency_ms"]["max"])
+        self.assertEqual(result["responses"], {200: 40})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import random
+import time
+import unittest
+import numpy as np
+from metar_spatial import StationIndex, toUnitVectors
+from metar_stations import Station, StationRegistry
+
+def randomStations(count, seed=1):
+    generator = random.Random(seed)
+    return [Station(f"S{index:05d}", "", "", "", generator.uniform(-90, 90), generator.uniform(-180, 180), 0)
+            for index in range(count)]
+
+class TestStationIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stations = randomStations(5000)
+        cls.index = StationIndex(cls.stations)
+
+    def testNearestMatchesLinearScan(self):
+        points = toUnitVectors([s.latitude for s in self.stations], [s.longitude for s in self.stations])
+        generator = random.Random(2)
+        for _ in range(50):
+            latitude, longitude = generator.uniform(-90, 90), generator.uniform(-180, 180)
+            target = toUnitVectors([latitude], [longitude])[0]
+            expected = np.argsort(((points - target) ** 2).sum(axis=1))[:5]
+            nearest = self.index.nearest(latitude, longitude, 5)
+            self.assertEqual([station.icao for station, _ in nearest], [self.stations[i].icao for i in expected])
+
+    def testNearestDistance(self):
+        index = StationIndex([Station("LOWW", "", "", "AT", 48.1103, 16.5697, 600),
+                              Station("EDDF", "", "", "DE", 50.0333, 8.5706, 364)])
+        nearest = index.nearest(48.1103, 16.5697 + 1, 2)
+        self.assertEqual([station.icao for station, _ in nearest], ["LOWW", "EDDF"])
+        self.assertAlmostEqual(nearest[0][1], 74.2, delta=0.2)
+        self.assertEqual(len(index.nearest(48.1103, 17.5697, 2, max_distance=100)), 1)
+
+    def testWithinMatchesLinearScan(self):
+        for south, west, north, east in ((40, -10, 50, 20), (-5, 170, 5, -170), (80, -180, 90, 180)):
+            if west <= east:
+                expected = [s for s in self.stations if south <= s.latitude <= north and west <= s.longitude <= east]
+            else:
+                expected = [s for s in self.stations if south <= s.latitude <= north
+                            and (s.longitude >= west or s.longitude <= east)]
+            self.assertEqual(self.index.within(south, west, north, east), expected)
+
+    def testWithinClampsBounds(self):
+        start = time.perf_counter()
+        self.assertEqual(self.index.within(-1e9, -1e9, 1e9, 1e9), self.index.within(-90, -180, 90, 180))
+        self.assertLess(time.perf_counter() - start, 1)
+        with self.assertRaises(ValueError):
+            self.index.within(float("nan"), 0, 10, 10)
+
+    def testLookupsAreFast(self):
+        index = StationIndex(StationRegistry.fromCsv())
+        start = time.perf_counter()
+        for _ in range(100):
+            index.nearest(48.11, 16.57, 10)
+            index.within(46, 9, 49, 17)
+        self.assertLess((time.perf_counter() - start) / 100, 0.005)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from influxdb_client.rest import ApiException
+import metar_parser
+import metar_spool
+
+def points(start, count, timestamp=None):
+    return [f"metar,icao=L{index:03d} temperature={index}i {timestamp or 1700000000000000000 + index}"
+            for index in range(start, start + count)]
+
+class FlakyWriter:
+    def __init__(self, failures=0, successes=0):
+        # the first successes writes succeed, the next failures writes fail
+        self.failures = failures
+        self.successes = successes
+        self.batches = []
+
+    def __call__(self, lines):
+        if self.successes:
+            self.successes -= 1
+        elif self.failures:
+            self.failures -= 1
+            raise ConnectionError("InfluxDB unavailable")
+        self.batches.append(list(lines))
+
+def rejecting(status):
+    def write(lines):
+        raise ApiException(status=status)
+    return write
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def spool(self, **options):
+        spool = metar_spool.Spool(self.directory, **options)
+        self.addCleanup(spool.close)
+        return spool
+
+    def testDrainInBatchesAndDeleteSegments(self):
+        spool = self.spool(segment_bytes=200)
+        spool.append(points(0, 3))
+        spool.append(points(3, 3))
+        spool.append(points(6, 3))
+        self.assertEqual(len(spool.segments()), 3)
+        writer = FlakyWriter()
+        drainer = metar_spool.SpoolDrainer(spool, writer, batch_size=2)
+        self.assertEqual(drainer.drain(), 9)
+        self.assertEqual([line for batch in writer.batches for line in batch], points(0, 9))
+        self.assertLessEqual(max(len(batch) for batch in writer.batches), 2)
+        # the newest segment is still appended to
+        self.assertEqual(len(spool.segments()), 1)
+        self.assertEqual(drainer.drain(), 0)
+
+    def testFailedWriteResumesFromCheckpoint(self):
+        spool = self.spool()
+        spool.append(points(0, 4))
+        spool.close()
+        drainer = metar_spool.SpoolDrainer(spool, FlakyWriter(failures=1, successes=1), batch_size=2)
+        with self.assertRaises(ConnectionError):
+            drainer.drain()
+
+        # a restarted process continues after the acknowledged batch
+        restarted = self.spool()
+        writer = FlakyWriter()
+        self.assertEqual(metar_spool.SpoolDrainer(restarted, writer).drain(), 2)
+        self.assertEqual(writer.batches, [points(2, 2)])
+        self.assertEqual(restarted.segments(), [])
+
+    def testTornWriteIsIgnored(self):
+        spool = self.spool()
+        spool.append(points(0, 2))
+        spool.close()
+        with open(os.path.join(self.directory, os.listdir(self.directory)[0]), "ab") as file:
+            file.write(b"metar,icao=LOWW temp")
+        writer = FlakyWriter()
+        self.assertEqual(metar_spool.SpoolDrainer(self.spool(), writer).drain(), 2)
+
+    def testSizeCapDropsOldestSegments(self):
+        spool = self.spool(segment_bytes=200, max_bytes=400)
+        for start in range(0, 30, 3):
+            spool.append(points(start, 3))
+        self.assertLessEqual(spool.size, 400)
+        writer = FlakyWriter()
+        metar_spool.SpoolDrainer(spool, writer).drain()
+        drained = [line for batch in writer.batches for line in batch]
+        self.assertEqual(drained, points(30 - len(drained), len(drained)))
+
+    def testCompactionDropsDuplicates(self):
+        spool = self.spool(segment_bytes=200)
+        for _ in range(3):
+            spool.append(points(0, 3))
+        spool.append(points(3, 1, timestamp=1))
+        spool.close()
+        self.assertEqual(spool.compact(), 6)
+        self.assertEqual(len(spool.segments()), 1)
+        writer = FlakyWriter()
+        self.assertEqual(metar_spool.SpoolDrainer(spool, writer).drain(), 4)
+
+    def testRejectedBatchIsDeadLettered(self):
+        spool = self.spool()
+        spool.append(points(0, 4))
+        batches = []
+        def write(lines):
+            if lines[0] == points(0, 1)[0]:
+                rejecting(422)(lines)
+            batches.append(lines)
+        self.assertEqual(metar_spool.SpoolDrainer(spool, write, batch_size=2).drain(), 2)
+        self.assertEqual(batches, [points(2, 2)])
+        with open(os.path.join(self.directory, metar_spool.DEAD_LETTER_FILE)) as file:
+            self.assertEqual(file.read().splitlines(), points(0, 2))
+        # server errors are retried
+        spool.append(points(4, 1))
+        with self.assertRaises(ApiException):
+            metar_spool.SpoolDrainer(spool, rejecting(503)).drain()
+
+    def testCompactionKeepsPointsWithoutTimestamp(self):
+        spool = self.spool(segment_bytes=50)
+        spool.append(['metar,icao=LOWW weather="light rain"'])
+        spool.append(['metar,icao=LOWW weather="heavy rain"'])
+        spool.close()
+        self.assertEqual(spool.compact(), 0)
+
+    def testDrainerThreadRetries(self):
+        spool = self.spool()
+        writer = FlakyWriter(failures=1)
+        drainer = metar_spool.SpoolDrainer(spool, writer, interval=0.01)
+        drainer.start()
+        spool.append(points(0, 5))
+        deadline = time.monotonic() + 5
+        while not writer.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        drainer.stop()
+        self.assertEqual(writer.batches, [points(0, 5)])
+
+    def testDrainerBacksOffByThePolicy(self):
+        spool = self.spool()
+        writer = FlakyWriter(failures=2)
+        failures = []
+        def backoff(failed):
+            failures.append(failed)
+            return 0.01
+        drainer = metar_spool.SpoolDrainer(spool, writer, interval=0.01, backoff=backoff)
+        spool.append(points(0, 5))
+        drainer.start()
+        deadline = time.monotonic() + 5
+        while not writer.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        drainer.stop()
+        self.assertEqual(failures, [1, 2])
+        self.assertEqual(writer.batches, [points(0, 5)])
+
+class TestSpoolMetars(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spool = metar_spool.Spool(directory.name)
+        self.addCleanup(self.spool.close)
+        for patch in (mock.patch.object(metar_spool, "getSpool", return_value=self.spool),
+                      mock.patch.dict(metar_spool._spooled_times, clear=True)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def testDuplicateObservationIsSkipped(self):
+        first = metar_parser.parseObservation("LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG").to_json()
+        second = metar_parser.parseObservation("LOWW 191850Z 15012KT CAVOK 06/M05 Q1029 NOSIG").to_json()
+        self.assertEqual(metar_spool.spoolMetars([first, first, second]), 2)
+        # the same observation from the other ingestion path
+        self.assertEqual(metar_spool.spoolMetars([second]), 0)
+
+    def testFailedAppendIsNotRemembered(self):
+        metar = metar_parser.parseObservation("LOWW 191820Z 15010KT CAVOK 06/M05 Q1029 NOSIG").to_json()
+        with mock.patch.object(self.spool, "append", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                metar_spool.spoolMetars([metar])
+        self.assertEqual(metar_spool.spoolMetars([metar]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
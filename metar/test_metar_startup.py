@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import unittest
+
+# Cold start budget of a parse worker in seconds, the parser itself imports in
+# about 25ms, the margin absorbs slow CI machines
+PARSE_WORKER_BUDGET = 0.25
+
+# Dependencies which take 50-300ms to import each
+HEAVY_MODULES = ("flask", "influxdb_client", "numpy", "prometheus_client", "pyarrow", "requests")
+
+def importTime(module, runs=3):
+    """Returns the fastest cumulative import time of module in a fresh interpreter and the heavy modules it loaded"""
+    script = (f"import sys, {module}\n"
+              f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        # lines are "import time: self [us] | cumulative | name", top level modules are indented by one space
+        for line in result.stderr.splitlines():
+            _, cumulative, name = line.split("|")
+            if name == f" {module}":
+                seconds = int(cumulative) / 1e6
+                best = seconds if best is None else min(best, seconds)
+    return best, [name for name in result.stdout.strip().split(",") if name]
+
+class TestStartup(unittest.TestCase):
+
+    def testParseWorkerColdStart(self):
+        seconds, heavy = importTime("metar_archive")
+        self.assertEqual(heavy, [])
+        self.assertLess(seconds, PARSE_WORKER_BUDGET)
+
+    def testLayersImportIndependently(self):
+        self.assertEqual(importTime("metar_crawler", runs=1)[1], ["prometheus_client"])
+        self.assertEqual(importTime("TimeSeriesRepository", runs=1)[1], ["prometheus_client"])
+        # the web layer loads InfluxDB, requests and numpy on first use
+        self.assertEqual(importTime("app", runs=1)[1], ["flask", "prometheus_client"])
+
+if __name__ == '__main__':
+    unittest.main()
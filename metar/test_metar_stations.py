@@ -0,0 +1,51 @@
+import unittest
+import metar_stations
+from metar_stations import Station, StationRegistry
+
+STATIONS = [
+    Station("LOWW", "Vienna International Airport", "Vienna", "AT", 48.1103, 16.5697, 600),
+    Station("LOWG", "Graz Airport", "Graz", "AT", 46.9911, 15.4396, 1115),
+    Station("LOWI", "Innsbruck Airport", "Innsbruck", "AT", 47.2602, 11.344, 1906),
+    Station("KJFK", "John F Kennedy International Airport", "New York", "US", 40.6398, -73.7789, 13),
+]
+
+class TestStationRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = StationRegistry(STATIONS)
+
+    def testLookup(self):
+        self.assertEqual(self.registry.get("loww").name, "Vienna International Airport")
+        self.assertIsNone(self.registry.get("XXXX"))
+        self.assertIn("KJFK", self.registry)
+        self.assertEqual(len(self.registry), 4)
+
+    def testPrefixAndNameSearch(self):
+        self.assertEqual([s.icao for s in self.registry.withPrefix("LOW")], ["LOWG", "LOWI", "LOWW"])
+        self.assertEqual([s.icao for s in self.registry.withPrefix("LOW", limit=1)], ["LOWG"])
+        self.assertEqual([s.icao for s in self.registry.search("inns")], ["LOWI"])
+        self.assertEqual([s.icao for s in self.registry.search("k")], ["KJFK"])
+
+    def testSelect(self):
+        selected = self.registry.select(["KJFK", "LO", "LOWW", "XXXX"])
+        self.assertEqual([s.icao for s in selected], ["KJFK", "LOWG", "LOWI", "LOWW"])
+
+    def testShippedStationFile(self):
+        registry = StationRegistry.fromCsv()
+        self.assertGreater(len(registry), 10000)
+        self.assertEqual(registry.get("LOWW").elevation, 600)
+
+class TestShardSchedule(unittest.TestCase):
+
+    def testShardsAreBalanced(self):
+        shards = metar_stations.shardStations([f"S{i:03d}" for i in range(23)], 5)
+        self.assertEqual([len(shard) for shard in shards], [5, 5, 5, 4, 4])
+        self.assertEqual(metar_stations.shardStations(["LOWW"], 5), [["LOWW"]])
+
+    def testShardStartTimes(self):
+        plan = metar_stations.shardSchedule([f"S{i:03d}" for i in range(6)], ["21", "59"], 3, 40)
+        self.assertEqual([at for at, _ in plan], ["21:00", "21:40", "22:20", "59:00", "59:40", "00:20"])
+        self.assertEqual(plan[1][1], ["S002", "S003"])
+
+if __name__ == '__main__':
+    unittest.main()
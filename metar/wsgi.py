@@ -0,0 +1,8 @@
+"""
+WSGI entry point of the API, e.g. gunicorn -c gunicorn.conf.py wsgi:application
+
+The ingestion runs in its own process, see ingest.py.
+"""
+from app import create_app
+
+application = create_app()